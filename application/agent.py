@@ -1,17 +1,26 @@
 import logging
 import sys
 import json
+import time
 import traceback
 import chat
 import utils
+import graph_registry
+import context_compactor
+import tool_index
+import tool_executor
+import mcp_pool
+import rate_limiter
+import region_scheduler
+import reference_collector
+import request_context
 
-from langgraph.prebuilt import ToolNode
 from typing import Literal
 from langgraph.graph import START, END, StateGraph
 from typing_extensions import Annotated, TypedDict
 from langgraph.graph.message import add_messages
 from langchain_core.prompts import MessagesPlaceholder, ChatPromptTemplate
-from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
+from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, AIMessageChunk
 
 logging.basicConfig(
     level=logging.INFO,  
@@ -23,267 +32,77 @@ logging.basicConfig(
 logger = logging.getLogger("agent")
 
 config = utils.load_config()
-sharing_url = config["sharing_url"] if "sharing_url" in config else None
-s3_prefix = "docs"
-capture_prefix = "captures"
+# wall-clock budget of a request. When the remaining time is less than the reserve,
+# the agent answers with the results which it has instead of calling more tools.
+agent_deadline = config["agent_deadline"] if "agent_deadline" in config else 180         # seconds, 0: no deadline
+answer_reserve = config["agent_answer_reserve"] if "agent_answer_reserve" in config else 30   # seconds
+
+# status of the running request in the user session, e.g. agent.response_msg
+session = request_context.SessionState("agent", lambda: {
+    "status_msg": [],
+    "response_msg": [],
+    "index": 0,   # next notification container
+    "collector": reference_collector.ReferenceCollector(),   # references and image urls of the tool results
+    "cache_usage": {"read": 0, "write": 0, "input": 0}   # prompt cache tokens of the request
+})
+
+def __getattr__(name):
+    if name in session:
+        return getattr(session, name)
+    raise AttributeError(f"module 'agent' has no attribute '{name}'")
 
-status_msg = []
-
-index = 0
 def add_notification(container, message):
-    global index
-    container['notification'][index].info(message)
-    index += 1
+    container['notification'][session.index].info(message)
+    session.index += 1
 
 def get_status_msg(status):
-    global status_msg
-    status_msg.append(status)
+    session.status_msg.append(status)
 
     if status != "end)":
-        status = " -> ".join(status_msg)
+        status = " -> ".join(session.status_msg)
         return "[status]\n" + status + "..."
     else: 
-        status = " -> ".join(status_msg)
+        status = " -> ".join(session.status_msg)
         return "[status]\n" + status
 
-response_msg = []
-references = []
-image_urls = []
-
-def get_tool_info(tool_name, tool_content):
-    tool_references = []    
-    urls = []
-    content = ""
-
-    # tavily
-    if isinstance(tool_content, str) and "Title:" in tool_content and "URL:" in tool_content and "Content:" in tool_content:
-        logger.info("Tavily parsing...")
-        items = tool_content.split("\n\n")
-        for i, item in enumerate(items):
-            # logger.info(f"item[{i}]: {item}")
-            if "Title:" in item and "URL:" in item and "Content:" in item:
-                try:
-                    title_part = item.split("Title:")[1].split("URL:")[0].strip()
-                    url_part = item.split("URL:")[1].split("Content:")[0].strip()
-                    content_part = item.split("Content:")[1].strip().replace("\n", "")
-                    
-                    logger.info(f"title_part: {title_part}")
-                    logger.info(f"url_part: {url_part}")
-                    logger.info(f"content_part: {content_part}")
-
-                    content += f"{content_part}\n\n"
-                    
-                    tool_references.append({
-                        "url": url_part,
-                        "title": title_part,
-                        "content": content_part[:100] + "..." if len(content_part) > 100 else content_part
-                    })
-                except Exception as e:
-                    logger.info(f"Parsing error: {str(e)}")
-                    continue                
-
-    # OpenSearch
-    elif tool_name == "SearchIndexTool": 
-        if ":" in tool_content:
-            extracted_json_data = tool_content.split(":", 1)[1].strip()
-            try:
-                json_data = json.loads(extracted_json_data)
-                # logger.info(f"extracted_json_data: {extracted_json_data[:200]}")
-            except json.JSONDecodeError:
-                logger.info("JSON parsing error")
-                json_data = {}
-        else:
-            json_data = {}
-        
-        if "hits" in json_data:
-            hits = json_data["hits"]["hits"]
-            if hits:
-                logger.info(f"hits[0]: {hits[0]}")
-
-            for hit in hits:
-                text = hit["_source"]["text"]
-                metadata = hit["_source"]["metadata"]
-                
-                content += f"{text}\n\n"
-
-                filename = metadata["name"].split("/")[-1]
-                # logger.info(f"filename: {filename}")
-                
-                content_part = text.replace("\n", "")
-                tool_references.append({
-                    "url": metadata["url"], 
-                    "title": filename,
-                    "content": content_part[:100] + "..." if len(content_part) > 100 else content_part
-                })
-                
-        logger.info(f"content: {content}")
-        
-    # Knowledge Base
-    elif tool_name == "QueryKnowledgeBases": 
-        try:
-            # Handle case where tool_content contains multiple JSON objects
-            if tool_content.strip().startswith('{'):
-                # Parse each JSON object individually
-                json_objects = []
-                current_pos = 0
-                brace_count = 0
-                start_pos = -1
-                
-                for i, char in enumerate(tool_content):
-                    if char == '{':
-                        if brace_count == 0:
-                            start_pos = i
-                        brace_count += 1
-                    elif char == '}':
-                        brace_count -= 1
-                        if brace_count == 0 and start_pos != -1:
-                            try:
-                                json_obj = json.loads(tool_content[start_pos:i+1])
-                                # logger.info(f"json_obj: {json_obj}")
-                                json_objects.append(json_obj)
-                            except json.JSONDecodeError:
-                                logger.info(f"JSON parsing error: {tool_content[start_pos:i+1][:100]}")
-                            start_pos = -1
-                
-                json_data = json_objects
-            else:
-                # Try original method
-                json_data = json.loads(tool_content)                
-            # logger.info(f"json_data: {json_data}")
-
-            # Build content
-            if isinstance(json_data, list):
-                for item in json_data:
-                    if isinstance(item, dict) and "content" in item:
-                        content_text = item["content"].get("text", "")
-                        content += content_text + "\n\n"
-
-                        uri = "" 
-                        if "location" in item:
-                            if "s3Location" in item["location"]:
-                                uri = item["location"]["s3Location"]["uri"]
-                                # logger.info(f"uri (list): {uri}")
-                                ext = uri.split(".")[-1]
-
-                                # ext가 이미지라면 
-                                url = sharing_url + "/" + s3_prefix + "/" + uri.split("/")[-1]
-                                if ext in ["jpg", "jpeg", "png", "gif", "bmp", "tiff", "ico", "webp"]:
-                                    url = sharing_url + "/" + capture_prefix + "/" + uri.split("/")[-1]
-                                logger.info(f"url: {url}")
-                                
-                                tool_references.append({
-                                    "url": url, 
-                                    "title": uri.split("/")[-1],
-                                    "content": content_text[:100] + "..." if len(content_text) > 100 else content_text
-                                })          
-                
-        except json.JSONDecodeError as e:
-            logger.info(f"JSON parsing error: {e}")
-            json_data = {}
-            content = tool_content  # Use original content if parsing fails
-
-        logger.info(f"content: {content}")
-        logger.info(f"tool_references: {tool_references}")
-
-    # aws document
-    elif tool_name == "search_documentation":
-        try:
-            json_data = json.loads(tool_content)
-            for item in json_data:
-                logger.info(f"item: {item}")
-                
-                if isinstance(item, str):
-                    try:
-                        item = json.loads(item)
-                    except json.JSONDecodeError:
-                        logger.info(f"Failed to parse item as JSON: {item}")
-                        continue
-                
-                if isinstance(item, dict) and 'url' in item and 'title' in item:
-                    url = item['url']
-                    title = item['title']
-                    content_text = item['context'][:100] + "..." if len(item['context']) > 100 else item['context']
-                    tool_references.append({
-                        "url": url,
-                        "title": title,
-                        "content": content_text
-                    })
-                else:
-                    logger.info(f"Invalid item format: {item}")
-                    
-        except json.JSONDecodeError:
-            logger.info(f"JSON parsing error: {tool_content}")
-            pass
-
-        logger.info(f"content: {content}")
-        logger.info(f"tool_references: {tool_references}")
-            
-    # ArXiv
-    elif tool_name == "search_papers" and "papers" in tool_content:
-        try:
-            json_data = json.loads(tool_content)
-
-            papers = json_data['papers']
-            for paper in papers:
-                url = paper['url']
-                title = paper['title']
-                abstract = paper['abstract'].replace("\n", "")
-                content_text = abstract[:100] + "..." if len(abstract) > 100 else abstract
-                content += f"{content_text}\n\n"
-                logger.info(f"url: {url}, title: {title}, content: {content_text}")
-
-                tool_references.append({
-                    "url": url,
-                    "title": title,
-                    "content": content_text
-                })
-        except json.JSONDecodeError:
-            logger.info(f"JSON parsing error: {tool_content}")
-            pass
-
-        logger.info(f"content: {content}")
-        logger.info(f"tool_references: {tool_references}")
-
-    else:        
-        try:
-            if isinstance(tool_content, dict):
-                json_data = tool_content
-            elif isinstance(tool_content, list):
-                json_data = tool_content
-            else:
-                json_data = json.loads(tool_content)
-            
-            logger.info(f"json_data: {json_data}")
-            if isinstance(json_data, dict) and "path" in json_data:  # path
-                path = json_data["path"]
-                if isinstance(path, list):
-                    for url in path:
-                        urls.append(url)
-                else:
-                    urls.append(path)            
-
-            for item in json_data:
-                logger.info(f"item: {item}")
-                if "reference" in item and "contents" in item:
-                    url = item["reference"]["url"]
-                    title = item["reference"]["title"]
-                    content_text = item["contents"][:100] + "..." if len(item["contents"]) > 100 else item["contents"]
-                    tool_references.append({
-                        "url": url,
-                        "title": title,
-                        "content": content_text
-                    })
-            logger.info(f"tool_references: {tool_references}")
-
-        except json.JSONDecodeError:
-            pass
-
-    return content, urls, tool_references
-
 class State(TypedDict):
     messages: Annotated[list, add_messages]
     image_url: list
 
+def get_final_request(messages):
+    """
+    One human message with the question and the tool results so far, which asks the answer.
+    The tool blocks are written as text since no tool is bound to the model.
+    """
+    request = ""
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            request += f"<question>\n{context_compactor.get_text(message.content)}\n</question>\n"
+        elif isinstance(message, ToolMessage):
+            request += f"<result tool=\"{message.name}\">\n{context_compactor.get_text(message.content)}\n</result>\n"
+        elif isinstance(message, AIMessage) and message.content:
+            request += f"<assistant>\n{chat.get_chunk_text(message)}\n</assistant>\n"
+
+    request += "\n시간 제한으로 더 이상 도구를 사용할 수 없습니다. 지금까지의 결과만으로 마지막 질문에 답변하세요."
+    return HumanMessage(content=request)
+
+def get_timing_msg(timings, start):
+    steps = ", ".join([f"{t['step']} {t['elapsed']:.1f}s" for t in timings])
+    return f"timing: total {time.time()-start:.1f}s ({steps})"
+
+def get_runtime_msg():
+    """Status of the Bedrock regions, the rate limiters and the MCP servers which are shared by the sessions."""
+    regions = ", ".join([f"{s['region']} {s['breaker']} p50 {s['p50']}s throttle {s['throttle_rate']}" for s in region_scheduler.get_status()])
+    limiters = ", ".join([f"{s['key']} delayed {s['delayed']}/{s['requests']} p95 wait {s['p95_wait']}s" for s in rate_limiter.get_status()])
+    servers = ", ".join([f"{s['name']} {'alive' if s['alive'] else 'stopped'} restarts {s['restarts']}" for s in mcp_pool.get_pool_status()])
+    hedge = region_scheduler.get_hedge_status()
+    return (
+        f"regions: {regions or '-'}\n"
+        f"hedge: {hedge['hedge_rate']*100:.1f}% hedged, {hedge['win_rate']*100:.1f}% won, {hedge['saved_per_request']}s saved per request\n"
+        f"rate limiter: {limiters or '-'}\n"
+        f"mcp servers: {servers or '-'}"
+    )
+
 async def call_model(state: State, config):
     logger.info(f"###### call_model ######")
 
@@ -297,44 +116,48 @@ async def call_model(state: State, config):
     tools = config.get("configurable", {}).get("tools", None)
     system_prompt = config.get("configurable", {}).get("system_prompt", None)
     
-    if isinstance(last_message, ToolMessage):
-        tool_name = last_message.name
-        tool_content = last_message.content
-        logger.info(f"tool_name: {tool_name}, content: {tool_content[:800]}")
-
-        if chat.debug_mode == "Enable":
-            add_notification(containers, f"{tool_name}: {str(tool_content)}")
-            response_msg.append(f"{tool_name}: {str(tool_content)}")
-
-        global references
-        content, urls, refs = get_tool_info(tool_name, tool_content)
-        if refs:
-            for r in refs:
-                references.append(r)
-            logger.info(f"refs: {refs}")
-        if urls:
-            for url in urls:
-                image_url.append(url)
-            logger.info(f"urls: {urls}")
+    # the results of the tool calls after the last AIMessage, which are parsed once by tool_call_id
+    tool_indexes = []
+    for i in range(len(state["messages"])-1, -1, -1):
+        if not isinstance(state["messages"][i], ToolMessage):
+            break
+        tool_indexes.insert(0, i)
+
+    if tool_indexes:
+        messages = list(state["messages"])
+        for i in tool_indexes:
+            tool_message = messages[i]
+            tool_name = tool_message.name
+            tool_content = tool_message.content
+            logger.info(f"tool_name: {tool_name}, content: {str(tool_content)[:800]}")
 
             if chat.debug_mode == "Enable":
-                add_notification(containers, f"Added path to image_url: {urls}")
-                response_msg.append(f"Added path to image_url: {urls}")
-
-        if content:  # manupulate the output of tool message
-            messages = state["messages"]
-            messages[-1] = ToolMessage(
-                name=tool_name,
-                tool_call_id=last_message.tool_call_id,
-                content=content
-            )
-            state["messages"] = messages
+                add_notification(containers, f"{tool_name}: {str(tool_content)}")
+                session.response_msg.append(f"{tool_name}: {str(tool_content)}")
+
+            content, urls, refs = session.collector.collect(tool_message)
+            for url in urls:
+                if url not in image_url:
+                    image_url.append(url)
+            if urls:
+                logger.info(f"urls: {urls}")
+                if chat.debug_mode == "Enable":
+                    add_notification(containers, f"Added path to image_url: {urls}")
+                    session.response_msg.append(f"Added path to image_url: {urls}")
+
+            if content:  # manupulate the output of tool message
+                messages[i] = ToolMessage(
+                    name=tool_name,
+                    tool_call_id=tool_message.tool_call_id,
+                    content=content
+                )
+        state["messages"] = messages
 
     if isinstance(last_message, AIMessage) and last_message.content:
         if chat.debug_mode == "Enable":
             containers['status'].info(get_status_msg(f"{last_message.name}"))
             add_notification(containers, f"{last_message.content}")
-            response_msg.append(last_message.content)    
+            session.response_msg.append(last_message.content)    
     
     if system_prompt:
         system = system_prompt
@@ -346,28 +169,56 @@ async def call_model(state: State, config):
             "한국어로 답변하세요."
         )
 
+    # only the tools relevant to the question are bound if many tools are selected
+    tool_selection = config.get("configurable", {}).get("tool_selection", None)
+    bound_tools = tool_selection.get_bound_tools() if tool_selection else tools
+
     chatModel = chat.get_chat(extended_thinking=chat.reasoning_mode)
-    model = chatModel.bind_tools(tools)
+    model = graph_registry.bind_tools(chatModel, bound_tools)
+
+    start = time.time()
+    remaining = tool_executor.get_remaining_time(config)
+    force_answer = remaining is not None and remaining < answer_reserve
+    if force_answer:  # answer without tools
+        logger.info(f"force to answer: remaining {remaining:.1f}s")
+        if chat.debug_mode == "Enable":
+            add_notification(containers, f"시간 제한으로 답변을 생성합니다. (남은 시간: {max(remaining, 0):.1f}s)")
+        model = chatModel
 
     try:
         prompt = ChatPromptTemplate.from_messages(
             [
-                ("system", system),
+                chat.get_system_message(system, chatModel.model_id),
                 MessagesPlaceholder(variable_name="messages"),
             ]
         )
         chain = prompt | model
             
-        response = await chain.ainvoke(state["messages"])
+        if force_answer:
+            messages = [get_final_request(state["messages"])]
+        else:
+            # old tool results are replaced by stubs if the prompt is larger than the budget
+            messages = context_compactor.compact(state["messages"], system)
+
+        # the config of the node is passed to stream the tokens of the response
+        response = await chain.ainvoke(messages, config)
         logger.info(f"response of call_model: {response}")
 
+        cache_read, cache_write, input_tokens = chat.get_cache_usage(response)
+        session.cache_usage["read"] += cache_read
+        session.cache_usage["write"] += cache_write
+        session.cache_usage["input"] += input_tokens
+        logger.info(f"prompt cache: read={cache_read}, write={cache_write}, input={input_tokens}")
+
     except Exception:
         response = AIMessage(content="답변을 찾지 못하였습니다.")
 
         err_msg = traceback.format_exc()
         logger.info(f"error message: {err_msg}")
 
-    return {"messages": [response], "image_url": image_url, "index": index}
+    tool_executor.add_timing(config, "agent", time.time()-start)
+
+    return {"messages": [response], "image_url": image_url, "index": session.index}
 
 async def should_continue(state: State, config) -> Literal["continue", "end"]:
     logger.info(f"###### should_continue ######")
@@ -378,27 +229,31 @@ async def should_continue(state: State, config) -> Literal["continue", "end"]:
     containers = config.get("configurable", {}).get("containers", None)
     
     if isinstance(last_message, AIMessage) and last_message.tool_calls:
-        tool_name = last_message.tool_calls[-1]['name']
-        logger.info(f"--- CONTINUE: {tool_name} ---")
-
-        tool_args = last_message.tool_calls[-1]['args']
+        tool_names = [tool_call['name'] for tool_call in last_message.tool_calls]
+        logger.info(f"--- CONTINUE: {tool_names} ---")
 
         if last_message.content:
             logger.info(f"last_message: {last_message.content}")
             if chat.debug_mode == "Enable":
                 add_notification(containers, f"{last_message.content}")
-                response_msg.append(last_message.content)
+                session.response_msg.append(last_message.content)
+
+        # the tool calls are executed concurrently by tool_executor
+        for tool_call in last_message.tool_calls:
+            tool_name = tool_call['name']
+            tool_args = tool_call['args']
+
+            logger.info(f"tool_name: {tool_name}, tool_args: {tool_args}")
+            if chat.debug_mode == "Enable":
+                add_notification(containers, f"{tool_name}: {tool_args}")
+            
+                if "code" in tool_args:
+                    logger.info(f"code: {tool_args['code']}")
+                    add_notification(containers, f"{tool_args['code']}")
+                    session.response_msg.append(f"{tool_args['code']}")
 
-        logger.info(f"tool_name: {tool_name}, tool_args: {tool_args}")
-        if chat.debug_mode == "Enable":
-            add_notification(containers, f"{tool_name}: {tool_args}")
-        
         if chat.debug_mode == "Enable":
-            containers['status'].info(get_status_msg(f"{tool_name}"))
-            if "code" in tool_args:
-                logger.info(f"code: {tool_args['code']}")
-                add_notification(containers, f"{tool_args['code']}")
-                response_msg.append(f"{tool_args['code']}")
+            containers['status'].info(get_status_msg(f"{', '.join(tool_names)}"))
 
         return "continue"
     else:
@@ -408,13 +263,11 @@ async def should_continue(state: State, config) -> Literal["continue", "end"]:
         logger.info(f"--- END ---")
         return "end"
 
-def buildChatAgent(tools):
-    tool_node = ToolNode(tools)
-
+def buildChatAgent():
     workflow = StateGraph(State)
 
     workflow.add_node("agent", call_model)
-    workflow.add_node("action", tool_node)
+    workflow.add_node("action", tool_executor.execute_tool_calls)
     workflow.add_edge(START, "agent")
     workflow.add_conditional_edges(
         "agent",
@@ -428,13 +281,11 @@ def buildChatAgent(tools):
 
     return workflow.compile() 
 
-def buildChatAgentWithHistory(tools):
-    tool_node = ToolNode(tools)
-
+def buildChatAgentWithHistory():
     workflow = StateGraph(State)
 
     workflow.add_node("agent", call_model)
-    workflow.add_node("action", tool_node)
+    workflow.add_node("action", tool_executor.execute_tool_calls)
     workflow.add_edge(START, "agent")
     workflow.add_conditional_edges(
         "agent",
@@ -451,131 +302,146 @@ def buildChatAgentWithHistory(tools):
         store=chat.memorystore
     )
 
-def extract_reference(response):
-    references = []
-    for i, re in enumerate(response):
-        if isinstance(re, ToolMessage):
-            logger.info(f"###### extract_reference ######")
-            try: 
-                
-                # check json format
-                if isinstance(re.content, str) and (re.content.strip().startswith('{') or re.content.strip().startswith('[')):
-                    tool_result = json.loads(re.content)
-                    # logger.info(f"tool_result: {tool_result}")
+def get_chat_agent(historyMode):
+    """Compiled agent which gets the tools of the request from config["configurable"]["tools"]."""
+    if historyMode == "Enable":
+        return graph_registry.get_graph("agent-with-history", buildChatAgentWithHistory)   # the sessions are separated by the thread_id
+    else:
+        return graph_registry.get_graph("agent", buildChatAgent)
+
+async def stream_agent(app, inputs, config, containers):
+    """
+    Run the agent with the updates of nodes and the tokens of the LLM. The tokens of the
+    agent node are shown in containers['message'] while they are generated. Return the last
+    output of the agent node.
+    """
+    final_output = None
+    message_container = containers.get("message") if containers else None
+
+    stream = ""
+    step = None
+    async for mode, payload in app.astream(inputs, config, stream_mode=["updates", "messages"]):
+        if mode == "messages":
+            chunk, metadata = payload
+            if message_container is None or metadata.get("langgraph_node") != "agent" or not isinstance(chunk, AIMessageChunk):
+                continue
+
+            if metadata.get("langgraph_step") != step:  # new response of the agent
+                step = metadata.get("langgraph_step")
+                stream = ""
+
+            text = chat.get_chunk_text(chunk)
+            if text:
+                stream += text
+                message_container.markdown(stream + "▌")
+            continue
+
+        for key, value in payload.items():
+            logger.info(f"--> key: {key}, value: {value}")
+
+            if key == "messages" or key == "agent":
+                if isinstance(value, dict) and "messages" in value:
+                    message = value["messages"]
+                    final_output = value
+                elif isinstance(value, list):
+                    value = {"messages": value, "image_url": []}
+                    message = value["messages"]
+                    final_output = value
                 else:
-                    tool_result = re.content
-                    # logger.info(f"tool_result (not JSON): {tool_result[:200]}")
-                                
-                if isinstance(tool_result, list):
-                    logger.info(f"size of tool_result: {len(tool_result)}")
-                    for i, item in enumerate(tool_result):
-                        logger.info(f'item[{i}]: {item}')
-                        
-                        # RAG
-                        if "reference" in item:
-                            logger.info(f"reference: {item['reference']}")
-
-                            infos = item['reference']
-                            url = infos['url']
-                            title = infos['title']
-                            source = infos['from']
-                            logger.info(f"url: {url}, title: {title}, source: {source}")
-
-                            references.append({
-                                "url": url,
-                                "title": title,
-                                "content": item['contents'][:100].replace("\n", "")
-                            })
-
-                        # Others               
-                        if isinstance(item, str):
-                            try:
-                                item = json.loads(item)
-
-                                # AWS Document
-                                if "rank_order" in item:
-                                    references.append({
-                                        "url": item['url'],
-                                        "title": item['title'],
-                                        "content": item['context'][:100].replace("\n", "")
-                                  })
-                            except json.JSONDecodeError:
-                                logger.info(f"JSON parsing error: {item}")
-                                continue
-
-            except:
-                logger.info(f"fail to parsing..")
-                pass
-    return references
+                    value = {"messages": [value], "image_url": []}
+                    message = value["messages"]
+                    final_output = value
+
+                if message and isinstance(message[-1], AIMessage) and message[-1].tool_calls and message_container is not None:
+                    message_container.empty()   # the streamed text was not the final answer
+
+    if message_container is not None:
+        message_container.empty()  # the final answer is written by the caller with the references
+
+    timings = config.get("timings", None)
+    if timings is not None and "start" in config:
+        timing_msg = get_timing_msg(timings, config["start"])
+        logger.info(timing_msg)
+        if chat.debug_mode == "Enable":
+            add_notification(containers, timing_msg)
+
+    runtime_msg = get_runtime_msg()
+    logger.info(runtime_msg)
+    if chat.debug_mode == "Enable":
+        add_notification(containers, runtime_msg)
+
+    logger.info(f"prompt cache of the request: {session.cache_usage}")
+    if chat.debug_mode == "Enable" and (session.cache_usage["read"] or session.cache_usage["write"]):
+        add_notification(containers, f"prompt cache: read {session.cache_usage['read']}, write {session.cache_usage['write']}, input {session.cache_usage['input']} tokens")
+
+    return final_output
 
 async def run(question, tools, containers, historyMode):
-    global status_msg, response_msg, references, image_urls
-    status_msg = []
-    response_msg = []
-    references = []
-    image_urls = []
+    session.status_msg = []
+    session.response_msg = []
+    session.collector = reference_collector.ReferenceCollector()
+    session.cache_usage = {"read": 0, "write": 0, "input": 0}
+    start = time.time()
 
     if chat.debug_mode == "Enable":
         containers["status"].info(get_status_msg("(start"))
 
+    extra_tools = []
+    if context_compactor.is_enabled():  # compacted tool results can be read again
+        extra_tools.append(context_compactor.get_tool_result)
+
+    tool_selection = tool_index.select_tools(tools, question, always=extra_tools)
+    tools = tools + extra_tools
+    if tool_selection:
+        tools.append(tool_selection.expand_tool)
+
     if historyMode == "Enable":
-        app = buildChatAgentWithHistory(tools)
+        app = get_chat_agent(historyMode)
         config = {
             "recursion_limit": 50,
             "configurable": {"thread_id": chat.userId},
             "containers": containers,
-            "tools": tools
+            "tools": tools,
+            "tool_selection": tool_selection,
+            "start": start,
+            "deadline": start + agent_deadline if agent_deadline else None,
+            "answer_reserve": answer_reserve,
+            "session_arguments": chat.get_session_arguments(),
+            "timings": []
         }
     else:
-        app = buildChatAgent(tools)
+        app = get_chat_agent(historyMode)
         config = {
             "recursion_limit": 50,
             "containers": containers,
-            "tools": tools
+            "tools": tools,
+            "tool_selection": tool_selection,
+            "start": start,
+            "deadline": start + agent_deadline if agent_deadline else None,
+            "answer_reserve": answer_reserve,
+            "session_arguments": chat.get_session_arguments(),
+            "timings": []
         }
     
     inputs = {
         "messages": [HumanMessage(content=question)]
     }
     
-    global index
-    index = 0
-
-    value = result = None
-    final_output = None
-    async for output in app.astream(inputs, config):
-        for key, value in output.items():
-            logger.info(f"--> key: {key}, value: {value}")
+    session.index = 0
 
-            if key == "messages" or key == "agent":
-                if isinstance(value, dict) and "messages" in value:
-                    message = value["messages"]
-                    final_output = value
-                elif isinstance(value, list):
-                    value = {"messages": value, "image_url": []}
-                    message = value["messages"]
-                    final_output = value
-                else:
-                    value = {"messages": [value], "image_url": []}
-                    message = value["messages"]
-                    final_output = value
+    result = None
+    final_output = await stream_agent(app, inputs, config, containers)
 
-                refs = extract_reference(message)
-                if refs:
-                    for r in refs:
-                        references.append(r)
-                        logger.info(f"r: {r}")
-                
     if final_output and "messages" in final_output and len(final_output["messages"]) > 0:
         result = final_output["messages"][-1].content
     else:
         result = "답변을 찾지 못하였습니다."
 
     logger.info(f"result: {final_output}")
-    logger.info(f"references: {references}")
-    if references:
+    logger.info(f"references: {session.collector.references}")
+    if session.collector.references:
         ref = "\n\n### Reference\n"
-        for i, reference in enumerate(references):
+        for i, reference in enumerate(session.collector.references):
             ref += f"{i+1}. [{reference['title']}]({reference['url']}), {reference['content']}...\n"    
         result += ref
 
@@ -584,60 +450,60 @@ async def run(question, tools, containers, historyMode):
     return result, image_url
 
 async def run_task(question, tools, system_prompt, containers, historyMode, previous_status_msg, previous_response_msg):
-    global status_msg, response_msg, references, image_urls
-    status_msg = previous_status_msg
-    response_msg = previous_response_msg
+    session.status_msg = previous_status_msg
+    session.response_msg = previous_response_msg
+    session.collector = reference_collector.ReferenceCollector()
+    session.cache_usage = {"read": 0, "write": 0, "input": 0}
+    start = time.time()
 
     if chat.debug_mode == "Enable":
         containers["status"].info(get_status_msg("(start"))
 
+    extra_tools = []
+    if context_compactor.is_enabled():  # compacted tool results can be read again
+        extra_tools.append(context_compactor.get_tool_result)
+
+    tool_selection = tool_index.select_tools(tools, question, always=extra_tools)
+    tools = tools + extra_tools
+    if tool_selection:
+        tools.append(tool_selection.expand_tool)
+
     if historyMode == "Enable":
-        app = buildChatAgentWithHistory(tools)
+        app = get_chat_agent(historyMode)
         config = {
             "recursion_limit": 50,
             "configurable": {"thread_id": chat.userId},
             "containers": containers,
             "tools": tools,
-            "system_prompt": system_prompt
+            "tool_selection": tool_selection,
+            "system_prompt": system_prompt,
+            "start": start,
+            "deadline": start + agent_deadline if agent_deadline else None,
+            "answer_reserve": answer_reserve,
+            "session_arguments": chat.get_session_arguments(),
+            "timings": []
         }
     else:
-        app = buildChatAgent(tools)
+        app = get_chat_agent(historyMode)
         config = {
             "recursion_limit": 50,
             "containers": containers,
             "tools": tools,
-            "system_prompt": system_prompt
+            "tool_selection": tool_selection,
+            "system_prompt": system_prompt,
+            "start": start,
+            "deadline": start + agent_deadline if agent_deadline else None,
+            "answer_reserve": answer_reserve,
+            "session_arguments": chat.get_session_arguments(),
+            "timings": []
         }
 
-    value = None
     inputs = {
         "messages": [HumanMessage(content=question)]
     }
 
-    final_output = None
-    async for output in app.astream(inputs, config):
-        for key, value in output.items():
-            logger.info(f"--> key: {key}, value: {value}")
-            
-            if key == "messages" or key == "agent":
-                if isinstance(value, dict) and "messages" in value:
-                    message = value["messages"]
-                    final_output = value
-                elif isinstance(value, list):
-                    value = {"messages": value, "image_url": []}
-                    message = value["messages"]
-                    final_output = value
-                else:
-                    value = {"messages": [value], "image_url": []}
-                    message = value["messages"]
-                    final_output = value
+    final_output = await stream_agent(app, inputs, config, containers)
 
-                refs = extract_reference(message)
-                if refs:
-                    for r in refs:
-                        references.append(r)
-                        logger.info(f"r: {r}")
-                
     if final_output and "messages" in final_output and len(final_output["messages"]) > 0:
         result = final_output["messages"][-1].content
     else:
@@ -645,4 +511,4 @@ async def run_task(question, tools, system_prompt, containers, historyMode, prev
 
     image_url = final_output["image_url"] if final_output and "image_url" in final_output else []
 
-    return result, image_url, status_msg, response_msg
\ No newline at end of file
+    return result, image_url, session.status_msg, session.response_msg
\ No newline at end of file
@@ -17,6 +17,7 @@ import asyncio
 import random
 import string
 import aws_cost.implementation as aws_cost
+import request_context
 
 logging.basicConfig(
     level=logging.INFO,  # Default to INFO level
@@ -27,6 +28,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger("streamlit")
 
+# the model, modes and results of this session are kept in its own request context
+request_context.activate_session(st.session_state)
+
 try:
     user_info = pwd.getpwuid(os.getuid())
     username = user_info.pw_name
@@ -71,6 +75,9 @@ mode_descriptions = {
     "Agent (Chat)": [
         "MCP를 활용한 Agent를 이용합니다. 채팅 히스토리를 이용해 interative한 대화를 즐길 수 있습니다."
     ],
+    "Agent (Plan)": [
+        "MCP를 활용한 Agent가 먼저 도구 실행 계획을 세우고, 서로 독립적인 도구들을 동시에 실행한 후에 한번에 답변합니다."
+    ],
     "Multi-agent Supervisor (Router)": [
         "Multi-agent Supervisor (Router)에 기반한 대화입니다. 여기에서는 Supervisor/Collaborators의 구조를 가지고 있습니다."
     ],
@@ -133,13 +140,13 @@ def cost_analysis():
             st.info("비용 데이터를 가져옵니다.")
             cost_data = cost.get_cost_analysis()
             logger.info(f"cost_data: {cost_data}")
-            cost.cost_data = cost_data
+            cost.session.cost_data = cost_data
         else:
             if not cost.insights:        
                 st.info("잠시만 기다리세요. 지난 한달간의 사용량을 분석하고 있습니다...")
                 insights = cost.generate_cost_insights()
                 logger.info(f"insights: {insights}")
-                cost.insights = insights
+                cost.session.insights = insights
             
             st.markdown(cost.insights)
             st.session_state.messages.append({"role": "assistant", "content": cost.insights})
@@ -194,13 +201,13 @@ with st.sidebar:
     
     # radio selection
     mode = st.radio(
-        label="원하는 대화 형태를 선택하세요. ",options=["일상적인 대화", "RAG", "Agent", "Agent (Chat)", "Multi-agent Supervisor (Router)", "LangGraph Supervisor", "LangGraph Swarm", "번역하기", "문법 검토하기", "이미지 분석", "비용 분석"], index=2
+        label="원하는 대화 형태를 선택하세요. ",options=["일상적인 대화", "RAG", "Agent", "Agent (Chat)", "Agent (Plan)", "Multi-agent Supervisor (Router)", "LangGraph Supervisor", "LangGraph Swarm", "번역하기", "문법 검토하기", "이미지 분석", "비용 분석"], index=2
     )   
     st.info(mode_descriptions[mode][0])
     
     # mcp selection
     mcp = ""
-    if mode=='Agent' or mode=='Agent (Chat)' or mode=='비용 분석':
+    if mode=='Agent' or mode=='Agent (Chat)' or mode=='Agent (Plan)' or mode=='비용 분석':
         # MCP Config JSON input
         st.subheader("⚙️ MCP Config")
 
@@ -318,15 +325,20 @@ with st.sidebar:
     gradingMode = 'Enable' if select_grading else 'Disable'
     # logger.info(f"gradingMode: {gradingMode}")
 
+    # start MCP servers when their tools are called
+    select_lazy = st.checkbox('MCP Lazy Loading', value=False)
+    lazyMode = 'Enable' if select_lazy else 'Disable'
+    # logger.info(f"lazyMode: {lazyMode}")
+
     uploaded_file = None
     if mode=='이미지 분석':
         st.subheader("🌇 이미지 업로드")
         uploaded_file = st.file_uploader("이미지 요약을 위한 파일을 선택합니다.", type=["png", "jpg", "jpeg"])
-    elif mode=='RAG' or mode=="Agent" or mode=="Agent (Chat)" or mode=='비용 분석':
+    elif mode=='RAG' or mode=="Agent" or mode=="Agent (Chat)" or mode=="Agent (Plan)" or mode=='비용 분석':
         st.subheader("📋 문서 업로드")
         uploaded_file = st.file_uploader("RAG를 위한 파일을 선택합니다.", type=["pdf", "txt", "py", "md", "csv", "json"], key=chat.fileId)
 
-    chat.update(modelName, debugMode, multiRegion, mcp, reasoningMode, gradingMode)
+    chat.update(modelName, debugMode, multiRegion, mcp, reasoningMode, gradingMode, lazyMode)
 
     st.success(f"Connected to {modelName}", icon="💚")
     clear_button = st.button("대화 초기화", key="clear")
@@ -336,8 +348,8 @@ st.title('🔮 '+ mode)
 
 if clear_button==True:
     chat.initiate()
-    cost.cost_data = {}
-    cost.visualizations = {}
+    cost.session.cost_data = {}
+    cost.session.visualizations = {}
 
 # Initialize chat history
 if "messages" not in st.session_state:
@@ -503,6 +515,24 @@ if prompt := st.chat_input("메시지를 입력하세요."):
                 file_name = url[url.rfind('/')+1:]
                 st.image(url, caption=file_name, use_container_width=True)            
 
+        elif mode == 'Agent (Plan)':
+            sessionState = ""
+            chat.references = []
+            chat.image_url = []
+            response, image_url = asyncio.run(chat.run_plan_agent(prompt, st))
+
+            st.session_state.messages.append({
+                "role": "assistant", 
+                "content": response,
+                "images": image_url if image_url else []
+            })
+
+            st.write(response)
+            for url in image_url:
+                logger.info(f"url: {url}")
+                file_name = url[url.rfind('/')+1:]
+                st.image(url, caption=file_name, use_container_width=True)
+
         elif mode == "Multi-agent Supervisor (Router)":
             sessionState = ""
             chat.references = []
@@ -27,6 +27,7 @@ import sys
 import base64
 import random
 import chat
+import request_context
 import os
 import json
 import traceback
@@ -155,20 +156,27 @@ class CostState(TypedDict):
     final_response: str
 
 # Define stand-alone functions
-status_msg = []
+# status of the running request in the user session
+session = request_context.SessionState("aws_cost", lambda: {
+    "status_msg": [],
+    "response_msg": []
+})
+
+def __getattr__(name):
+    if name in session:
+        return getattr(session, name)
+    raise AttributeError(f"module 'aws_cost' has no attribute '{name}'")
+
 def get_status_msg(status):
-    global status_msg
-    status_msg.append(status)
+    session.status_msg.append(status)
 
     if status != "end":
-        status = " -> ".join(status_msg)
+        status = " -> ".join(session.status_msg)
         return "[status]\n" + status + "..."
     else: 
-        status = " -> ".join(status_msg)
+        status = " -> ".join(session.status_msg)
         return "[status]\n" + status
 
-response_msg = []
-
 def service_cost(state: CostState, config) -> dict:
     logger.info(f"###### service_cost ######")
 
@@ -217,7 +225,7 @@ def service_cost(state: CostState, config) -> dict:
     if response_container:
         value = service_costs.to_string()
         response_container.info('[response]\n' + value[:800])
-        response_msg.append(value[:800])
+        session.response_msg.append(value[:800])
     
     # service cost (pie chart)
     fig_pie = px.pie(
@@ -247,7 +255,7 @@ def service_cost(state: CostState, config) -> dict:
     if response_container:
         value = summary
         response_container.info('[response]\n' + value[:200])
-        response_msg.append(value[:200])
+        session.response_msg.append(value[:200])
 
     appendix = state["appendix"] if "appendix" in state else []
     appendix.append(body)
@@ -305,7 +313,7 @@ def region_cost(state: CostState, config) -> dict:
     if response_container:
         value = region_costs.to_string()
         response_container.info('[response]\n' + value[:800])
-        response_msg.append(value[:800])
+        session.response_msg.append(value[:800])
 
     # region cost (bar chart)
     fig_bar = px.bar(
@@ -333,7 +341,7 @@ def region_cost(state: CostState, config) -> dict:
     if response_container:
         value = body
         response_container.info('[response]\n' + time + body[:200])
-        response_msg.append(time + value[:200])
+        session.response_msg.append(time + value[:200])
 
     appendix = state["appendix"] if "appendix" in state else []
     appendix.append(body)
@@ -394,7 +402,7 @@ def daily_cost(state: CostState, config) -> dict:
     if response_container:
         value = daily_costs_df.to_string()
         response_container.info('[response]\n' + value[:800])
-        response_msg.append(value[:800])
+        session.response_msg.append(value[:800])
 
     # daily trend cost (line chart)
     fig_line = px.line(
@@ -424,7 +432,7 @@ def daily_cost(state: CostState, config) -> dict:
     if response_container:
         value = body
         response_container.info('[response]\n' + value[:200])
-        response_msg.append(value[:200])
+        session.response_msg.append(value[:200])
 
     appendix = state["appendix"] if "appendix" in state else []
     appendix.append(body)
@@ -504,7 +512,7 @@ def generate_insight(state: CostState, config) -> dict:
     if response_container:
         value = response.content
         response_container.info('[response]\n' + value[:500])
-        response_msg.append(value[:500])
+        session.response_msg.append(value[:500])
 
     iteration = state["iteration"] if "iteration" in state else 0
 
@@ -536,7 +544,7 @@ def reflect_context(state: CostState, config) -> dict:
     if response_container:
         value = body
         response_container.info('[response]\n' + value[:500])
-        response_msg.append(value[:500])
+        session.response_msg.append(value[:500])
 
     return {
         "reflection": result
@@ -555,8 +563,7 @@ def mcp_tools(state: CostState, config) -> dict:
     if status_container:
         status_container.info(get_status_msg("mcp_tools"))
 
-    global status_msg, response_msg 
-    reflection_result, image_url, status_msg, response_msg = asyncio.run(reflection_agent.run(draft, state["reflection"], status_container, response_container, key_container, status_msg, response_msg))
+    reflection_result, image_url, session.status_msg, session.response_msg = asyncio.run(reflection_agent.run(draft, state["reflection"], status_container, response_container, key_container, session.status_msg, session.response_msg))
     logger.info(f"reflection result: {reflection_result}")
 
     value = ""
@@ -578,7 +585,7 @@ def mcp_tools(state: CostState, config) -> dict:
     if response_container:
         value = body
         response_container.info('[response]\n' + value[:500])
-        response_msg.append(value[:500])
+        session.response_msg.append(value[:500])
 
     additional_context = state["additional_context"] if "additional_context" in state else []
     additional_context.append(reflection_result)
@@ -622,8 +629,7 @@ cost_agent = agent.compile()
 def run(request_id: str, status_container=None, response_container=None, key_container=None):
     logger.info(f"request_id: {request_id}")
 
-    global status_msg
-    status_msg = []
+    session.status_msg = []
 
     # add plan to report
     key = f"artifacts/{request_id}_plan.md"
@@ -3,15 +3,16 @@ import sys
 import json
 import traceback
 import chat
+import mcp_pool
+import request_context
+import tool_executor
 
-from langgraph.prebuilt import ToolNode
 from typing import Literal
 from langgraph.graph import START, END, StateGraph
 from typing_extensions import Annotated, TypedDict
 from langgraph.graph.message import add_messages
 from langchain_core.prompts import MessagesPlaceholder, ChatPromptTemplate
 from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
-from langchain_mcp_adapters.client import MultiServerMCPClient
 
 import chat
 
@@ -24,20 +25,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger("agent")
 
-status_msg = []
+# status of the running request in the user session
+session = request_context.SessionState("reflection_agent", lambda: {
+    "status_msg": [],
+    "response_msg": []
+})
+
+def __getattr__(name):
+    if name in session:
+        return getattr(session, name)
+    raise AttributeError(f"module 'reflection_agent' has no attribute '{name}'")
+
 def get_status_msg(status):
-    global status_msg
-    status_msg.append(status)
+    session.status_msg.append(status)
 
     if status != "end)":
-        status = " -> ".join(status_msg)
+        status = " -> ".join(session.status_msg)
         return "[status]\n" + status + "..."
     else: 
-        status = " -> ".join(status_msg)
+        status = " -> ".join(session.status_msg)
         return "[status]\n" + status
 
-response_msg = []
-
 class State(TypedDict):
     messages: Annotated[list, add_messages]
     image_url: list
@@ -73,20 +81,20 @@ async def call_model(state: State, config):
                 logger.info(f"image_url: {image_url}")
                 if chat.debug_mode == "Enable":
                     response_container.info(f"Added path to image_url: {json_data['path']}")
-                    response_msg.append(f"Added path to image_url: {json_data['path']}")
+                    session.response_msg.append(f"Added path to image_url: {json_data['path']}")
 
         except json.JSONDecodeError:
             pass
 
         if chat.debug_mode == "Enable":
             response_container.info(f"{tool_name}: {tool_content[:800]}")
-            response_msg.append(f"{tool_name}: {tool_content[:800]}")
+            session.response_msg.append(f"{tool_name}: {tool_content[:800]}")
 
     if isinstance(last_message, AIMessage) and last_message.content:
         if chat.debug_mode == "Enable":
             status_container.info(get_status_msg(f"{last_message.name}"))
             response_container.info(f"{last_message.content[:800]}")
-            response_msg.append(last_message.content[:800])    
+            session.response_msg.append(last_message.content[:800])    
         
     system = (
         "당신은 보고서를 잘 작성하는 논리적이고 똑똑한 AI입니다."
@@ -136,7 +144,7 @@ async def should_continue(state: State, config) -> Literal["continue", "end"]:
             logger.info(f"last_message: {last_message.content}")
             if chat.debug_mode == "Enable":
                 response_container.info(f"{last_message.content}")
-                response_msg.append(last_message.content)
+                session.response_msg.append(last_message.content)
 
         logger.info(f"tool_name: {tool_name}, tool_args: {tool_args}")
         if chat.debug_mode == "Enable":
@@ -144,7 +152,7 @@ async def should_continue(state: State, config) -> Literal["continue", "end"]:
             if "code" in tool_args:
                 logger.info(f"code: {tool_args['code']}")
                 key_container.code(tool_args['code'])
-                response_msg.append(f"{tool_args['code']}")
+                session.response_msg.append(f"{tool_args['code']}")
 
         return "continue"
     else:
@@ -154,13 +162,11 @@ async def should_continue(state: State, config) -> Literal["continue", "end"]:
         logger.info(f"--- END ---")
         return "end"
 
-def buildChatAgent(tools):
-    tool_node = ToolNode(tools)
-
+def buildChatAgent():
     workflow = StateGraph(State)
 
     workflow.add_node("agent", call_model)
-    workflow.add_node("action", tool_node)
+    workflow.add_node("action", tool_executor.execute_tool_calls)   # the session arguments are added to the MCP tool calls
     workflow.add_edge(START, "agent")
     workflow.add_conditional_edges(
         "agent",
@@ -274,59 +280,58 @@ def extract_reference(response):
     return references
 
 async def run(draft, reflection, status_container, response_container, key_container, previous_status_msg, previous_response_msg):
-    global status_msg, response_msg
-    status_msg = previous_status_msg
-    response_msg = previous_response_msg
+    session.status_msg = previous_status_msg
+    session.response_msg = previous_response_msg
 
     server_params = chat.load_multiple_mcp_server_parameters()
     logger.info(f"server_params: {server_params}")
 
-    async with MultiServerMCPClient(server_params) as client:
-        tools = client.get_tools()
-
-        if chat.debug_mode == "Enable":
-            logger.info(f"tools: {tools}")
-            
-            tool_info = []
-            for tool in tools:
-                description = tool.description.split('\n')[0]
-                tool_info.append(f"{tool.name}: {description}")
-            tool_summary = "\n".join(tool_info)
-
-            response_container.info(f"{tool_summary}")
-            response_msg.append(f"{tool_summary}")
-
-        instruction = (
-            f"<reflection>{reflection}</reflection>\n\n"
-            f"<draft>{draft}</draft>"
-        )
+    tools = await mcp_pool.get_tools(server_params, lazy=chat.mcp_lazy_mode=='Enable')
 
-        if chat.debug_mode == "Enable":
-            status_container.info(get_status_msg("(start"))
-
-        app = buildChatAgent(tools)
-        config = {
-            "recursion_limit": 50,
-            "status_container": status_container,
-            "response_container": response_container,
-            "key_container": key_container,
-            "tools": tools            
-        }
-
-        value = None
-        inputs = {
-            "messages": [HumanMessage(content=instruction)]
-        }
-
-        references = []
-        final_output = None
-        async for output in app.astream(inputs, config):
-            for key, value in output.items():
-                logger.info(f"--> key: {key}, value: {value}")
-                final_output = output
+    if chat.debug_mode == "Enable":
+        logger.info(f"tools: {tools}")
         
-        result = final_output["messages"][-1].content
-        logger.info(f"result: {result}")
-        image_url = final_output["image_url"] if "image_url" in final_output else []
+        tool_info = []
+        for tool in tools:
+            description = tool.description.split('\n')[0]
+            tool_info.append(f"{tool.name}: {description}")
+        tool_summary = "\n".join(tool_info)
+
+        response_container.info(f"{tool_summary}")
+        session.response_msg.append(f"{tool_summary}")
+
+    instruction = (
+        f"<reflection>{reflection}</reflection>\n\n"
+        f"<draft>{draft}</draft>"
+    )
+
+    if chat.debug_mode == "Enable":
+        status_container.info(get_status_msg("(start"))
+
+    app = buildChatAgent()
+    config = {
+        "recursion_limit": 50,
+        "status_container": status_container,
+        "response_container": response_container,
+        "key_container": key_container,
+        "tools": tools,
+        "session_arguments": chat.get_session_arguments()
+    }
+
+    value = None
+    inputs = {
+        "messages": [HumanMessage(content=instruction)]
+    }
+
+    references = []
+    final_output = None
+    async for output in app.astream(inputs, config):
+        for key, value in output.items():
+            logger.info(f"--> key: {key}, value: {value}")
+            final_output = output
+    
+    result = final_output["messages"][-1].content
+    logger.info(f"result: {result}")
+    image_url = final_output["image_url"] if "image_url" in final_output else []
 
-        return result, image_url, status_msg, response_msg
+    return result, image_url, session.status_msg, session.response_msg
@@ -1,16 +1,25 @@
 import traceback
 import boto3
+import asyncio
 import os
 import json
 import re
 import uuid
 import time
 import base64
+import threading
 import info 
 import PyPDF2
 import csv
 import utils
 import agent
+import plan_execute
+import mcp_pool
+import region_scheduler
+import hedged_chat
+import failover_chat
+import rate_limiter
+import request_context
 
 from io import BytesIO
 from PIL import Image
@@ -27,20 +36,13 @@ from pydantic.v1 import BaseModel, Field
 from langchain_core.output_parsers import StrOutputParser
 from langchain_community.utilities.tavily_search import TavilySearchAPIWrapper
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
-
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
-from langchain_mcp_adapters.tools import load_mcp_tools
-from langgraph.prebuilt import ToolNode
-from typing import Literal
-from langgraph.graph import START, END, StateGraph
-from typing_extensions import Annotated, TypedDict
-from langgraph.graph.message import add_messages
-from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, SystemMessage
+
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.store.memory import InMemoryStore
-from multiprocessing import Process, Pipe
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from grade_cache import GradeCache
 
 import logging
 import sys
@@ -54,30 +56,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger("chat")
 
-userId = uuid.uuid4().hex
-map_chain = dict() 
-
-checkpointers = dict() 
-memorystores = dict() 
-
-checkpointer = MemorySaver()
-memorystore = InMemoryStore()
-
-checkpointers[userId] = checkpointer
-memorystores[userId] = memorystore
-
-reasoning_mode = 'Disable'
-debug_messages = []  # List to store debug messages
-
 def get_debug_messages():
-    global debug_messages
-    messages = debug_messages.copy()
-    debug_messages = []  # Clear messages after returning
+    messages = session.debug_messages.copy()
+    session.debug_messages = []  # Clear messages after returning
     return messages
 
 def push_debug_messages(type, contents):
-    global debug_messages
-    debug_messages.append({
+    session.debug_messages.append({
         type: contents
     })
 
@@ -129,30 +114,14 @@ def status_messages(message):
             push_debug_messages("text", status)
 
 def initiate():
-    global userId
-    global memory_chain, checkpointers, memorystores, checkpointer, memorystore
+    """Start a new conversation of the session. The memory of the previous one is released."""
+    release_user(session.userId)
 
-    userId = uuid.uuid4().hex
-    logger.info(f"userId: {userId}")
-
-    if userId in map_chain:  
-            # print('memory exist. reuse it!')
-            memory_chain = map_chain[userId]
-
-            checkpointer = checkpointers[userId]
-            memorystore = memorystores[userId]
-    else: 
-        # print('memory does not exist. create new one!')        
-        memory_chain = ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=5)
-        map_chain[userId] = memory_chain
-
-        checkpointer = MemorySaver()
-        memorystore = InMemoryStore()
+    session.userId = uuid.uuid4().hex
+    logger.info(f"userId: {session.userId}")
 
-        checkpointers[userId] = checkpointer
-        memorystores[userId] = memorystore
-
-initiate()
+    session.memory_chain = ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=5)
+    register_user(session.userId, session.memory_chain)
 
 config = utils.load_config()
 print(f"config: {config}")
@@ -202,72 +171,160 @@ MSG_LENGTH = 100
 
 doc_prefix = s3_prefix+'/'
 
-model_name = "Claude 3.5 Sonnet"
-model_type = "claude"
-models = info.get_model_info(model_name)
-number_of_models = len(models)
-model_id = models[0]["model_id"]
-debug_mode = "Enable"
-multi_region = "Disable"
-
 client = boto3.client(
     service_name='bedrock-agent',
     region_name=bedrock_region
 )  
 
-mcp_json = ""
-reasoning_mode = 'Disable'
-grading_mode = 'Disable'
-def update(modelName, debugMode, multiRegion, mcp, reasoningMode, gradingMode):    
-    global model_name, model_id, model_type, debug_mode, multi_region, reasoning_mode, grading_mode
-    global models, mcp_json
+####################### Session Memory #######################
+# The checkpointer and the store are shared by all sessions and
+# the graphs are compiled once with them. The histories of the
+# sessions are separated by the thread_id, which is the userId.
+# The memory of a user is released when the user is idle for
+# session_ttl seconds or is the oldest above max_sessions.
+##############################################################
+session_ttl = config["session_ttl"] if "session_ttl" in config else 3600   # seconds
+max_sessions = config["max_sessions"] if "max_sessions" in config else 100
 
-    # load mcp.env    
-    mcp_env = utils.load_mcp_env()
-    
-    if model_name != modelName:
-        model_name = modelName
-        logger.info(f"model_name: {model_name}")
+checkpointer = MemorySaver()
+memorystore = InMemoryStore()
+
+map_chain = OrderedDict()   # userId -> memory chain
+last_used = OrderedDict()   # userId -> time of the last request, the oldest first
+memory_lock = threading.Lock()
+
+def register_user(userId, memory_chain):
+    with memory_lock:
+        map_chain[userId] = memory_chain
+    touch_user(userId)
+
+def touch_user(userId):
+    """Record a request of the user and release the memory of the idle users."""
+    now = time.time()
+    with memory_lock:
+        last_used[userId] = now
+        last_used.move_to_end(userId)
+
+        expired = []
+        for user, used_at in last_used.items():
+            if now - used_at > session_ttl or len(last_used) - len(expired) > max_sessions:
+                expired.append(user)
+            else:
+                break
+
+    for user in expired:
+        release_user(user)
+
+def release_user(userId):
+    with memory_lock:
+        map_chain.pop(userId, None)
+        last_used.pop(userId, None)
+
+    try:
+        checkpointer.delete_thread(userId)
+        logger.info(f"memory released: {userId}")
+    except Exception:
+        err_msg = traceback.format_exc()
+        logger.info(f"error message: {err_msg}")
+
+####################### Session #######################
+# The model, modes, memory and the results of a request
+# belong to the user session. They are kept in the active
+# request context (see request_context) and are read by
+# the other modules as chat.<name>, e.g. chat.debug_mode.
+#######################################################
+def get_session_defaults():
+    """Initial values of a new session."""
+    userId = uuid.uuid4().hex
+    logger.info(f"userId: {userId}")
+
+    memory_chain = ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=5)
+    register_user(userId, memory_chain)
+
+    model_name = "Claude 3.5 Sonnet"
+    models = info.get_model_info(model_name)
+    return {
+        "userId": userId,
+        "memory_chain": memory_chain,
+        "model_name": model_name,
+        "model_type": "claude",
+        "models": models,
+        "model_id": models[0]["model_id"],
+        "selected_chat": 0,
+        "debug_mode": "Enable",
+        "multi_region": "Disable",
+        "reasoning_mode": "Disable",
+        "grading_mode": "Disable",
+        "mcp_json": "",
+        "mcp_lazy_mode": "Disable",
+        "debug_messages": [],   # List to store debug messages
+        "reference_docs": [],
+        "contentList": [],
+        "fileId": uuid.uuid4().hex
+    }
+
+session = request_context.SessionState("chat", get_session_defaults)
+
+def __getattr__(name):
+    # the session values of the active request, e.g. chat.debug_mode
+    if name in session:
+        return getattr(session, name)
+    raise AttributeError(f"module 'chat' has no attribute '{name}'")
+def update(modelName, debugMode, multiRegion, mcp, reasoningMode, gradingMode, lazyMode):    
+
+    touch_user(session.userId)
+
+    if session.model_name != modelName:
+        session.model_name = modelName
+        logger.info(f"model_name: {session.model_name}")
         
-        models = info.get_model_info(model_name)
-        model_id = models[0]["model_id"]
-        model_type = models[0]["model_type"]
+        session.models = info.get_model_info(session.model_name)
+        session.model_id = session.models[0]["model_id"]
+        session.model_type = session.models[0]["model_type"]
                                 
-    if debug_mode != debugMode:
-        debug_mode = debugMode
-        logger.info(f"debug_mode: {debug_mode}")
-        
-    mcp_json = mcp
-    logger.info(f"mcp_json: {mcp_json}")
-
-    if reasoning_mode != reasoningMode:
-        reasoning_mode = reasoningMode
-        logger.info(f"reasoning_mode: {reasoning_mode}")    
-
-    if multi_region != multiRegion:
-        multi_region = multiRegion
-        logger.info(f"multi_region: {multi_region}")
-        mcp_env['multi_region'] = multi_region
-
-    if grading_mode != gradingMode:
-        grading_mode = gradingMode
-        logger.info(f"grading_mode: {grading_mode}")            
-        mcp_env['grading_mode'] = grading_mode
+    if session.debug_mode != debugMode:
+        session.debug_mode = debugMode
+        logger.info(f"debug_mode: {session.debug_mode}")
         
-    # update mcp.env    
-    utils.save_mcp_env(mcp_env)
-    logger.info(f"mcp.env updated: {mcp_env}")
+    session.mcp_json = mcp
+    logger.info(f"mcp_json: {session.mcp_json}")
+
+    if session.reasoning_mode != reasoningMode:
+        session.reasoning_mode = reasoningMode
+        logger.info(f"reasoning_mode: {session.reasoning_mode}")    
+
+    if session.multi_region != multiRegion:
+        session.multi_region = multiRegion
+        logger.info(f"multi_region: {session.multi_region}")
+
+    if session.grading_mode != gradingMode:
+        session.grading_mode = gradingMode
+        logger.info(f"grading_mode: {session.grading_mode}")            
+
+    if session.mcp_lazy_mode != lazyMode:
+        session.mcp_lazy_mode = lazyMode
+        logger.info(f"mcp_lazy_mode: {session.mcp_lazy_mode}")
+
+def get_session_arguments():
+    """
+    Modes of the session which are given to the MCP tools as their arguments (see mcp_pool.session_arguments).
+    The MCP servers are shared by the sessions, so the modes are not written to mcp.env.
+    """
+    return {
+        "grading_mode": session.grading_mode,
+        "multi_region": session.multi_region
+    }
 
 def clear_chat_history():
     memory_chain = []
-    map_chain[userId] = memory_chain
+    map_chain[session.userId] = memory_chain
 
 def save_chat_history(text, msg):
-    memory_chain.chat_memory.add_user_message(text)
+    session.memory_chain.chat_memory.add_user_message(text)
     if len(msg) > MSG_LENGTH:
-        memory_chain.chat_memory.add_ai_message(msg[:MSG_LENGTH])                          
+        session.memory_chain.chat_memory.add_ai_message(msg[:MSG_LENGTH])                          
     else:
-        memory_chain.chat_memory.add_ai_message(msg) 
+        session.memory_chain.chat_memory.add_ai_message(msg) 
 
 def create_object(key, body):
     """
@@ -335,42 +392,127 @@ def updata_object(key, body, direction):
         logger.error(f"Error updating object in S3: {str(e)}")
         raise e
 
-selected_chat = 0
+####################### Bedrock #######################
+# Chat model factory
+# boto3 clients and chat models are shared by all callers to avoid
+# client construction and TLS handshakes on every request.
+#######################################################
+max_pool_connections = config["max_pool_connections"] if "max_pool_connections" in config else 50
+default_max_attempts = 30
+# In multi-region mode, a throttled request gives up its region after a few attempts 
+# and the same call is sent to the next region (see failover_chat.py).
+multi_region_max_attempts = config["multi_region_max_attempts"] if "multi_region_max_attempts" in config else 4
+# In multi-region mode, a request is sent to a second region too if the first token 
+# of the selected region is later than its usual delay (see hedged_chat.py).
+hedge_mode = config["hedge_mode"] if "hedge_mode" in config else "Disable"
+
+# shared budget of all Bedrock callers per region and model (0: unlimited)
+rate_limiter.configure(
+    rpm=config["bedrock_rpm"] if "bedrock_rpm" in config else 0,
+    tpm=config["bedrock_tpm"] if "bedrock_tpm" in config else 0,
+    path=config["rate_limit_shared_path"] if "rate_limit_shared_path" in config else None
+)
+
+bedrock_clients = dict()  # (region, max_attempts) -> bedrock-runtime client
+chat_models = dict()      # (region, model_id, parameters, max_attempts) -> ChatBedrock
+hedged_chat_models = dict()   # (region, model_id, secondary region, secondary model_id, parameters, max_attempts) -> HedgedChatModel
+failover_chat_models = dict() # ((region, model_id), ..., parameters, max_attempts) -> FailoverChatModel
+chat_model_lock = threading.RLock()
+
+def get_max_attempts():
+    return multi_region_max_attempts if session.multi_region == 'Enable' else default_max_attempts
+
+def get_bedrock_client(bedrock_region):
+    max_attempts = get_max_attempts()
+    key = (bedrock_region, max_attempts)
+
+    with chat_model_lock:
+        if key not in bedrock_clients:
+            logger.info(f"create bedrock-runtime client: {bedrock_region} (max_attempts: {max_attempts})")
+            bedrock_client = boto3.client(
+                service_name='bedrock-runtime',
+                region_name=bedrock_region,
+                config=Config(
+                    retries = {
+                        'max_attempts': max_attempts
+                    },
+                    max_pool_connections=max_pool_connections
+                )
+            )
+            rate_limiter.register_client(bedrock_client, bedrock_region)
+            region_scheduler.register_client(bedrock_client, bedrock_region)
+            bedrock_clients[key] = bedrock_client
+        return bedrock_clients[key]
+
+def get_chat_model(bedrock_region, modelId, parameters):
+    key = (bedrock_region, modelId, json.dumps(parameters, sort_keys=True), get_max_attempts())
+
+    with chat_model_lock:
+        if key not in chat_models:
+            chat_models[key] = ChatBedrock(   # new chat model
+                model_id=modelId,
+                client=get_bedrock_client(bedrock_region), 
+                model_kwargs=parameters,
+                region_name=bedrock_region
+            )
+        return chat_models[key]
+
+def get_hedged_chat_model(bedrock_region, modelId, secondary_region, secondary_modelId, parameters):
+    key = (bedrock_region, modelId, secondary_region, secondary_modelId, json.dumps(parameters, sort_keys=True), get_max_attempts())
+
+    with chat_model_lock:
+        if key not in hedged_chat_models:
+            hedged_chat_models[key] = hedged_chat.HedgedChatModel(
+                models=[
+                    {"bedrock_region": bedrock_region, "model": get_chat_model(bedrock_region, modelId, parameters)},
+                    {"bedrock_region": secondary_region, "model": get_chat_model(secondary_region, secondary_modelId, parameters)}
+                ],
+                model_id=modelId
+            )
+        return hedged_chat_models[key]
+
+def get_failover_chat_model(profiles, parameters):
+    key = tuple((profile['bedrock_region'], profile['model_id']) for profile in profiles) + (json.dumps(parameters, sort_keys=True), get_max_attempts())
+
+    with chat_model_lock:
+        if key not in failover_chat_models:
+            failover_chat_models[key] = failover_chat.FailoverChatModel(
+                models=[{
+                    "bedrock_region": profile['bedrock_region'], 
+                    "model": get_chat_model(profile['bedrock_region'], profile['model_id'], parameters)
+                } for profile in profiles],
+                model_id=profiles[0]['model_id']
+            )
+        return failover_chat_models[key]
+
 def get_chat(extended_thinking):
-    global selected_chat, model_type
 
-    logger.info(f"models: {models}")
-    logger.info(f"selected_chat: {selected_chat}")
+    if session.multi_region=='Enable':
+        session.selected_chat = region_scheduler.select(session.models)
+    else:
+        session.selected_chat = 0
+
+    logger.info(f"models: {session.models}")
+    logger.info(f"selected_chat: {session.selected_chat}")
     
-    profile = models[selected_chat]
+    profile = session.models[session.selected_chat]
     # print('profile: ', profile)
         
     bedrock_region =  profile['bedrock_region']
     modelId = profile['model_id']
-    model_type = profile['model_type']
-    if model_type == 'claude':
+    session.model_type = profile['model_type']
+    if session.model_type == 'claude':
         maxOutputTokens = 4096 # 4k
     else:
         maxOutputTokens = 5120 # 5k
-    number_of_models = len(models)
 
-    logger.info(f"LLM: {selected_chat}, bedrock_region: {bedrock_region}, modelId: {modelId}, model_type: {model_type}")
+    logger.info(f"LLM: {session.selected_chat}, bedrock_region: {bedrock_region}, modelId: {modelId}, model_type: {session.model_type}")
 
     if profile['model_type'] == 'nova':
         STOP_SEQUENCE = '"\n\n<thinking>", "\n<thinking>", " <thinking>"'
     elif profile['model_type'] == 'claude':
         STOP_SEQUENCE = "\n\nHuman:" 
                           
-    # bedrock   
-    boto3_bedrock = boto3.client(
-        service_name='bedrock-runtime',
-        region_name=bedrock_region,
-        config=Config(
-            retries = {
-                'max_attempts': 30
-            }
-        )
-    )
     if extended_thinking=='Enable':
         maxReasoningOutputTokens=64000
         logger.info(f"extended_thinking: {extended_thinking}")
@@ -394,22 +536,54 @@ def get_chat(extended_thinking):
             "stop_sequences": [STOP_SEQUENCE]
         }
 
-    chat = ChatBedrock(   # new chat model
-        model_id=modelId,
-        client=boto3_bedrock, 
-        model_kwargs=parameters,
-        region_name=bedrock_region
-    )    
-    
-    if multi_region=='Enable':
-        selected_chat = selected_chat + 1
-        if selected_chat == number_of_models:
-            selected_chat = 0
-    else:
-        selected_chat = 0
+    chat = get_chat_model(bedrock_region, modelId, parameters)
+
+    if hedge_mode == 'Enable' and session.multi_region == 'Enable':
+        secondary = region_scheduler.select_secondary(session.models, session.selected_chat)
+        if secondary is not None:
+            secondary_profile = session.models[secondary]
+            logger.info(f"hedge: {bedrock_region} -> {secondary_profile['bedrock_region']}")
+            chat = get_hedged_chat_model(bedrock_region, modelId, secondary_profile['bedrock_region'], secondary_profile['model_id'], parameters)
+    elif session.multi_region == 'Enable':
+        fallbacks = region_scheduler.select_fallbacks(session.models, session.selected_chat)
+        if fallbacks:
+            chat = get_failover_chat_model([profile] + [session.models[i] for i in fallbacks], parameters)
 
     return chat
 
+prompt_cache_mode = config["prompt_cache"] if "prompt_cache" in config else "Enable"
+
+def get_system_message(system, model_id):
+    """
+    System message with a cache checkpoint for the models which support prompt caching.
+    Tool definitions are placed before the system prompt, so the checkpoint caches both of them.
+    """
+    if prompt_cache_mode == "Enable" and info.is_prompt_cache_supported(model_id):
+        return SystemMessage(content=[
+            {
+                "type": "text", 
+                "text": system, 
+                "cache_control": {"type": "ephemeral"}
+            }
+        ])
+    return SystemMessage(content=system)
+
+def get_cache_usage(response):
+    """Return (cache read tokens, cache write tokens, input tokens) of a response."""
+    usage_metadata = getattr(response, "usage_metadata", None) or {}
+    details = usage_metadata.get("input_token_details", {}) or {}
+    cache_read = details.get("cache_read", 0) or 0
+    cache_write = details.get("cache_creation", 0) or 0
+
+    usage = (getattr(response, "response_metadata", None) or {}).get("usage", {}) or {}
+    if not cache_read:
+        cache_read = usage.get("cache_read_input_tokens", 0) or 0
+    if not cache_write:
+        cache_write = usage.get("cache_creation_input_tokens", 0) or 0
+
+    input_tokens = usage_metadata.get("input_tokens", 0) or usage.get("input_tokens", 0) or 0
+    return cache_read, cache_write, input_tokens
+
 def print_doc(i, doc):
     if len(doc.page_content)>=100:
         text = doc.page_content[:100]
@@ -419,7 +593,7 @@ def print_doc(i, doc):
     logger.info(f"{i}: {text}, metadata:{doc.metadata}")
 
 def translate_text(text):
-    chat = get_chat(extended_thinking=reasoning_mode)
+    chat = get_chat(extended_thinking=session.reasoning_mode)
 
     system = (
         "You are a helpful assistant that translates {input_language} to {output_language} in <article> tags. Put it in <result> tags."
@@ -455,7 +629,7 @@ def translate_text(text):
     return msg[msg.find('<result>')+8:len(msg)-9] # remove <result> tag
     
 def check_grammer(text):
-    chat = get_chat(extended_thinking=reasoning_mode)
+    chat = get_chat(extended_thinking=session.reasoning_mode)
 
     if isKorean(text)==True:
         system = (
@@ -488,7 +662,6 @@ def check_grammer(text):
     
     return msg
 
-reference_docs = []
 # api key to get weather information in agent
 secretsmanager = boto3.client(
     service_name='secretsmanager',
@@ -679,7 +852,7 @@ def extract_thinking_tag(response, st):
         status = response[response.find('<thinking>')+10:response.find('</thinking>')]
         logger.info(f"gent_thinking: {status}")
         
-        if debug_mode=="Enable":
+        if session.debug_mode=="Enable":
             st.info(status)
 
         if response.find('<thinking>') == 0:
@@ -692,30 +865,33 @@ def extract_thinking_tag(response, st):
 
     return msg
 
+def get_chunk_text(chunk):
+    """Return the text of a streamed message chunk whose content is a string or a list of content blocks."""
+    content = chunk.content
+    if isinstance(content, str):
+        return content
+
+    text = ""
+    for block in content:
+        if isinstance(block, str):
+            text += block
+        elif isinstance(block, dict) and block.get("type") == "text":
+            text += block.get("text", "")
+    return text
+
 def get_parallel_processing_chat(models, selected):
-    global model_type
     profile = models[selected]
     bedrock_region =  profile['bedrock_region']
     modelId = profile['model_id']
-    model_type = profile['model_type']
+    session.model_type = profile['model_type']
     maxOutputTokens = 4096
-    logger.info(f'selected_chat: {selected}, bedrock_region: {bedrock_region}, modelId: {modelId}, model_type: {model_type}')
+    logger.info(f'selected_chat: {selected}, bedrock_region: {bedrock_region}, modelId: {modelId}, model_type: {session.model_type}')
 
     if profile['model_type'] == 'nova':
         STOP_SEQUENCE = '"\n\n<thinking>", "\n<thinking>", " <thinking>"'
     elif profile['model_type'] == 'claude':
         STOP_SEQUENCE = "\n\nHuman:" 
                           
-    # bedrock   
-    boto3_bedrock = boto3.client(
-        service_name='bedrock-runtime',
-        region_name=bedrock_region,
-        config=Config(
-            retries = {
-                'max_attempts': 30
-            }
-        )
-    )
     parameters = {
         "max_tokens":maxOutputTokens,     
         "temperature":0.1,
@@ -725,11 +901,11 @@ def get_parallel_processing_chat(models, selected):
     }
     # print('parameters: ', parameters)
 
-    chat = ChatBedrock(   # new chat model
-        model_id=modelId,
-        client=boto3_bedrock, 
-        model_kwargs=parameters,
-    )        
+    fallbacks = region_scheduler.select_fallbacks(models, selected)
+    if fallbacks:
+        return get_failover_chat_model([profile] + [models[i] for i in fallbacks], parameters)
+
+    chat = get_chat_model(bedrock_region, modelId, parameters)
     return chat
 
 def print_doc(i, doc):
@@ -740,54 +916,135 @@ def print_doc(i, doc):
             
     logger.info(f"{i}: {text}, metadata:{doc.metadata}")
 
-def grade_document_based_on_relevance(conn, question, doc, models, selected):     
-    chat = get_parallel_processing_chat(models, selected)
-    retrieval_grader = get_retrieval_grader(chat)
-    score = retrieval_grader.invoke({"question": question, "document": doc.page_content})
+# number of documents which are graded at the same time
+grading_concurrency = config["grading_concurrency"] if "grading_concurrency" in config else 8
+# stop grading when this number of relevant documents are found (0: grade all documents)
+min_relevant_docs = config["min_relevant_docs"] if "min_relevant_docs" in config else 0
+# number of documents which are graded by a single request (0 or 1: one request per document)
+grading_batch_size = config["grading_batch_size"] if "grading_batch_size" in config else 10
+
+# grades of (question, document, model), kept in sqlite as well if grade_cache_path is set
+grade_cache = GradeCache(
+    maxsize=config["grade_cache_size"] if "grade_cache_size" in config else 10000,
+    ttl=config["grade_cache_ttl"] if "grade_cache_ttl" in config else 86400,
+    path=config["grade_cache_path"] if "grade_cache_path" in config else None
+)
+
+def run_async(coro):
+    """Run a coroutine from sync code even if the caller is already in a running event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(request_context.copy_context().run, asyncio.run, coro).result()   # the thread runs in the request context
+
+async def grade_document_based_on_relevance(retrieval_grader, question, doc, semaphore):
+    async with semaphore:
+        score = await retrieval_grader.ainvoke({"question": question, "document": doc.page_content})
     # print(f"score: {score}")
-    
-    grade = score.binary_score    
-    if grade == 'yes':
+
+    if score.binary_score.lower() == "yes":
         logger.info(f"---GRADE: DOCUMENT RELEVANT---")
-        conn.send(doc)
+        return True
     else:  # no
-        logger.info(f"--GRADE: DOCUMENT NOT RELEVANT---")
-        conn.send(None)
-    
-    conn.close()
+        logger.info(f"---GRADE: DOCUMENT NOT RELEVANT---")
+        return False
 
-def grade_documents_using_parallel_processing(question, documents):
-    global selected_chat
-    
-    filtered_docs = []    
+async def grade_batch_based_on_relevance(batch_grader, retrieval_grader, question, documents, indexes, semaphore):
+    """
+    Grade documents[indexes] in a single request. Documents without a verdict are graded one by one.
+    Return the verdicts as {index: True if relevant}.
+    """
+    verdicts = dict()
+    if batch_grader is not None:
+        try:
+            async with semaphore:
+                result = await batch_grader.ainvoke({"question": question, "documents": format_documents_for_grading(documents, indexes)})
+            for grade in result.grades:
+                if grade.index in indexes:
+                    verdicts[grade.index] = grade.binary_score.lower() == "yes"
+        except Exception:
+            err_msg = traceback.format_exc()
+            logger.info(f"error message: {err_msg}")
 
-    processes = []
-    parent_connections = []
-    
+        missing = [i for i in indexes if i not in verdicts]
+        if missing:
+            logger.info(f"no verdict in the batch, grade documents {missing} one by one")
+    else:
+        missing = indexes
+
+    results = await asyncio.gather(
+        *[grade_document_based_on_relevance(retrieval_grader, question, documents[i], semaphore) for i in missing],
+        return_exceptions=True
+    )
+    for i, result in zip(missing, results):
+        if isinstance(result, Exception):
+            logger.info(f"error message: {result}")
+            continue
+        verdicts[i] = result
+
+    relevant = [i for i in indexes if verdicts.get(i)]
+    logger.info(f"---GRADE: {len(relevant)}/{len(indexes)} DOCUMENTS RELEVANT---")
+    return verdicts
+
+async def grade_documents_concurrently(question, documents, min_relevant=0):
+    model_id = session.models[0]["model_id"]
+
+    relevant = set()
+    uncached = []
     for i, doc in enumerate(documents):
-        #print(f"grading doc[{i}]: {doc.page_content}")        
-        parent_conn, child_conn = Pipe()
-        parent_connections.append(parent_conn)
-            
-        process = Process(target=grade_document_based_on_relevance, args=(child_conn, question, doc, models, selected_chat))
-        processes.append(process)
-        
-        selected_chat = selected_chat + 1
-        if selected_chat == number_of_models:
-            selected_chat = 0
-    for process in processes:
-        process.start()
-            
-    for parent_conn in parent_connections:
-        relevant_doc = parent_conn.recv()
+        grade = grade_cache.get(question, doc.page_content, model_id)
+        if grade is None:
+            uncached.append(i)
+        elif grade:
+            relevant.add(i)
+    if len(uncached) < len(documents):
+        logger.info(f"grade cache: {len(documents)-len(uncached)} hits, {len(uncached)} misses")
+    if min_relevant and len(relevant) >= min_relevant:
+        uncached = []
+
+    batch_size = grading_batch_size if grading_batch_size > 1 else 1
+    batches = [uncached[i:i+batch_size] for i in range(0, len(uncached), batch_size)]
+
+    if session.multi_region == 'Enable':
+        selected = region_scheduler.select_many(session.models, len(batches))
+        llms = [get_parallel_processing_chat(session.models, s) for s in selected]
+    else:
+        llms = [get_chat(extended_thinking="Disable")] * len(batches) if batches else []
 
-        if relevant_doc is not None:
-            filtered_docs.append(relevant_doc)
+    semaphore = asyncio.Semaphore(grading_concurrency)
+    tasks = []
+    for llm, indexes in zip(llms, batches):
+        batch_grader = get_batch_retrieval_grader(llm) if len(indexes) > 1 else None
+        tasks.append(asyncio.create_task(
+            grade_batch_based_on_relevance(batch_grader, get_retrieval_grader(llm), question, documents, indexes, semaphore)
+        ))
 
-    for process in processes:
-        process.join()
-    
-    return filtered_docs
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    for i, grade in task.result().items():
+                        grade_cache.put(question, documents[i].page_content, model_id, grade)
+                        if grade:
+                            relevant.add(i)
+                except Exception:
+                    err_msg = traceback.format_exc()
+                    logger.info(f"error message: {err_msg}")
+
+            if min_relevant and len(relevant) >= min_relevant:
+                logger.info(f"found {len(relevant)} relevant documents, skip {len(pending)} batches")
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    # keep the order of the retrieved documents
+    return [doc for i, doc in enumerate(documents) if i in relevant]
 
 class GradeDocuments(BaseModel):
     """Binary score for relevance check on retrieved documents."""
@@ -814,6 +1071,37 @@ def get_retrieval_grader(chat):
     retrieval_grader = grade_prompt | structured_llm_grader
     return retrieval_grader
 
+class DocumentGrade(BaseModel):
+    """Binary score for relevance check on one of the retrieved documents."""
+
+    index: int = Field(description="index of the document")
+    binary_score: str = Field(description="Document is relevant to the question, 'yes' or 'no'")
+
+class GradeBatch(BaseModel):
+    """Binary scores for relevance check on a list of retrieved documents."""
+
+    grades: list[DocumentGrade] = Field(description="grade of every document in the list")
+
+def format_documents_for_grading(documents, indexes):
+    return "\n\n".join([f"<document index={i}>\n{documents[i].page_content}\n</document>" for i in indexes])
+
+def get_batch_retrieval_grader(chat):
+    system = """You are a grader assessing relevance of retrieved documents to a user question. \n 
+    Each document is given in <document index=N> tags. Grade every document independently. \n
+    If a document contains keyword(s) or semantic meaning related to the question, grade it as relevant. \n
+    Give a binary score 'yes' or 'no' with the index of each document to indicate whether the document is relevant to the question."""
+
+    grade_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", system),
+            ("human", "Retrieved documents: \n\n {documents} \n\n User question: {question}"),
+        ]
+    )
+
+    structured_llm_grader = chat.with_structured_output(GradeBatch)
+    batch_grader = grade_prompt | structured_llm_grader
+    return batch_grader
+
 def show_extended_thinking(st, result):
     # logger.info(f"result: {result}")
     if "thinking" in result.response_metadata:
@@ -825,34 +1113,11 @@ def grade_documents(question, documents):
     logger.info(f"###### grade_documents ######")
     
     logger.info(f"start grading...")
-    
-    filtered_docs = []
-    if multi_region == 'Enable':  # parallel processing        
-        filtered_docs = grade_documents_using_parallel_processing(question, documents)
+    for i, doc in enumerate(documents):
+        print_doc(i, doc)
 
-    else:
-        # Score each doc    
-        llm = get_chat(extended_thinking="Disable")
-        retrieval_grader = get_retrieval_grader(llm)
-        for i, doc in enumerate(documents):
-            # print('doc: ', doc)
-            print_doc(i, doc)
-            
-            score = retrieval_grader.invoke({"question": question, "document": doc.page_content})
-            # print("score: ", score)
-            
-            grade = score.binary_score
-            # print("grade: ", grade)
-            # Document relevant
-            if grade.lower() == "yes":
-                logger.info(f"---GRADE: DOCUMENT RELEVANT---")
-                filtered_docs.append(doc)
-            # Document not relevant
-            else:
-                logger.info(f"---GRADE: DOCUMENT NOT RELEVANT---")
-                # We do not include the document in filtered_docs
-                # We set a flag to indicate that we want to run web search
-                continue
+    filtered_docs = run_async(grade_documents_concurrently(question, documents, min_relevant_docs))
+    logger.info(f"filtered_docs: {len(filtered_docs)}/{len(documents)}")
 
     return filtered_docs
 
@@ -860,7 +1125,7 @@ def grade_documents(question, documents):
 # General Conversation
 #########################################################
 def general_conversation(query):
-    llm = get_chat(extended_thinking=reasoning_mode)
+    llm = get_chat(extended_thinking=session.reasoning_mode)
 
     system = (
         "당신의 이름은 서연이고, 질문에 대해 친절하게 답변하는 사려깊은 인공지능 도우미입니다."
@@ -876,7 +1141,7 @@ def general_conversation(query):
         ("human", human)
     ])
                 
-    history = memory_chain.load_memory_variables({})["chat_history"]
+    history = session.memory_chain.load_memory_variables({})["chat_history"]
 
     chain = prompt | llm | StrOutputParser()
     try: 
@@ -919,7 +1184,7 @@ def upload_to_s3(file_bytes, file_name):
         
         user_meta = {  # user-defined metadata
             "content_type": content_type,
-            "model_name": model_name
+            "model_name": session.model_name
         }
         
         response = s3_client.put_object(
@@ -1001,7 +1266,7 @@ def load_csv_document(s3_file_name):
     return docs
 
 def get_summary(docs):    
-    llm = get_chat(extended_thinking=reasoning_mode)
+    llm = get_chat(extended_thinking=session.reasoning_mode)
 
     text = ""
     for doc in docs:
@@ -1095,7 +1360,7 @@ def summary_of_code(code, mode):
     prompt = ChatPromptTemplate.from_messages([("system", system), ("human", human)])
     # print('prompt: ', prompt)
     
-    llm = get_chat(extended_thinking=reasoning_mode)
+    llm = get_chat(extended_thinking=session.reasoning_mode)
 
     chain = prompt | llm    
     try: 
@@ -1115,7 +1380,7 @@ def summary_of_code(code, mode):
     return summary
 
 def summary_image(img_base64, instruction):      
-    llm = get_chat(extended_thinking=reasoning_mode)
+    llm = get_chat(extended_thinking=session.reasoning_mode)
 
     if instruction:
         logger.info(f"instruction: {instruction}")
@@ -1156,7 +1421,7 @@ def summary_image(img_base64, instruction):
     return extracted_text
 
 def extract_text(img_base64):    
-    multimodal = get_chat(extended_thinking=reasoning_mode)
+    multimodal = get_chat(extended_thinking=session.reasoning_mode)
     query = "텍스트를 추출해서 markdown 포맷으로 변환하세요. <result> tag를 붙여주세요."
     
     extracted_text = ""
@@ -1195,8 +1460,6 @@ def extract_text(img_base64):
 
     return extracted_text
 
-fileId = uuid.uuid4().hex
-# print('fileId: ', fileId)
 def get_summary_of_uploaded_file(file_name, st):
     file_type = file_name[file_name.rfind('.')+1:len(file_name)]            
     logger.info(f"file_type: {file_type}")
@@ -1255,7 +1518,7 @@ def get_summary_of_uploaded_file(file_name, st):
             service_name='s3',
             region_name=bedrock_region
         )             
-        if debug_mode=="Enable":
+        if session.debug_mode=="Enable":
             status = "이미지를 가져옵니다."
             logger.info(f"status: {status}")
             st.info(status)
@@ -1284,7 +1547,7 @@ def get_summary_of_uploaded_file(file_name, st):
         img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
                
         # extract text from the image
-        if debug_mode=="Enable":
+        if session.debug_mode=="Enable":
             status = "이미지에서 텍스트를 추출합니다."
             logger.info(f"status: {status}")
             st.info(status)
@@ -1298,12 +1561,12 @@ def get_summary_of_uploaded_file(file_name, st):
         else:
             extracted_text = text
 
-        if debug_mode=="Enable":
+        if session.debug_mode=="Enable":
             logger.info(f"### 추출된 텍스트\n\n{extracted_text}")
             print('status: ', status)
             st.info(status)
     
-        if debug_mode=="Enable":
+        if session.debug_mode=="Enable":
             status = "이미지의 내용을 분석합니다."
             logger.info(f"status: {status}")
             st.info(status)
@@ -1319,8 +1582,7 @@ def get_summary_of_uploaded_file(file_name, st):
 
         msg = contents
 
-    global fileId
-    fileId = uuid.uuid4().hex
+    session.fileId = uuid.uuid4().hex
     # print('fileId: ', fileId)
 
     return msg
@@ -1335,7 +1597,7 @@ def get_image_summarization(object_name, prompt, st):
         region_name=bedrock_region
     )
 
-    if debug_mode=="Enable":
+    if session.debug_mode=="Enable":
         status = "이미지를 가져옵니다."
         logger.info(f"status: {status}")
         st.info(status)
@@ -1364,7 +1626,7 @@ def get_image_summarization(object_name, prompt, st):
     img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
 
     # extract text from the image
-    if debug_mode=="Enable":
+    if session.debug_mode=="Enable":
         status = "이미지에서 텍스트를 추출합니다."
         logger.info(f"status: {status}")
         st.info(status)
@@ -1378,12 +1640,12 @@ def get_image_summarization(object_name, prompt, st):
     else:
         extracted_text = text
     
-    if debug_mode=="Enable":
+    if session.debug_mode=="Enable":
         status = f"### 추출된 텍스트\n\n{extracted_text}"
         logger.info(f"status: {status}")
         st.info(status)
     
-    if debug_mode=="Enable":
+    if session.debug_mode=="Enable":
         status = "이미지의 내용을 분석합니다."
         logger.info(f"status: {status}")
         st.info(status)
@@ -1408,10 +1670,10 @@ def get_image_summarization(object_name, prompt, st):
 ############################################################# 
 def get_rag_prompt(text):
     # print("###### get_rag_prompt ######")
-    llm = get_chat(extended_thinking=reasoning_mode)
+    llm = get_chat(extended_thinking=session.reasoning_mode)
     # print('model_type: ', model_type)
     
-    if model_type == "nova":
+    if session.model_type == "nova":
         if isKorean(text)==True:
             system = (
                 "당신의 이름은 서연이고, 질문에 대해 친절하게 답변하는 사려깊은 인공지능 도우미입니다."
@@ -1434,7 +1696,7 @@ def get_rag_prompt(text):
             "{context}"
         ) 
         
-    elif model_type == "claude":
+    elif session.model_type == "claude":
         if isKorean(text)==True:
             system = (
                 "당신의 이름은 서연이고, 질문에 대해 친절하게 답변하는 사려깊은 인공지능 도우미입니다."
@@ -1469,39 +1731,92 @@ def get_rag_prompt(text):
 
     return rag_chain
  
-def retrieve_knowledge_base(query):
-    lambda_client = boto3.client(
-        service_name='lambda',
-        region_name=bedrock_region
-    )
+lambda_client = None
+def get_lambda_client():
+    global lambda_client
+    if lambda_client is None:
+        lambda_client = boto3.client(
+            service_name='lambda',
+            region_name=bedrock_region
+        )
+    return lambda_client
 
+def invoke_rag_lambda(payload):
     functionName = f"lambda-rag-for-{projectName}"
     logger.info(f"functionName: {functionName}")
+    payload = {**payload, 'compression': 'gzip'}
+    logger.info(f"payload: {payload}")
 
+    output = get_lambda_client().invoke(
+        FunctionName=functionName,
+        Payload=json.dumps(payload),
+    )
+    payload = json.load(output['Payload'])
+    payload['response'] = utils.decode_response(payload)
+    logger.info(f"response: {payload['response']}")
+    return payload
+
+def retrieve_knowledge_base(query):
     try:
-        payload = {
+        payload = invoke_rag_lambda({
             'function': 'search_rag',
             'knowledge_base_name': knowledge_base_name,
             'keyword': query,
             'top_k': numberOfDocs,
             'grading': "Enable",
-            'model_name': model_name,
-            'multi_region': multi_region
-        }
-        logger.info(f"payload: {payload}")
-
-        output = lambda_client.invoke(
-            FunctionName=functionName,
-            Payload=json.dumps(payload),
-        )
-        payload = json.load(output['Payload'])
-        logger.info(f"response: {payload['response']}")
+            'model_name': session.model_name,
+            'multi_region': session.multi_region
+        })
+        return payload['response']
         
     except Exception:
         err_msg = traceback.format_exc()
         logger.info(f"error message: {err_msg}")       
 
-    return payload['response']
+    return json.dumps([])
+
+def retrieve_knowledge_base_progressively(query):
+    """
+    Yield ("hits", docs) as soon as the documents are retrieved, and then ("graded", docs) with the relevant ones.
+    The grading runs in the Lambda while the caller shows the hits. The hits are used if the grading fails.
+    """
+    try:
+        payload = invoke_rag_lambda({
+            'function': 'search_rag',
+            'knowledge_base_name': knowledge_base_name,
+            'keyword': query,
+            'top_k': numberOfDocs,
+            'grading': "Disable",
+            'model_name': session.model_name,
+            'multi_region': session.multi_region
+        })
+        hits = json.loads(payload['response'])
+    except Exception:
+        err_msg = traceback.format_exc()
+        logger.info(f"error message: {err_msg}")
+        hits = []
+
+    if not hits:
+        yield "graded", hits
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        grading = executor.submit(request_context.copy_context().run, invoke_rag_lambda, {
+            'function': 'grade_documents',
+            'keyword': query,
+            'documents': hits,
+            'model_name': session.model_name,
+            'multi_region': session.multi_region
+        })
+        yield "hits", hits
+
+        try:
+            docs = json.loads(grading.result()['response'])
+        except Exception:
+            err_msg = traceback.format_exc()
+            logger.info(f"error message: {err_msg}")
+            docs = hits
+    yield "graded", docs
 
 def get_reference_docs(docs):    
     reference_docs = []
@@ -1520,20 +1835,26 @@ def get_reference_docs(docs):
     return reference_docs
 
 def run_rag_with_knowledge_base(query, st):
-    global reference_docs, contentList
-    reference_docs = []
-    contentList = []
+    session.reference_docs = []
+    session.contentList = []
 
     # retrieve
-    if debug_mode == "Enable":
+    if session.debug_mode == "Enable":
         st.info(f"RAG 검색을 수행합니다. 검색어: {query}")  
 
-    relevant_context = retrieve_knowledge_base(query)    
+    # the retrieved documents are shown while they are graded
+    status = st.empty()
+    docs = []
+    for stage, docs in retrieve_knowledge_base_progressively(query):
+        session.reference_docs = get_reference_docs(docs)
+        if stage == "hits":
+            titles = "\n".join([f"- {doc.metadata['name']}" for doc in session.reference_docs])
+            status.info(f"{len(session.reference_docs)}개의 문서를 찾았습니다. 관련성을 평가하고 있습니다.\n{titles}")
+        else:
+            status.info(f"{len(session.reference_docs)}개의 관련된 문서를 얻었습니다.")
+
+    relevant_context = json.dumps(docs, ensure_ascii=False)
     logger.info(f"relevant_context: {relevant_context}")
-    
-    # change format to document
-    reference_docs = get_reference_docs(json.loads(relevant_context))
-    st.info(f"{len(reference_docs)}개의 관련된 문서를 얻었습니다.")
 
     rag_chain = get_rag_prompt(query)
                        
@@ -1556,205 +1877,28 @@ def run_rag_with_knowledge_base(query, st):
         logger.info(f"error message: {err_msg}")                    
         raise Exception ("Not able to request to LLM")
     
-    if reference_docs:
-        logger.info(f"reference_docs: {reference_docs}")
+    if session.reference_docs:
+        logger.info(f"reference_docs: {session.reference_docs}")
         ref = "\n\n### Reference\n"
-        for i, reference in enumerate(reference_docs):
+        for i, reference in enumerate(session.reference_docs):
             ref += f"{i+1}. [{reference.metadata['name']}]({reference.metadata['url']}), {reference.page_content[:100]}...\n"    
         logger.info(f"ref: {ref}")
         msg += ref
     
-    return msg, reference_docs
+    return msg, session.reference_docs
    
 ####################### Agent #######################
 # Agent 
 #####################################################
-def create_agent(tools, historyMode):
-    tool_node = ToolNode(tools)
-
-    chatModel = get_chat(extended_thinking=reasoning_mode)
-    model = chatModel.bind_tools(tools)
-
-    class State(TypedDict):
-        messages: Annotated[list, add_messages]
-        image_url: list
-
-    def call_model(state: State, config):
-        logger.info(f"###### call_model ######")
-        logger.info(f"state: {state['messages']}")
-
-        last_message = state['messages'][-1].content
-        logger.info(f"last message: {last_message}")
-        
-        # get image_url from state
-        image_url = state['image_url'] if 'image_url' in state else []
-        if isinstance(last_message, str) and (last_message.strip().startswith('{') or last_message.strip().startswith('[')):
-            try:                 
-                tool_result = json.loads(last_message)
-                if "path" in tool_result:
-                    logger.info(f"path: {tool_result['path']}")
-
-                    path = tool_result['path']
-                    if isinstance(path, list):
-                        for p in path:
-                            logger.info(f"image: {p}")
-                            #if p.startswith('http') or p.startswith('https'):
-                            image_url.append(p)
-                    else:
-                        logger.info(f"image: {path}")
-                        #if path.startswith('http') or path.startswith('https'):
-                        image_url.append(path)
-            except json.JSONDecodeError:
-                tool_result = last_message
-        if image_url:
-            logger.info(f"image_url: {image_url}")
-
-        if isKorean(state["messages"][0].content)==True:
-            system = (
-                "당신의 이름은 서연이고, 질문에 친근한 방식으로 대답하도록 설계된 대화형 AI입니다."
-                "상황에 맞는 구체적인 세부 정보를 충분히 제공합니다."
-                "모르는 질문을 받으면 솔직히 모른다고 말합니다."
-                "한국어로 답변하세요."
-            )
-        else: 
-            system = (            
-                "You are a conversational AI designed to answer in a friendly way to a question."
-                "If you don't know the answer, just say that you don't know, don't try to make up an answer."
-            )
-
-        try:
-            prompt = ChatPromptTemplate.from_messages(
-                [
-                    ("system", system),
-                    MessagesPlaceholder(variable_name="messages"),
-                ]
-            )
-            chain = prompt | model
-                
-            response = chain.invoke(state["messages"])
-            # logger.info(f"call_model response: {response}")
-            logger.info(f"call_model: {response.content}")
-
-        except Exception:
-            response = AIMessage(content="답변을 찾지 못하였습니다.")
-
-            err_msg = traceback.format_exc()
-            logger.info(f"error message: {err_msg}")
-            # raise Exception ("Not able to request to LLM")
-
-        return {"messages": [response], "image_url": image_url}
-
-    def should_continue(state: State) -> Literal["continue", "end"]:
-        logger.info(f"###### should_continue ######")
-
-        messages = state["messages"]    
-        last_message = messages[-1]
-        
-        if isinstance(last_message, AIMessage) and last_message.tool_calls:
-            tool_name = last_message.tool_calls[-1]['name']
-            logger.info(f"--- CONTINUE: {tool_name} ---")
-
-            if debug_mode == "Enable":
-                status_messages(last_message)
-
-            return "continue"
-        else:
-            logger.info(f"--- END ---")
-            return "end"
-
-    def buildChatAgent():
-        workflow = StateGraph(State)
-
-        workflow.add_node("agent", call_model)
-        workflow.add_node("action", tool_node)
-        workflow.add_edge(START, "agent")
-        workflow.add_conditional_edges(
-            "agent",
-            should_continue,
-            {
-                "continue": "action",
-                "end": END,
-            },
-        )
-        workflow.add_edge("action", "agent")
-
-        return workflow.compile() 
-    
-    def buildChatAgentWithHistory():
-        workflow = StateGraph(State)
-
-        workflow.add_node("agent", call_model)
-        workflow.add_node("action", tool_node)
-        workflow.add_edge(START, "agent")
-        workflow.add_conditional_edges(
-            "agent",
-            should_continue,
-            {
-                "continue": "action",
-                "end": END,
-            },
-        )
-        workflow.add_edge("action", "agent")
-    
-        return workflow.compile(
-            checkpointer=checkpointer,
-            store=memorystore
-        )
-    
-    # workflow 
-    if historyMode == "Enable":
-        app = buildChatAgentWithHistory()
-        config = {
-            "recursion_limit": 50,
-            "configurable": {"thread_id": userId}
-        }
-    else:
-        app = buildChatAgent()
-        config = {
-            "recursion_limit": 50
-        }
-
-    return app, config
-
 # server_params = StdioServerParameters(
 #   command="python",
 #   args=["application/mcp-server.py"],
 # )
 
-def load_mcp_server_parameters():
-    logger.info(f"mcp_json: {mcp_json}")
-
-    mcpServers = mcp_json.get("mcpServers")
-    logger.info(f"mcpServers: {mcpServers}")
-
-    command = ""
-    args = []
-    if mcpServers is not None:
-        for server in mcpServers:
-            logger.info(f"server: {server}")
-
-            config = mcpServers.get(server)
-            logger.info(f"config: {config}")
-
-            if "command" in config:
-                command = config["command"]
-            if "args" in config:
-                args = config["args"]
-            if "env" in config:
-                env = config["env"]
-
-            break
-
-    return StdioServerParameters(
-        command=command,
-        args=args,
-        env=env
-    )
-
 def load_multiple_mcp_server_parameters():
-    logger.info(f"mcp_json: {mcp_json}")
+    logger.info(f"mcp_json: {session.mcp_json}")
 
-    mcpServers = mcp_json.get("mcpServers")
+    mcpServers = session.mcp_json.get("mcpServers")
     logger.info(f"mcpServers: {mcpServers}")
   
     server_info = {}
@@ -1803,251 +1947,60 @@ def tool_info(tools, st):
     # st.info(f"{tool_info}")
     st.info(f"Tools: {tool_list}")
 
-def extract_reference(response):
-    references = []
-    for i, re in enumerate(response):
-        logger.info(f"message[{i}]: {re}")
-
-        if i==len(response)-1:
-            break
-
-        if isinstance(re, ToolMessage):            
-            try: 
-                # tavily
-                if isinstance(re.content, str) and "Title:" in re.content and "URL:" in re.content and "Content:" in re.content:
-                    logger.info("Tavily parsing...")                    
-                    items = re.content.split("\n\n")
-                    for i, item in enumerate(items):
-                        logger.info(f"item[{i}]: {item}")
-                        if "Title:" in item and "URL:" in item and "Content:" in item:
-                            try:
-                                # 정규식 대신 문자열 분할 방법 사용
-                                title_part = item.split("Title:")[1].split("URL:")[0].strip()
-                                url_part = item.split("URL:")[1].split("Content:")[0].strip()
-                                content_part = item.split("Content:")[1].strip()
-                                
-                                logger.info(f"title_part: {title_part}")
-                                logger.info(f"url_part: {url_part}")
-                                logger.info(f"content_part: {content_part}")
-                                
-                                references.append({
-                                    "url": url_part,
-                                    "title": title_part,
-                                    "content": content_part[:100] + "..." if len(content_part) > 100 else content_part
-                                })
-                            except Exception as e:
-                                logger.info(f"파싱 오류: {str(e)}")
-                                continue
-                
-                # check json format
-                if isinstance(re.content, str) and (re.content.strip().startswith('{') or re.content.strip().startswith('[')):
-                    tool_result = json.loads(re.content)
-                    logger.info(f"tool_result: {tool_result}")
-                else:
-                    tool_result = re.content
-                    logger.info(f"tool_result (not JSON): {tool_result}")
-
-                # ArXiv
-                if "papers" in tool_result:
-                    logger.info(f"size of papers: {len(tool_result['papers'])}")
-
-                    papers = tool_result['papers']
-                    for paper in papers:
-                        url = paper['url']
-                        title = paper['title']
-                        content = paper['abstract'][:100]
-                        logger.info(f"url: {url}, title: {title}, content: {content}")
-
-                        references.append({
-                            "url": url,
-                            "title": title,
-                            "content": content
-                        })
-                                
-                if isinstance(tool_result, list):
-                    logger.info(f"size of tool_result: {len(tool_result)}")
-                    for i, item in enumerate(tool_result):
-                        logger.info(f'item[{i}]: {item}')
-                        
-                        # RAG
-                        if "reference" in item:
-                            logger.info(f"reference: {item['reference']}")
-
-                            infos = item['reference']
-                            url = infos['url']
-                            title = infos['title']
-                            source = infos['from']
-                            logger.info(f"url: {url}, title: {title}, source: {source}")
-
-                            references.append({
-                                "url": url,
-                                "title": title,
-                                "content": item['contents'][:100]
-                            })
-
-                        # Others               
-                        if isinstance(item, str):
-                            try:
-                                item = json.loads(item)
-
-                                # AWS Document
-                                if "rank_order" in item:
-                                    references.append({
-                                        "url": item['url'],
-                                        "title": item['title'],
-                                        "content": item['context'][:100]
-                                    })
-                            except json.JSONDecodeError:
-                                logger.info(f"JSON parsing error: {item}")
-                                continue
-
-            except:
-                logger.info(f"fail to parsing..")
-                pass
-    return references
-
-async def mcp_rag_agent_multiple(query, historyMode, st):
+async def run_agent(query, historyMode, st):
     server_params = load_multiple_mcp_server_parameters()
     logger.info(f"server_params: {server_params}")
 
-    async with MultiServerMCPClient(server_params) as client:
-        ref = ""
-        with st.status("thinking...", expanded=True, state="running") as status:
-            tools = client.get_tools()
-            if debug_mode == "Enable":
-                tool_info(tools, st)
-                logger.info(f"tools: {tools}")
-
-            # react agent
-            # model = get_chat(extended_thinking="Disable")
-            # agent = create_react_agent(model, client.get_tools())
-
-            # langgraph agent
-            agent, config = create_agent(tools, historyMode)
-
-            try:
-                response = await agent.ainvoke({"messages": query}, config)
-                logger.info(f"response: {response}")
-
-                result = response["messages"][-1].content
-                # logger.info(f"result: {result}")
-
-                debug_msgs = get_debug_messages()
-                for msg in debug_msgs:
-                    logger.info(f"debug_msg: {msg}")
-                    if "image" in msg:
-                        st.image(msg["image"])
-                    elif "text" in msg:
-                        st.info(msg["text"])
-
-                image_url = response["image_url"] if "image_url" in response else []
-                logger.info(f"image_url: {image_url}")
-
-                for image in image_url:
-                    st.image(image)
-
-                if model_type == "nova":
-                    result = extract_thinking_tag(result, st) # for nova
-
-                references = extract_reference(response["messages"])                
-                if references:
-                    ref = "\n\n### Reference\n"
-                    for i, reference in enumerate(references):
-                        ref += f"{i+1}. [{reference['title']}]({reference['url']}), {reference['content']}...\n"    
-                    logger.info(f"ref: {ref}")
-                    result += ref
-
-                st.markdown(result)
-
-                st.session_state.messages.append({
-                    "role": "assistant", 
-                    "content": result,
-                    "images": image_url if image_url else []
-                })
-
-                return result
-            except Exception as e:
-                logger.error(f"Error during agent invocation: {str(e)}")
-                raise Exception(f"Agent invocation failed: {str(e)}")
-
-async def mcp_rag_agent_single(query, historyMode, st):
-    server_params = load_mcp_server_parameters()
-    logger.info(f"server_params: {server_params}")
-
-    async with stdio_client(server_params) as (read, write):
-        # Open an MCP session to interact with the math_server.py tool.
-        async with ClientSession(read, write) as session:
-            # Initialize the session.
-            await session.initialize()
+    tools = await mcp_pool.get_tools(server_params, lazy=session.mcp_lazy_mode=='Enable')
 
-            logger.info(f"query: {query}")
-            
-            # Load tools
-            tools = await load_mcp_tools(session)
+    with st.status("thinking...", expanded=True, state="running") as status:
+        if session.debug_mode == "Enable":
+            tool_info(tools, st)
             logger.info(f"tools: {tools}")
 
-            with st.status("thinking...", expanded=True, state="running") as status:       
-                if debug_mode == "Enable":
-                    tool_info(tools, st)
+        containers = {
+            "status": st.empty(),
+            "notification": [st.empty() for _ in range(100)],
+            "message": st.empty()
+        }
+                    
+        result, image_url = await agent.run(query, tools, containers, historyMode)            
 
-                agent = create_agent(tools, historyMode)
-                
-                # Run the agent.            
-                agent_response = await agent.ainvoke({"messages": query})                
-                logger.info(f"agent_response: {agent_response}")
-
-                if debug_mode == "Enable":
-                    for i, re in enumerate(agent_response["messages"]):
-                        if i==0 or i==len(agent_response["messages"])-1:
-                            continue
-                        
-                        if isinstance(re, AIMessage):
-                            if re.content:
-                                st.info(f"Agent: {re.content}")
-                            if re.tool_calls:
-                                for tool_call in re.tool_calls:
-                                    st.info(f"Agent: {tool_call['name']}, {tool_call['args']}")
-                        # elif isinstance(re, ToolMessage):
-                        #     st.info(f"Tool: {re.content}")
-                
-                result = agent_response["messages"][-1].content
-                logger.info(f"result: {result}")
+    if agent.response_msg:
+        with st.expander(f"수행 결과"):
+            response_msg = '\n\n'.join(agent.response_msg)
+            st.markdown(response_msg)
 
-            # st.info(f"Agent: {result}")
+    logger.info(f"result: {result}")       
+    logger.info(f"image_url: {image_url}")
 
-            st.markdown(result)
-            st.session_state.messages.append({
-                "role": "assistant", 
-                "content": result
-            })
-            
-            return result
+    return result, image_url
 
-async def run_agent(query, historyMode, st):
+async def run_plan_agent(query, st):
     server_params = load_multiple_mcp_server_parameters()
     logger.info(f"server_params: {server_params}")
 
-    async with MultiServerMCPClient(server_params) as client:
-        with st.status("thinking...", expanded=True, state="running") as status:
-            tools = client.get_tools()
+    tools = await mcp_pool.get_tools(server_params, lazy=session.mcp_lazy_mode=='Enable')
 
-            if debug_mode == "Enable":
-                tool_info(tools, st)
-                logger.info(f"tools: {tools}")
+    with st.status("planning...", expanded=True, state="running") as status:
+        if session.debug_mode == "Enable":
+            tool_info(tools, st)
+            logger.info(f"tools: {tools}")
 
-            containers = {
-                "status": st.empty(),
-                "notification": [st.empty() for _ in range(100)]
-            }
-                        
-            result, image_url = await agent.run(query, tools, containers, historyMode)            
+        containers = {
+            "status": st.empty(),
+            "notification": [st.empty() for _ in range(100)],
+            "message": st.empty()
+        }
 
-        if agent.response_msg:
-            with st.expander(f"수행 결과"):
-                response_msg = '\n\n'.join(agent.response_msg)
-                st.markdown(response_msg)
+        result, image_url = await plan_execute.run(query, tools, containers)
+
+    if agent.response_msg:
+        with st.expander(f"수행 결과"):
+            response_msg = '\n\n'.join(agent.response_msg)
+            st.markdown(response_msg)
+
+    logger.info(f"result: {result}")
+    logger.info(f"image_url: {image_url}")
 
-        logger.info(f"result: {result}")       
-        logger.info(f"image_url: {image_url}")
-    
     return result, image_url
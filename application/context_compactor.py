@@ -0,0 +1,132 @@
+import json
+import logging
+import sys
+import threading
+import utils
+import request_context
+
+from collections import OrderedDict
+from langchain_core.messages import ToolMessage, AIMessage
+from langchain_core.tools import tool
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("context-compactor")
+
+config = utils.load_config()
+
+####################### Context Compaction #######################
+# Before each model call, the prompt tokens are estimated and the
+# oldest tool results are replaced by short stubs until the prompt
+# fits in the budget. The original results are kept in a store so
+# that the agent can read them again with get_tool_result.
+##################################################################
+token_budget = config["context_token_budget"] if "context_token_budget" in config else 60000   # 0: disable
+keep_recent = config["context_keep_recent"] if "context_keep_recent" in config else 2           # tool results which are not compacted
+stub_length = 400             # characters kept from the head of a compacted result
+chars_per_token = 3           # conservative for mixed Korean and English text
+max_stored_results = 1000    # per session
+
+_lock = threading.Lock()
+
+# the original results belong to the session, so a reference is read only by the session which stored it
+session = request_context.SessionState("context_compactor", lambda: {
+    "tool_results": OrderedDict()   # tool_call_id -> original content
+})
+
+def is_enabled():
+    return token_budget > 0
+
+def get_text(content):
+    if isinstance(content, str):
+        return content
+    return json.dumps(content, ensure_ascii=False, default=str)
+
+def estimate_tokens(messages, system=""):
+    length = len(system)
+    for message in messages:
+        length += len(get_text(message.content))
+        if isinstance(message, AIMessage) and message.tool_calls:
+            length += len(json.dumps([tool_call["args"] for tool_call in message.tool_calls], ensure_ascii=False, default=str))
+    return length // chars_per_token
+
+def save_result(tool_call_id, content):
+    tool_results = session.tool_results
+    with _lock:
+        tool_results[tool_call_id] = content
+        tool_results.move_to_end(tool_call_id)
+        while len(tool_results) > max_stored_results:
+            tool_results.popitem(last=False)
+
+def get_stub(message):
+    text = get_text(message.content)
+    return (
+        f"{text[:stub_length]}\n"
+        f"...[compacted: {len(text)} characters. "
+        f"Call get_tool_result with reference=\"{message.tool_call_id}\" to read the full result.]"
+    )
+
+def compact(messages, system="", budget=None):
+    """
+    Return a copy of messages which fits in the token budget. The oldest tool results
+    except the last keep_recent results are replaced by stubs. The state is not changed.
+    """
+    budget = token_budget if budget is None else budget
+    if not budget:
+        return messages
+
+    tokens = estimate_tokens(messages, system)
+    if tokens <= budget:
+        return messages
+
+    tool_indexes = [i for i, message in enumerate(messages) if isinstance(message, ToolMessage)]
+    candidates = tool_indexes[:-keep_recent] if keep_recent else tool_indexes
+
+    compacted = list(messages)
+    count = 0
+    for i in candidates:
+        if tokens <= budget:
+            break
+
+        message = compacted[i]
+        text = get_text(message.content)
+        if len(text) <= stub_length * 2 or "...[compacted:" in text:
+            continue
+
+        save_result(message.tool_call_id, text)
+        stub = get_stub(message)
+        compacted[i] = ToolMessage(
+            name=message.name,
+            tool_call_id=message.tool_call_id,
+            content=stub
+        )
+        tokens -= (len(text) - len(stub)) // chars_per_token
+        count += 1
+
+    logger.info(f"compacted {count} tool results, estimated tokens: {tokens} (budget: {budget})")
+    return compacted
+
+@tool
+def get_tool_result(reference: str, offset: int = 0, length: int = 8000) -> str:
+    """
+    Read the full result of a previous tool call which was compacted in the conversation.
+    reference: the reference of the compacted tool result
+    offset: the start position in characters
+    length: the number of characters to read
+    return: the part of the original tool result
+    """
+    with _lock:
+        content = session.tool_results.get(reference)
+
+    if content is None:
+        return f"No tool result for the reference: {reference}"
+
+    part = content[offset:offset+length]
+    if offset+length < len(content):
+        part += f"\n...[{len(content)-offset-length} characters left. Use offset={offset+length} to read more.]"
+    return part
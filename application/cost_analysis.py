@@ -5,6 +5,7 @@ import pandas as pd
 import plotly.express as px
 import traceback
 import chat
+import request_context
 
 from datetime import datetime, timedelta
 from langchain_core.prompts import ChatPromptTemplate
@@ -149,11 +150,11 @@ def create_cost_visualizations(cost_data):
     return visualizations
 
 def generate_cost_insights():
-    if cost_data:
+    if session.cost_data:
         cost_data_dict = {
-            'service_costs': cost_data['service_costs'].to_dict(orient='records'),
-            'region_costs': cost_data['region_costs'].to_dict(orient='records'),
-            'daily_costs': cost_data['daily_costs'].to_dict(orient='records') if 'daily_costs' in cost_data else []
+            'service_costs': session.cost_data['service_costs'].to_dict(orient='records'),
+            'region_costs': session.cost_data['region_costs'].to_dict(orient='records'),
+            'daily_costs': session.cost_data['daily_costs'].to_dict(orient='records') if 'daily_costs' in session.cost_data else []
         }
     else:
         return "Not available"
@@ -213,20 +214,27 @@ def generate_cost_insights():
     
     return response.content
 
-cost_data = {}
-visualizations = {}
-insights = ""
+# cost analysis of the user session, e.g. cost_analysis.insights
+session = request_context.SessionState("cost_analysis", lambda: {
+    "cost_data": {},
+    "visualizations": {},
+    "insights": ""
+})
+
+def __getattr__(name):
+    if name in session:
+        return getattr(session, name)
+    raise AttributeError(f"module 'cost_analysis' has no attribute '{name}'")
 
 def get_visualiation():
-    global cost_data, visualizations
 
     try:
-        cost_data = get_cost_analysis()
-        if cost_data:
+        session.cost_data = get_cost_analysis()
+        if session.cost_data:
             logger.info(f"No cost data available")
 
             # draw visualizations        
-            visualizations = create_cost_visualizations(cost_data)
+            session.visualizations = create_cost_visualizations(session.cost_data)
 
     except Exception as e:
         logger.info(f"Error to earn cost data: {str(e)}")   
@@ -234,11 +242,11 @@ def get_visualiation():
 get_visualiation() 
 
 def ask_cost_insights(question):
-    if cost_data:
+    if session.cost_data:
         cost_data_dict = {
-            'service_costs': cost_data['service_costs'].to_dict(orient='records'),
-            'region_costs': cost_data['region_costs'].to_dict(orient='records'),
-            'daily_costs': cost_data['daily_costs'].to_dict(orient='records') if 'daily_costs' in cost_data else []
+            'service_costs': session.cost_data['service_costs'].to_dict(orient='records'),
+            'region_costs': session.cost_data['region_costs'].to_dict(orient='records'),
+            'daily_costs': session.cost_data['daily_costs'].to_dict(orient='records') if 'daily_costs' in session.cost_data else []
         }
     else:
         return "Cost 데이터를 가져오는데 실패하였습니다."
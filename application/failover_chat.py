@@ -0,0 +1,89 @@
+import logging
+import sys
+import graph_registry
+import region_scheduler
+
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream, generate_from_stream
+from langchain_core.outputs import ChatGenerationChunk
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("failover-chat")
+
+####################### Failover Chat #######################
+# botocore retries a throttled call only in its own region, so
+# the clients of the multi-region mode have a small retry budget.
+# When a region is still throttled after the retries, the same
+# call is sent to the next region which the scheduler ranked.
+# A call fails over only before its first token, so the caller
+# never receives a partial answer twice.
+##############################################################
+class FailoverChatModel(BaseChatModel):
+    models: list              # [{"bedrock_region": region, "model": chat model or bound runnable}], primary first
+    model_id: str
+
+    @property
+    def _llm_type(self):
+        return "failover-bedrock"
+
+    def get_model_key(self):
+        """Key of the wrapper for the caches of the bound models, from the keys of the inner models."""
+        return ("failover",) + tuple(graph_registry.get_model_key(item["model"]) for item in self.models)
+
+    def bind_tools(self, tools, **kwargs):
+        return FailoverChatModel(
+            models=[{
+                "bedrock_region": item["bedrock_region"],
+                "model": item["model"].bind_tools(tools, **kwargs)
+            } for item in self.models],
+            model_id=self.model_id
+        )
+
+    def can_fail_over(self, index, error):
+        if index == len(self.models) - 1 or not region_scheduler.is_throttling_error(error):
+            return False
+        logger.info(f"{self.models[index]['bedrock_region']} is throttled, fail over to {self.models[index+1]['bedrock_region']}")
+        return True
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        inner_config = {"callbacks": []}   # the tokens are streamed to the caller by this model
+        for index, item in enumerate(self.models):
+            streamed = False
+            try:
+                async for chunk in item["model"].astream(messages, inner_config, stop=stop, **kwargs):
+                    streamed = True
+                    generation = ChatGenerationChunk(message=chunk)
+                    if run_manager:
+                        await run_manager.on_llm_new_token(generation.text, chunk=generation)
+                    yield generation
+                return
+            except Exception as e:
+                if streamed or not self.can_fail_over(index, e):
+                    raise
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        inner_config = {"callbacks": []}
+        for index, item in enumerate(self.models):
+            streamed = False
+            try:
+                for chunk in item["model"].stream(messages, inner_config, stop=stop, **kwargs):
+                    streamed = True
+                    generation = ChatGenerationChunk(message=chunk)
+                    if run_manager:
+                        run_manager.on_llm_new_token(generation.text, chunk=generation)
+                    yield generation
+                return
+            except Exception as e:
+                if streamed or not self.can_fail_over(index, e):
+                    raise
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+from collections import OrderedDict
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("grade-cache")
+
+####################### Grade Cache #######################
+# Relevance grades of (question, document) pairs
+# The key is the normalized question, the hash of the document
+# and the grading model. Entries are evicted by LRU and TTL.
+# With a path, the grades are also kept in sqlite so that they
+# survive restarts and are shared by the processes of the app.
+###########################################################
+prune_interval = 100    # the sqlite table is pruned once per this number of saves
+
+def normalize_question(question):
+    question = question.lower().strip()
+    question = re.sub(r"\s+", " ", question)
+    return question.rstrip("?!. ")
+
+def get_key(question, content, model_id):
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    body = f"{model_id}\n{normalize_question(question)}\n{content_hash}"
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+class GradeCache:
+    def __init__(self, maxsize=10000, ttl=86400, path=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.items = OrderedDict()   # key -> (grade, created_at)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+
+        if self.path:
+            try:
+                with self.connect() as conn:
+                    conn.execute("CREATE TABLE IF NOT EXISTS grades (key TEXT PRIMARY KEY, grade INTEGER, created_at REAL, used_at REAL)")
+            except Exception:
+                err_msg = traceback.format_exc()
+                logger.info(f"error message: {err_msg}")
+                self.path = None
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, question, content, model_id):
+        """Return the cached grade (True: relevant, False: not relevant) or None."""
+        key = get_key(question, content, model_id)
+        now = time.time()
+
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                if now - item[1] < self.ttl:
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return item[0]
+                del self.items[key]
+
+        grade = self.load(key, now)
+        with self.lock:
+            if grade is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return grade
+
+    def put(self, question, content, model_id, grade):
+        key = get_key(question, content, model_id)
+        now = time.time()
+
+        with self.lock:
+            self.set_item(key, grade, now)
+        self.save(key, grade, now)
+
+    def set_item(self, key, grade, created_at):
+        self.items[key] = (grade, created_at)
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def load(self, key, now):
+        if not self.path:
+            return None
+        try:
+            with self.connect() as conn:
+                row = conn.execute("SELECT grade, created_at FROM grades WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                if now - row[1] >= self.ttl:
+                    conn.execute("DELETE FROM grades WHERE key = ?", (key,))
+                    return None
+                conn.execute("UPDATE grades SET used_at = ? WHERE key = ?", (now, key))
+        except Exception:
+            err_msg = traceback.format_exc()
+            logger.info(f"error message: {err_msg}")
+            return None
+
+        grade = bool(row[0])
+        with self.lock:
+            self.set_item(key, grade, row[1])
+        return grade
+
+    def save(self, key, grade, now):
+        if not self.path:
+            return
+        try:
+            with self.connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO grades (key, grade, created_at, used_at) VALUES (?, ?, ?, ?)", (key, int(grade), now, now))
+
+                self.saves += 1
+                if self.saves % prune_interval == 0:
+                    conn.execute("DELETE FROM grades WHERE created_at < ?", (now - self.ttl,))
+                    conn.execute("DELETE FROM grades WHERE key NOT IN (SELECT key FROM grades ORDER BY used_at DESC LIMIT ?)", (self.maxsize,))
+        except Exception:
+            err_msg = traceback.format_exc()
+            logger.info(f"error message: {err_msg}")
+
+    def get_status(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0,
+                "path": self.path
+            }
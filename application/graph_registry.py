@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+import sys
+import threading
+
+from collections import OrderedDict
+from langgraph.prebuilt import ToolNode
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("graph-registry")
+
+####################### Graph Registry #######################
+# Compile-once LangGraph workflows
+# A graph is compiled once per topology and reused by every
+# request. The nodes get the per-request values (tools, st,
+# containers, prompts) from config["configurable"], so the
+# same compiled graph serves any tool set.
+##############################################################
+_lock = threading.RLock()
+
+max_cache_size = 128   # entries of each LRU cache below
+
+graphs = dict()                   # (name, key) -> compiled graph
+bound_models = OrderedDict()      # (model key, tools signature) -> chat model with tools
+tool_nodes = OrderedDict()        # tools signature -> (tools, ToolNode)
+tool_signatures = OrderedDict()   # ids of the tools -> (tools, signature)
+
+def get_cached(cache, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+def put_cached(cache, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_cache_size:
+        cache.popitem(last=False)
+    return value
+
+def get_model_key(chat_model):
+    """Key of the chat model by its model id, region, parameters and retries, as the chat model factory."""
+    if hasattr(chat_model, "get_model_key"):
+        return chat_model.get_model_key()
+
+    client = getattr(chat_model, "client", None)
+    retries = getattr(getattr(getattr(client, "meta", None), "config", None), "retries", None)
+    return (
+        type(chat_model).__name__,
+        getattr(chat_model, "model_id", None),
+        getattr(chat_model, "region_name", None),
+        json.dumps(getattr(chat_model, "model_kwargs", None), sort_keys=True, default=str),
+        json.dumps(retries, sort_keys=True, default=str)
+    )
+
+def compute_tool_signature(tools):
+    items = []
+    for tool in tools or []:
+        try:
+            schema = tool.tool_call_schema.model_json_schema() if hasattr(tool.tool_call_schema, "model_json_schema") else tool.tool_call_schema.schema()
+        except Exception:
+            schema = str(getattr(tool, "args", ""))
+        items.append([tool.name, tool.description, schema])
+
+    body = json.dumps(items, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()[:16]
+
+def get_tool_signature(tools):
+    """Hash of the names, descriptions and argument schemas of the tools. It is computed once per list of tool objects."""
+    tools = list(tools or [])
+    key = tuple(id(tool) for tool in tools)
+    with _lock:
+        item = get_cached(tool_signatures, key)
+        if item is not None and all(a is b for a, b in zip(item[0], tools)):
+            return item[1]
+
+    signature = compute_tool_signature(tools)
+    with _lock:
+        put_cached(tool_signatures, key, (tools, signature))   # the tools are kept so that their ids are not reused
+    return signature
+
+def get_graph(name, builder, key=None):
+    """Return the compiled graph of name and key. builder() is called only once for them."""
+    with _lock:
+        if (name, key) not in graphs:
+            logger.info(f"compile graph: {name} ({key})")
+            graphs[(name, key)] = builder()
+        return graphs[(name, key)]
+
+def bind_tools(chat_model, tools):
+    """chat_model.bind_tools(tools) which is cached by the key of the chat model and the tool signature."""
+    key = (get_model_key(chat_model), get_tool_signature(tools))
+    with _lock:
+        model = get_cached(bound_models, key)
+        if model is None:
+            model = put_cached(bound_models, key, chat_model.bind_tools(tools))
+        return model
+
+def get_tool_node(tools):
+    """ToolNode of the tools. The node is rebuilt when the tool objects are replaced."""
+    key = get_tool_signature(tools)
+    with _lock:
+        item = get_cached(tool_nodes, key)
+        if item is None or any(a is not b for a, b in zip(item[0], tools)):
+            item = put_cached(tool_nodes, key, (list(tools), ToolNode(tools)))
+        return item[1]
+
+def tool_node(state, config):
+    """Action node which runs the tools in config["configurable"]["tools"]."""
+    tools = config.get("configurable", {}).get("tools", [])
+    return get_tool_node(tools).invoke(state, config)
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import queue
+import sys
+import threading
+import time
+import graph_registry
+import region_scheduler
+import request_context
+
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream, generate_from_stream
+from langchain_core.outputs import ChatGenerationChunk
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("hedged-chat")
+
+####################### Hedged Chat #######################
+# The request is streamed from the primary region. If its first
+# token does not arrive within the hedge delay of the region, the
+# same request is sent to a second region and the first one which
+# streams a token wins. The other stream is cancelled at once.
+# When the hedge wins, the primary is only known to be slower
+# than the time so far, which is recorded as its first token.
+# The saved latency is estimated from its earlier first tokens
+# which were slower than that, and is 0 without such samples.
+# The inner models run without the callbacks of the caller, so
+# only the tokens of the winner are streamed to the caller.
+############################################################
+class HedgedChatModel(BaseChatModel):
+    models: list              # [{"bedrock_region": region, "model": chat model or bound runnable}], primary first
+    model_id: str
+
+    @property
+    def _llm_type(self):
+        return "hedged-bedrock"
+
+    def get_model_key(self):
+        """Key of the wrapper for the caches of the bound models, from the keys of the inner models."""
+        return ("hedged",) + tuple(graph_registry.get_model_key(item["model"]) for item in self.models)
+
+    def bind_tools(self, tools, **kwargs):
+        return HedgedChatModel(
+            models=[{
+                "bedrock_region": item["bedrock_region"],
+                "model": item["model"].bind_tools(tools, **kwargs)
+            } for item in self.models],
+            model_id=self.model_id
+        )
+
+    async def race(self, messages, stop=None, **kwargs):
+        """Yield the message chunks of the region which streams the first token."""
+        primary, secondary = self.models[0], self.models[1]
+        delay = region_scheduler.get_hedge_delay(primary["bedrock_region"])
+        inner_config = {"callbacks": []}
+
+        chunks = asyncio.Queue()   # (index, chunk, error), chunk is None at the end of the stream
+        starts = dict()
+        tasks = dict()
+
+        async def consume(index, item):
+            try:
+                async for chunk in item["model"].astream(messages, inner_config, stop=stop, **kwargs):
+                    await chunks.put((index, chunk, None))
+                await chunks.put((index, None, None))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await chunks.put((index, None, e))
+
+        def start(index):
+            starts[index] = time.time()
+            tasks[index] = asyncio.create_task(consume(index, self.models[index]))
+
+        start(0)
+        winner = None
+        first_chunk = None
+        errors = []
+        try:
+            # wait for the first token of any region
+            while winner is None:
+                timeout = None if 1 in tasks else max(0, delay - (time.time() - starts[0]))
+                try:
+                    index, chunk, error = await asyncio.wait_for(chunks.get(), timeout)
+                except asyncio.TimeoutError:
+                    logger.info(f"no token from {primary['bedrock_region']} in {delay:.2f}s, hedge to {secondary['bedrock_region']}")
+                    start(1)
+                    continue
+
+                if error is not None or chunk is None:
+                    errors.append(error)
+                    logger.info(f"{self.models[index]['bedrock_region']} failed before the first token: {error}")
+                    if 1 not in tasks:
+                        start(1)   # fail over without waiting for the delay
+                    elif len(errors) == len(tasks):
+                        raise error if error is not None else RuntimeError("no answer from the regions")
+                    continue
+
+                winner = index
+                first_chunk = chunk
+
+            now = time.time()
+            first_token = now - starts[winner]
+            region_scheduler.record_first_token(self.models[winner]["bedrock_region"], first_token)
+            loser = 1 - winner
+            primary_failed = winner == 1 and tasks[0].done()
+            if loser in tasks:
+                tasks[loser].cancel()
+            logger.info(f"winner: {self.models[winner]['bedrock_region']}, first token: {first_token:.2f}s, hedged: {1 in tasks}")
+
+            if winner == 1:
+                saved = 0
+                if not primary_failed:
+                    # the primary would have answered later than now
+                    elapsed = now - starts[0]
+                    saved = region_scheduler.estimate_first_token(primary["bedrock_region"], elapsed) - elapsed
+                    region_scheduler.record_first_token(primary["bedrock_region"], elapsed)
+                region_scheduler.record_hedge(True, True, saved)
+                logger.info(f"hedge saved {saved:.2f}s, {region_scheduler.get_hedge_status()}")
+            else:
+                region_scheduler.record_hedge(1 in tasks, False)
+
+            yield first_chunk
+
+            while True:
+                index, chunk, error = await chunks.get()
+                if index != winner:
+                    continue   # queued by the cancelled region before it stopped
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async for chunk in self.race(messages, stop, **kwargs):
+            generation = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                await run_manager.on_llm_new_token(generation.text, chunk=generation)
+            yield generation
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        # the race runs in an event loop of another thread and its chunks are passed by a queue
+        results = queue.Queue()
+        done = threading.Event()
+
+        async def produce():
+            try:
+                async for chunk in self.race(messages, stop, **kwargs):
+                    results.put((chunk, None))
+                    if done.is_set():
+                        break
+            except Exception as e:
+                results.put((None, e))
+            results.put((None, None))
+
+        context = request_context.copy_context()
+        thread = threading.Thread(target=context.run, args=(asyncio.run, produce()), daemon=True)
+        thread.start()
+        try:
+            while True:
+                chunk, error = results.get()
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    break
+                generation = ChatGenerationChunk(message=chunk)
+                if run_manager:
+                    run_manager.on_llm_new_token(generation.text, chunk=generation)
+                yield generation
+        finally:
+            done.set()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
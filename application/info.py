@@ -231,3 +231,17 @@ def get_stop_sequence(model_name):
         return STOP_SEQUENCE_NOVA
     else:
         return ""
+
+# models which support prompt caching with cache_control checkpoints
+PROMPT_CACHE_MODELS = [
+    "claude-3-7-sonnet",
+    "claude-3-5-haiku",
+    "claude-3-5-sonnet-20241022-v2",
+    "claude-sonnet-4",
+    "claude-opus-4",
+    "claude-4-sonnet",
+    "claude-4-opus"
+]
+
+def is_prompt_cache_supported(model_id):
+    return any(name in model_id for name in PROMPT_CACHE_MODELS)
@@ -4,6 +4,7 @@ import logging
 import sys
 import base64
 import chat
+import request_context
 import pandas as pd
 import plotly.express as px
 import plotly.io as pio
@@ -23,7 +24,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger("mcp-cost")
 
-cost_data = {}
+# cost data of the user session. The MCP server has one process for all calls, so it uses the default context.
+session = request_context.SessionState("mcp_cost", lambda: {
+    "cost_data": {},
+    "region_cost_data": {},
+    "daily_cost_data": {}
+})
+
+def __getattr__(name):
+    if name in session:
+        return getattr(session, name)
+    raise AttributeError(f"module 'mcp_cost' has no attribute '{name}'")
 def normalize_service_name(service_name: str) -> str:
     """
     Normalize AWS service names to their official names
@@ -180,8 +191,7 @@ def get_region_cost(days: int=30, region: str="us-west-2"):
         region_costs_df = pd.DataFrame(region_costs)
         logger.info(f"Region Cost (df): {region_costs_df}")
 
-        global region_cost_data
-        region_cost_data = {
+        session.region_cost_data = {
             'region_costs': region_costs_df
         }
 
@@ -232,12 +242,11 @@ def get_daily_cost(days: int=30, region: str="us-west-2"):
         daily_costs_df = pd.DataFrame(daily_costs)
         logger.info(f"Daily Cost (df): {daily_costs_df}")
 
-        global daily_cost_data
-        daily_cost_data = {
+        session.daily_cost_data = {
             'daily_costs': daily_costs_df
         }
 
-        return daily_cost_data
+        return session.daily_cost_data
 
     except Exception as e:
         logger.info(f"Error in cost analysis: {str(e)}")
@@ -270,7 +279,7 @@ def create_service_cost_visualizations():
     
     # service cost (pie chart)
     fig_pie = px.pie(
-        cost_data['service_costs'],
+        session.cost_data['service_costs'],
         values='cost',
         names='SERVICE',
         title='Service Cost'
@@ -285,14 +294,14 @@ def create_daily_cost_visualizations():
     """Visualize daily AWS costs showing total costs and service-wise breakdown"""
     logger.info("Creating daily cost visualizations...")
 
-    if not daily_cost_data or 'daily_costs' not in daily_cost_data:
+    if not session.daily_cost_data or 'daily_costs' not in session.daily_cost_data:
         logger.info("No cost data available")
         return None        
     
     paths = []
     
     # Get daily costs DataFrame
-    daily_costs_df = daily_cost_data['daily_costs']
+    daily_costs_df = session.daily_cost_data['daily_costs']
     
     # Calculate daily total costs
     daily_totals = daily_costs_df.groupby('date')['cost'].sum().reset_index()
@@ -342,7 +351,7 @@ def create_region_cost_visualizations():
     """Cost Visualization of region AWS cost"""
     logger.info("Creating region cost visualizations...")
 
-    if not region_cost_data:
+    if not session.region_cost_data:
         logger.info("No cost data available")
         return None
         
@@ -350,7 +359,7 @@ def create_region_cost_visualizations():
     
     # region cost (bar chart)
     fig_bar = px.bar(
-        cost_data['region_costs'],
+        session.cost_data['region_costs'],
         x='REGION',
         y='cost',
         title='Region Cost'
@@ -364,11 +373,11 @@ def create_region_cost_visualizations():
     }
 
 def generate_cost_insights():
-    if cost_data:
+    if session.cost_data:
         cost_data_dict = {
-            'service_costs': cost_data['service_costs'].to_dict(orient='records'),
-            'region_costs': cost_data['region_costs'].to_dict(orient='records'),
-            'daily_costs': cost_data['daily_costs'].to_dict(orient='records') if 'daily_costs' in cost_data else []
+            'service_costs': session.cost_data['service_costs'].to_dict(orient='records'),
+            'region_costs': session.cost_data['region_costs'].to_dict(orient='records'),
+            'daily_costs': session.cost_data['daily_costs'].to_dict(orient='records') if 'daily_costs' in session.cost_data else []
         }
     else:
         return "Not available"
@@ -429,11 +438,11 @@ def generate_cost_insights():
     return response.content
 
 def ask_cost_insights(question):
-    if cost_data:
+    if session.cost_data:
         cost_data_dict = {
-            'service_costs': cost_data['service_costs'].to_dict(orient='records'),
-            'region_costs': cost_data['region_costs'].to_dict(orient='records'),
-            'daily_costs': cost_data['daily_costs'].to_dict(orient='records') if 'daily_costs' in cost_data else []
+            'service_costs': session.cost_data['service_costs'].to_dict(orient='records'),
+            'region_costs': session.cost_data['region_costs'].to_dict(orient='records'),
+            'daily_costs': session.cost_data['daily_costs'].to_dict(orient='records') if 'daily_costs' in session.cost_data else []
         }
     else:
         return "Failed to retrieve cost data."
@@ -0,0 +1,347 @@
+import asyncio
+import atexit
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import utils
+import mcp_tool_cache
+
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+from mcp.types import Tool
+from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("mcp-pool")
+
+config = utils.load_config()
+
+# seconds
+idle_timeout = config["mcp_idle_timeout"] if "mcp_idle_timeout" in config else 900
+startup_timeout = config["mcp_startup_timeout"] if "mcp_startup_timeout" in config else 120
+health_check_interval = config["mcp_health_check_interval"] if "mcp_health_check_interval" in config else 60
+health_check_timeout = 10
+eviction_interval = 60
+
+####################### MCP Server Pool #######################
+# Long-lived MCP servers shared by Streamlit reruns and sessions
+# The servers run in a dedicated event loop because the stdio
+# sessions are bound to the loop that created them while every
+# user turn runs in its own asyncio.run().
+###############################################################
+_loop = None
+_loop_lock = threading.Lock()
+
+servers = dict()   # key -> MCPServer
+
+def get_loop():
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="mcp-pool", daemon=True)
+            thread.start()
+
+            asyncio.run_coroutine_threadsafe(evict_idle_servers(), _loop)
+            logger.info(f"mcp pool loop started")
+    return _loop
+
+async def run_in_pool(coro):
+    """Run a coroutine in the pool loop and wait for the result from any other loop."""
+    loop = get_loop()
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    return await asyncio.wrap_future(future)
+
+def get_server_key(server_config):
+    return mcp_tool_cache.get_config_hash(server_config)
+
+def get_stdio_parameters(server_config):
+    normalized = mcp_tool_cache.normalize_server_config(server_config)
+
+    env = normalized["env"]
+    if "PATH" not in env:
+        env["PATH"] = os.environ.get("PATH", "")
+
+    return StdioServerParameters(
+        command=normalized["command"],
+        args=normalized["args"],
+        env=env
+    )
+
+class PooledSession:
+    """Session proxy for langchain tools which forwards tool calls to the pooled server."""
+
+    def __init__(self, key):
+        self.key = key
+
+    async def call_tool(self, name, arguments=None):
+        server = servers.get(self.key)
+        if server is None:
+            raise Exception(f"MCP server is not available in the pool: {self.key}")
+        return await run_in_pool(server.call_tool(name, arguments))
+
+# The servers are shared by the sessions, so the modes of a session are given to
+# a tool as these arguments in each call. They are hidden from the model, and 
+# tool_executor fills them with the values of config["configurable"]["session_arguments"].
+session_arguments = ["grading_mode", "multi_region"]
+
+def hide_session_arguments(mcp_tool):
+    """Return the tool without the session arguments in its input schema, and the names of the removed ones."""
+    properties = (mcp_tool.inputSchema or {}).get("properties", {})
+    arguments = [name for name in session_arguments if name in properties]
+    if not arguments:
+        return mcp_tool, []
+
+    schema = {
+        **mcp_tool.inputSchema,
+        "properties": {k: v for k, v in properties.items() if k not in arguments},
+        "required": [k for k in mcp_tool.inputSchema.get("required", []) if k not in arguments]
+    }
+    return mcp_tool.model_copy(update={"inputSchema": schema}), arguments
+
+class MCPServer:
+    def __init__(self, name, key, server_config):
+        self.name = name
+        self.key = key
+        self.server_config = server_config
+        self.session = None
+        self.task = None
+        self.ready = None
+        self.stop_event = None
+        self.lock = asyncio.Lock()
+        self.mcp_tools = []
+        self.tools = []
+        self.warmup_task = None
+        self.error = None
+        self.started_at = 0
+        self.last_used = time.time()
+        self.last_health_check = 0
+        self.restarts = 0
+
+    async def serve(self):
+        # the stdio client and session must be entered and exited in the same task
+        try:
+            async with stdio_client(get_stdio_parameters(self.server_config)) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+
+                    result = await session.list_tools()
+                    self.mcp_tools = result.tools
+                    self.session = session
+                    self.ready.set()
+
+                    await self.stop_event.wait()
+        except Exception as e:
+            self.error = str(e)
+            err_msg = traceback.format_exc()
+            logger.info(f"error message ({self.name}): {err_msg}")
+        finally:
+            self.session = None
+            self.ready.set()
+
+    async def start(self):
+        logger.info(f"start mcp server: {self.name} ({self.key})")
+        self.ready = asyncio.Event()
+        self.stop_event = asyncio.Event()
+        self.error = None
+
+        self.task = asyncio.create_task(self.serve())
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout=startup_timeout)
+        except asyncio.TimeoutError:
+            self.error = f"startup timeout ({startup_timeout}s)"
+            await self.stop()
+
+        if self.session is None:
+            raise Exception(f"Fail to start MCP server {self.name}: {self.error}")
+
+        self.started_at = self.last_health_check = time.time()
+        self.tools = self.convert_tools()
+        logger.info(f"{self.name} is ready with {len(self.tools)} tools")
+
+        mcp_tool_cache.put_tools(
+            self.server_config,
+            [tool.model_dump(mode="json", exclude_none=True) for tool in self.mcp_tools]
+        )
+
+    def convert_tools(self):
+        tools = []
+        for mcp_tool in self.mcp_tools:
+            mcp_tool, arguments = hide_session_arguments(mcp_tool)
+            tool = convert_mcp_tool_to_langchain_tool(PooledSession(self.key), mcp_tool)
+            tool.metadata = {
+                **(tool.metadata or {}), 
+                "mcp_server": self.name,            # for the timeout of the server
+                "session_arguments": arguments      # filled by tool_executor
+            }
+            tools.append(tool)
+        return tools
+
+    def load_cached_tools(self, cached_tools):
+        self.mcp_tools = [Tool.model_validate(tool) for tool in cached_tools]
+        self.tools = self.convert_tools()
+        logger.info(f"{self.name}: {len(self.tools)} tools from the tool cache")
+
+    async def warm_up(self):
+        try:
+            await self.ensure_started()
+        except Exception:
+            err_msg = traceback.format_exc()
+            logger.info(f"error message ({self.name}): {err_msg}")
+
+    async def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+        if self.task is not None:
+            try:
+                await asyncio.wait_for(self.task, timeout=10)
+            except Exception:
+                self.task.cancel()
+        self.task = None
+        self.session = None
+
+    def is_alive(self):
+        return self.task is not None and not self.task.done() and self.session is not None
+
+    async def check_health(self):
+        try:
+            await asyncio.wait_for(self.session.send_ping(), timeout=health_check_timeout)
+            self.last_health_check = time.time()
+            return True
+        except Exception as e:
+            logger.info(f"health check failed ({self.name}): {e}")
+            return False
+
+    async def ensure_started(self):
+        async with self.lock:
+            if self.is_alive():
+                if time.time() - self.last_health_check < health_check_interval:
+                    return
+                if await self.check_health():
+                    return
+
+            if self.task is not None:  # crashed or hung
+                logger.info(f"restart mcp server: {self.name}")
+                self.restarts += 1
+                await self.stop()
+
+            await self.start()
+
+    async def call_tool(self, name, arguments):
+        await self.ensure_started()
+        self.last_used = time.time()
+
+        try:
+            return await self.session.call_tool(name, arguments)
+        except Exception:
+            if self.is_alive() and await self.check_health():
+                raise
+
+            # the server was crashed while the tool is running
+            logger.info(f"retry {name} after restarting {self.name}")
+            await self.ensure_started()
+            return await self.session.call_tool(name, arguments)
+
+    def get_status(self):
+        return {
+            "name": self.name,
+            "key": self.key,
+            "alive": self.is_alive(),
+            "started": self.started_at > 0,
+            "tools": len(self.tools),
+            "restarts": self.restarts,
+            "idle": int(time.time() - self.last_used)
+        }
+
+async def acquire_server(name, server_config, lazy=False):
+    key = get_server_key(server_config)
+
+    server = servers.get(key)
+    if server is None:
+        server = MCPServer(name, key, server_config)
+        servers[key] = server
+
+    if not server.is_alive():
+        if server.warmup_task is not None and not server.warmup_task.done():
+            server.last_used = time.time()
+            return server
+
+        # bind the cached tool schemas without a tools/list round trip and start the server in background.
+        # In lazy mode, the server is started by the first call of its tools.
+        cached_tools = mcp_tool_cache.get_tools(server_config) if not server.lock.locked() else None
+        if cached_tools is not None:
+            server.load_cached_tools(cached_tools)
+            if not lazy:
+                server.warmup_task = asyncio.create_task(server.warm_up())
+            server.last_used = time.time()
+            return server
+
+    await server.ensure_started()
+    server.last_used = time.time()
+    return server
+
+async def evict_idle_servers():
+    while True:
+        await asyncio.sleep(eviction_interval)
+
+        for key, server in list(servers.items()):
+            if time.time() - server.last_used > idle_timeout and not server.lock.locked():
+                logger.info(f"evict idle mcp server: {server.name} ({key})")
+                servers.pop(key, None)
+                try:
+                    await server.stop()
+                except Exception:
+                    err_msg = traceback.format_exc()
+                    logger.info(f"error message: {err_msg}")
+
+async def get_tools(server_params, lazy=False):
+    """
+    Return langchain tools of the MCP servers in server_params, the output of
+    chat.load_multiple_mcp_server_parameters(). Servers are started only if
+    they are not running in the pool yet. If lazy is True, servers with cached
+    tool schemas are not started until one of their tools is called.
+    """
+    names = list(server_params.keys())
+    results = await asyncio.gather(
+        *[run_in_pool(acquire_server(name, server_params[name], lazy)) for name in names],
+        return_exceptions=True
+    )
+
+    tools = []
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            logger.info(f"{name} is not available: {result}")
+            continue
+        tools.extend(result.tools)
+
+    return tools
+
+def get_pool_status():
+    return [server.get_status() for server in list(servers.values())]
+
+async def close_all():
+    for key in list(servers.keys()):
+        server = servers.pop(key, None)
+        if server is not None:
+            await server.stop()
+
+def shutdown():
+    if _loop is None or not _loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(close_all(), _loop).result(timeout=30)
+    except Exception:
+        err_msg = traceback.format_exc()
+        logger.info(f"error message: {err_msg}")
+
+atexit.register(shutdown)
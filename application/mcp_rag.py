@@ -39,19 +39,32 @@ numberOfDocs = 3
 model_name = "Claude 3.5 Haiku"
 knowledge_base_name = projectName
 
-def retrieve_knowledge_base(query):
-    lambda_client = boto3.client(
-        service_name='lambda',
-        region_name=bedrock_region
-    )
+lambda_client = None
+def get_lambda_client():
+    global lambda_client
+    if lambda_client is None:
+        lambda_client = boto3.client(
+            service_name='lambda',
+            region_name=bedrock_region
+        )
+    return lambda_client
+
+def get_modes(grading_mode=None, multi_region=None):
+    """Modes of the session which called the tool. mcp.env has the defaults for the calls without them."""
+    if not grading_mode or not multi_region:
+        mcp_env = utils.load_mcp_env()
+        grading_mode = grading_mode or mcp_env['grading_mode']
+        multi_region = multi_region or mcp_env['multi_region']
+    return grading_mode, multi_region
+
+def retrieve_knowledge_base(query, grading_mode=None, multi_region=None):
+    lambda_client = get_lambda_client()
 
     functionName = f"lambda-rag-for-{projectName}"
     print(f"functionName: {functionName}")
 
-    mcp_env = utils.load_mcp_env()
-    grading_mode = mcp_env['grading_mode']
+    grading_mode, multi_region = get_modes(grading_mode, multi_region)
     logger.info(f"grading_mode: {grading_mode}")
-    multi_region = mcp_env['multi_region']
     logger.info(f"multi_region: {multi_region}")
 
     try:
@@ -62,7 +75,8 @@ def retrieve_knowledge_base(query):
             'top_k': numberOfDocs,
             'grading': grading_mode,
             'model_name': model_name,
-            'multi_region': multi_region
+            'multi_region': multi_region,
+            'compression': 'gzip'
         }
         print(f"payload: {payload}")
 
@@ -71,10 +85,56 @@ def retrieve_knowledge_base(query):
             Payload=json.dumps(payload),
         )
         payload = json.load(output['Payload'])
+        payload['response'] = utils.decode_response(payload)
         print(f"response: {payload['response']}")
         
     except Exception:
         err_msg = traceback.format_exc()
         print(f"error message: {err_msg}")       
 
-    return payload['response']
\ No newline at end of file
+    return payload['response']
+
+def retrieve_knowledge_bases(keywords, grading_mode=None, multi_region=None):
+    """
+    Search the keywords by one invocation. The documents are merged without duplication,
+    and each document has the keywords which found it.
+    """
+    lambda_client = get_lambda_client()
+
+    functionName = f"lambda-rag-for-{projectName}"
+    print(f"functionName: {functionName}")
+
+    grading_mode, multi_region = get_modes(grading_mode, multi_region)
+
+    try:
+        payload = {
+            'function': 'search_rag',
+            'knowledge_base_name': knowledge_base_name,
+            'keywords': keywords,
+            'top_k': numberOfDocs,
+            'grading': grading_mode,
+            'model_name': model_name,
+            'multi_region': multi_region,
+            'compression': 'gzip'
+        }
+        print(f"payload: {payload}")
+
+        output = lambda_client.invoke(
+            FunctionName=functionName,
+            Payload=json.dumps(payload),
+        )
+        payload = json.load(output['Payload'])
+        payload['response'] = utils.decode_response(payload)
+        print(f"response: {payload['response']}")
+
+        docs = json.loads(payload['response'])
+        for result in json.loads(payload.get('results', '[]')):
+            for i in result['indexes']:
+                docs[i].setdefault('keywords', []).append(result['keyword'])
+        return json.dumps(docs, ensure_ascii=False)
+        
+    except Exception:
+        err_msg = traceback.format_exc()
+        print(f"error message: {err_msg}")       
+
+    return json.dumps([])
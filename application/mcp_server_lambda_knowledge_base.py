@@ -31,15 +31,30 @@ except Exception as e:
 # RAG
 ######################################
 @mcp.tool()
-def knowledge_base_search(keyword: str) -> list:
+def knowledge_base_search(keyword: str, grading_mode: str = "", multi_region: str = "") -> list:
     """
     Search the knowledge base with the given keyword.
     keyword: the keyword to search
+    grading_mode, multi_region: modes of the session which are set by the application
     return: the result of search
     """
     logger.info(f"search --> keyword: {keyword}")
 
-    result = rag.retrieve_knowledge_base(keyword)
+    result = rag.retrieve_knowledge_base(keyword, grading_mode, multi_region)
+    logger.info(f"result: {result}")
+    return result
+
+@mcp.tool()
+def knowledge_base_search_batch(keywords: list[str], grading_mode: str = "", multi_region: str = "") -> str:
+    """
+    Search the knowledge base with several keywords at once. Use this tool instead of calling knowledge_base_search many times.
+    keywords: the keywords to search
+    grading_mode, multi_region: modes of the session which are set by the application
+    return: the documents of all keywords, where each document has the keywords which found it
+    """
+    logger.info(f"search --> keywords: {keywords}")
+
+    result = rag.retrieve_knowledge_bases(keywords, grading_mode, multi_region)
     logger.info(f"result: {result}")
     return result
 
@@ -31,15 +31,28 @@ except Exception as e:
 # RAG
 ######################################
 @mcp.tool()
-def rag_search(keyword: str) -> str:
+def rag_search(keyword: str, grading_mode: str = "", multi_region: str = "") -> str:
     """
     Search the knowledge base with the given keyword.
     keyword: the keyword to search
+    grading_mode, multi_region: modes of the session which are set by the application
     return: the result of search
     """
     logger.info(f"search --> keyword: {keyword}")
 
-    return rag.retrieve_knowledge_base(keyword)
+    return rag.retrieve_knowledge_base(keyword, grading_mode, multi_region)
+
+@mcp.tool()
+def rag_search_batch(keywords: list[str], grading_mode: str = "", multi_region: str = "") -> str:
+    """
+    Search the knowledge base with several keywords at once. Use this tool instead of calling rag_search many times.
+    keywords: the keywords to search
+    grading_mode, multi_region: modes of the session which are set by the application
+    return: the documents of all keywords, where each document has the keywords which found it
+    """
+    logger.info(f"search --> keywords: {keywords}")
+
+    return rag.retrieve_knowledge_bases(keywords, grading_mode, multi_region)
 
 if __name__ =="__main__":
     print(f"###### main ######")
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import utils
+
+from importlib import metadata
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("mcp-tool-cache")
+
+config = utils.load_config()
+
+cache_path = config["mcp_tool_cache_path"] if "mcp_tool_cache_path" in config else os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcp_tool_cache.json")
+# unpinned packages (npx -y pkg, pkg@latest) are refreshed after this period
+unpinned_ttl = config["mcp_tool_cache_ttl"] if "mcp_tool_cache_ttl" in config else 86400
+
+client_packages = ["mcp", "langchain-mcp-adapters"]
+
+_lock = threading.Lock()
+_cache = None
+
+def normalize_server_config(server_config):
+    env = dict(server_config.get("env") or {})
+    return {
+        "command": server_config.get("command", ""),
+        "args": list(server_config.get("args", [])),
+        "env": {k: env[k] for k in sorted(env)},
+        "transport": server_config.get("transport", "stdio")
+    }
+
+def get_config_hash(server_config):
+    normalized = normalize_server_config(server_config)
+    body = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()[:16]
+
+def get_package_version(package):
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return ""
+
+def is_pinned_package(arg):
+    # @scope/name@1.2.3, name@1.2.3, name==1.2.3
+    if "==" in arg:
+        return True
+    name, sep, version = arg.rpartition("@")
+    return bool(sep and name and version and version != "latest")
+
+def get_fingerprint(server_config):
+    """Values which invalidate the cached tool list of a server when they are changed."""
+    normalized = normalize_server_config(server_config)
+
+    fingerprint = {
+        "client": {package: get_package_version(package) for package in client_packages},
+        "files": {},
+        "expires": None
+    }
+
+    for arg in normalized["args"]:
+        if os.path.isfile(arg):   # local server script
+            fingerprint["files"][arg] = os.path.getmtime(arg)
+
+    if normalized["command"] in ["npx", "uvx"]:
+        packages = [arg for arg in normalized["args"] if not arg.startswith("-") and not arg.startswith("{")]
+        if not packages or not is_pinned_package(packages[0]):
+            fingerprint["expires"] = int(time.time() // unpinned_ttl)
+
+    return fingerprint
+
+def load_cache():
+    global _cache
+
+    if _cache is None:
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                _cache = json.load(f)
+        except FileNotFoundError:
+            _cache = {}
+        except Exception:
+            err_msg = traceback.format_exc()
+            logger.info(f"error message: {err_msg}")
+            _cache = {}
+    return _cache
+
+def save_cache(cache):
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp_path, cache_path)
+
+def get_tools(server_config):
+    """Return the cached tool schemas (list of dict) of the server or None."""
+    key = get_config_hash(server_config)
+
+    with _lock:
+        item = load_cache().get(key)
+
+    if item is None:
+        return None
+
+    if item["fingerprint"] != get_fingerprint(server_config):
+        logger.info(f"tool cache is outdated: {key}")
+        return None
+
+    return item["tools"]
+
+def put_tools(server_config, tools):
+    key = get_config_hash(server_config)
+
+    item = {
+        "fingerprint": get_fingerprint(server_config),
+        "tools": tools
+    }
+
+    with _lock:
+        cache = load_cache()
+        if cache.get(key) == item:
+            return
+        cache[key] = item
+
+        try:
+            save_cache(cache)
+            logger.info(f"tool cache updated: {key} ({len(tools)} tools)")
+        except Exception:
+            err_msg = traceback.format_exc()
+            logger.info(f"error message: {err_msg}")
@@ -10,6 +10,7 @@ import traceback
 import mcp_config 
 import logging
 import sys
+import request_context
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,6 +21,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger("streamlit")
 
+# the model, modes and results of this session are kept in its own request context
+request_context.activate_session(st.session_state)
+
 # 모바일 환경에 최적화된 페이지 설정
 st.set_page_config(
     page_title='MCP Mobile',
@@ -0,0 +1,263 @@
+import asyncio
+import json
+import logging
+import re
+import sys
+import time
+import traceback
+import chat
+import agent
+import utils
+import tool_executor
+import tool_index
+import reference_collector
+
+from pydantic.v1 import BaseModel, Field
+from langchain_core.prompts import ChatPromptTemplate
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("plan-execute")
+
+config = utils.load_config()
+
+####################### Plan and Execute #######################
+# The model makes a plan of tool calls with their dependencies
+# at once. The steps run as soon as their dependencies are done,
+# so independent steps run at the same time, and the model makes
+# the answer from all results with one more call. An argument can
+# use the result of a previous step as {{step id}}.
+################################################################
+max_steps = config["plan_max_steps"] if "plan_max_steps" in config else 10
+plan_timeout = config["plan_timeout"] if "plan_timeout" in config else 300   # seconds
+max_result_length = 8000   # characters of a step result which are given to the next steps and the answer
+
+class PlanStep(BaseModel):
+    id: str = Field(description="unique id of the step such as s1, s2")
+    tool: str = Field(description="name of the tool")
+    args: dict = Field(description="arguments of the tool. Use {{step id}} in a string to use the result of a previous step")
+    depends_on: list[str] = Field(default=[], description="ids of the steps whose results are required")
+
+class Plan(BaseModel):
+    steps: list[PlanStep] = Field(description="tool calls to answer the question. Empty if no tool is required")
+
+def get_tool_catalog(tools):
+    catalog = []
+    for tool in tools:
+        args = json.dumps(getattr(tool, "args", {}), ensure_ascii=False, default=str)
+        catalog.append(f"<tool name=\"{tool.name}\">\n{tool.description}\nargs: {args}\n</tool>")
+    return "\n".join(catalog)
+
+async def make_plan(question, tools, config):
+    system = (
+        "You make a plan of tool calls to answer the question of the user.\n"
+        "Use only the tools in <tools> with their arguments. Make the steps independent as much as possible "
+        "so that they run at the same time, and add a step to depends_on only if its result is required "
+        "in the arguments. Use {{{{step id}}}} in an argument to put the result of the step.\n"
+        f"Use at most {max_steps} steps. If the question can be answered without tools, return no step.\n\n"
+        "<tools>\n{catalog}\n</tools>"
+    )
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", system),
+        ("human", "{question}")
+    ])
+
+    chatModel = chat.get_chat(extended_thinking="Disable")
+    planner = prompt | chatModel.with_structured_output(Plan)
+
+    # planning is bounded by the deadline of the request, before the time reserved for the answer
+    start = time.time()
+    timeout = plan_timeout
+    remaining = tool_executor.get_remaining_time(config)
+    if remaining is not None:
+        timeout = max(min(plan_timeout, remaining - config["configurable"].get("answer_reserve", 0)), 1)
+
+    plan = await asyncio.wait_for(planner.ainvoke({"catalog": get_tool_catalog(tools), "question": question}), timeout=timeout)
+    tool_executor.add_timing(config, "plan", time.time()-start)
+    logger.info(f"plan: {plan}")
+    return plan
+
+def validate_plan(plan, tools):
+    """Return the steps in a topological order. The steps of unknown tools and cycles are removed."""
+    steps = dict()
+    for step in plan.steps[:max_steps]:
+        if step.tool not in tools:
+            logger.info(f"unknown tool: {step.tool}")
+            continue
+        if step.id in steps:
+            logger.info(f"duplicated step: {step.id}")
+            continue
+        steps[step.id] = step
+
+    for step in steps.values():
+        step.depends_on = [d for d in step.depends_on if d in steps and d != step.id]
+        # a reference to a step in the args is also a dependency
+        for d in re.findall(r"\{\{\s*([\w\-]+)\s*\}\}", json.dumps(step.args, ensure_ascii=False)):
+            if d in steps and d != step.id and d not in step.depends_on:
+                step.depends_on.append(d)
+
+    ordered = []
+    done = set()
+    while len(ordered) < len(steps):
+        ready = [s for s in steps.values() if s.id not in done and all(d in done for d in s.depends_on)]
+        if not ready:   # cycle
+            logger.info(f"cycle in the plan: {[s.id for s in steps.values() if s.id not in done]}")
+            break
+        for step in ready:
+            ordered.append(step)
+            done.add(step.id)
+    return ordered
+
+def resolve_args(value, results):
+    if isinstance(value, str):
+        return re.sub(r"\{\{\s*([\w\-]+)\s*\}\}", lambda m: results.get(m.group(1), m.group(0)), value)
+    if isinstance(value, dict):
+        return {k: resolve_args(v, results) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve_args(v, results) for v in value]
+    return value
+
+def get_text(content):
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(item.get("text", "") if isinstance(item, dict) else str(item) for item in content)
+    return json.dumps(content, ensure_ascii=False, default=str)
+
+async def execute_plan(steps, tools, containers, config):
+    """Run the steps as soon as their dependencies are done. Return the results by the step id."""
+    results = dict()   # step id -> text
+    tasks = dict()     # step id -> task
+
+    async def run_step(step):
+        if step.depends_on:
+            await asyncio.wait([tasks[d] for d in step.depends_on])
+
+        args = resolve_args(step.args, results)
+        tool_call = {"name": step.tool, "args": args, "id": f"plan-{step.id}"}
+        logger.info(f"run step {step.id}: {step.tool}, {args}")
+        if chat.debug_mode == "Enable":
+            agent.add_notification(containers, f"{step.id} {step.tool}: {args}")
+
+        message = await tool_executor.run_tool(tools[step.tool], tool_call, config)
+        content, _, _ = agent.collector.collect(message)
+        text = content if content else get_text(message.content)
+
+        results[step.id] = text[:max_result_length]
+        agent.response_msg.append(f"{step.id} {step.tool}: {text[:max_result_length]}")
+
+    start = time.time()
+    for step in steps:   # topological order, so the tasks of the dependencies exist
+        tasks[step.id] = asyncio.create_task(run_step(step))
+
+    timeout = plan_timeout
+    remaining = tool_executor.get_remaining_time(config)
+    if remaining is not None:
+        timeout = max(min(plan_timeout, remaining - config["configurable"].get("answer_reserve", 0)), 1)
+
+    done, pending = await asyncio.wait(tasks.values(), timeout=timeout)
+    for step in steps:
+        task = tasks[step.id]
+        if task in pending:
+            task.cancel()
+            results[step.id] = f"Error: cancelled because the plan took more than {timeout:.0f} seconds."
+    logger.info(f"plan executed: {len(steps)} steps, {time.time()-start:.2f}s")
+
+    return results
+
+async def synthesize(question, steps, results, containers):
+    system = (
+        "당신의 이름은 서연이고, 질문에 친근한 방식으로 대답하도록 설계된 대화형 AI입니다."
+        "<results>의 도구 실행 결과를 이용해 질문에 답변합니다."
+        "상황에 맞는 구체적인 세부 정보를 충분히 제공합니다."
+        "결과에서 답을 찾을 수 없으면 솔직히 모른다고 말합니다."
+        "한국어로 답변하세요."
+    )
+    items = [
+        f"<result step=\"{step.id}\" tool=\"{step.tool}\">\n{results.get(step.id, '')}\n</result>"
+        for step in steps
+    ]
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", system),
+        ("human", "<results>\n{results}\n</results>\n\n<question>\n{question}\n</question>")
+    ])
+
+    chatModel = chat.get_chat(extended_thinking="Disable")
+    chain = prompt | chatModel
+
+    message_container = containers.get("message")
+    answer = ""
+    async for chunk in chain.astream({"results": "\n".join(items), "question": question}):
+        text = chat.get_chunk_text(chunk)
+        if text:
+            answer += text
+            if message_container is not None:
+                message_container.markdown(answer + "▌")
+
+    if message_container is not None:
+        message_container.empty()   # the final answer is written by the caller with the references
+    return answer
+
+async def run(question, tools, containers):
+    """Answer the question with a plan of tool calls. The ReAct agent is used if the plan is not available."""
+    agent.session.status_msg = []
+    agent.session.response_msg = []
+    agent.session.collector = reference_collector.ReferenceCollector()
+    agent.session.index = 0
+
+    # the planner sees only the relevant tools if many tools are selected
+    tool_selection = tool_index.select_tools(tools, question)
+    candidates = [t for t in tool_selection.get_bound_tools() if t is not tool_selection.expand_tool] if tool_selection else tools
+    tool_map = {tool.name: tool for tool in tools}
+
+    if chat.debug_mode == "Enable":
+        containers["status"].info(agent.get_status_msg("(plan"))
+
+    start = time.time()
+    run_config = {
+        "configurable": {
+            "containers": containers, 
+            "session_arguments": chat.get_session_arguments(),
+            "start": start,
+            "deadline": start + agent.agent_deadline if agent.agent_deadline else None,
+            "answer_reserve": agent.answer_reserve,
+            "timings": []
+        }
+    }
+
+    try:
+        plan = await make_plan(question, candidates, run_config)
+    except Exception:
+        err_msg = traceback.format_exc()
+        logger.info(f"error message: {err_msg}")
+        logger.info("fall back to the agent")
+        return await agent.run(question, tools, containers, "Disable")
+
+    steps = validate_plan(plan, tool_map)
+    if chat.debug_mode == "Enable":
+        plan_msg = "\n".join([f"{s.id}: {s.tool} {s.args} <- {s.depends_on}" for s in steps])
+        agent.add_notification(containers, f"plan:\n{plan_msg}" if steps else "plan: no tool")
+        containers["status"].info(agent.get_status_msg("execute"))
+
+    results = await execute_plan(steps, tool_map, containers, run_config) if steps else {}
+
+    if chat.debug_mode == "Enable":
+        containers["status"].info(agent.get_status_msg("answer"))
+    result = await synthesize(question, steps, results, containers)
+
+    logger.info(f"timings: {run_config['configurable']['timings']}")
+    if chat.debug_mode == "Enable":
+        containers["status"].info(agent.get_status_msg("end)"))
+
+    if agent.collector.references:
+        ref = "\n\n### Reference\n"
+        for i, reference in enumerate(agent.collector.references):
+            ref += f"{i+1}. [{reference['title']}]({reference['url']}), {reference['content']}...\n"
+        result += ref
+
+    return result, agent.collector.image_urls
@@ -0,0 +1,288 @@
+import json
+import logging
+import re
+import sys
+import traceback
+import utils
+
+from langchain_core.messages import ToolMessage
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("reference-collector")
+
+config = utils.load_config()
+sharing_url = config["sharing_url"] if "sharing_url" in config else None
+s3_prefix = "docs"
+capture_prefix = "captures"
+
+####################### Reference Collector #######################
+# The result of a tool is parsed once when its ToolMessage appears,
+# and the parsed content, image urls and references are kept by the
+# tool_call_id. The parser is selected by the tool name and falls
+# back to the generic JSON parser. References are deduplicated by
+# their url.
+###################################################################
+image_extensions = ["jpg", "jpeg", "png", "gif", "bmp", "tiff", "ico", "webp"]
+
+parsers = dict()   # tool name -> parser(tool_content) which returns (content, urls, references)
+
+def register_parser(*tool_names):
+    """Decorator to use the function as the parser of the tools."""
+    def decorator(parser):
+        for tool_name in tool_names:
+            parsers[tool_name] = parser
+        return parser
+    return decorator
+
+def get_summary(text):
+    text = text.replace("\n", "")
+    return text[:100] + "..." if len(text) > 100 else text
+
+def load_json(tool_content):
+    if isinstance(tool_content, (dict, list)):
+        return tool_content
+    return json.loads(tool_content)
+
+def is_tavily(tool_content):
+    return isinstance(tool_content, str) and "Title:" in tool_content and "URL:" in tool_content and "Content:" in tool_content
+
+tavily_pattern = re.compile(r"Title:\s*(.*?)\s*URL:\s*(\S+)\s*Content:\s*(.*?)(?=\n\nTitle:|\Z)", re.DOTALL)
+
+def parse_tavily(tool_content):
+    content = ""
+    references = []
+    for title, url, text in tavily_pattern.findall(tool_content):
+        text = text.strip().replace("\n", "")
+        content += f"{text}\n\n"
+        references.append({
+            "url": url,
+            "title": title,
+            "content": get_summary(text)
+        })
+    return content, [], references
+
+# OpenSearch
+@register_parser("SearchIndexTool")
+def parse_opensearch(tool_content):
+    content = ""
+    references = []
+
+    json_data = {}
+    if ":" in tool_content:
+        try:
+            json_data = json.loads(tool_content.split(":", 1)[1].strip())
+        except json.JSONDecodeError:
+            logger.info("JSON parsing error")
+
+    if "hits" in json_data:
+        for hit in json_data["hits"]["hits"]:
+            text = hit["_source"]["text"]
+            metadata = hit["_source"]["metadata"]
+            content += f"{text}\n\n"
+
+            references.append({
+                "url": metadata["url"],
+                "title": metadata["name"].split("/")[-1],
+                "content": get_summary(text)
+            })
+    return content, [], references
+
+def split_json_objects(tool_content):
+    """Parse the concatenated JSON objects in the text."""
+    json_objects = []
+    brace_count = 0
+    start_pos = -1
+    for i, char in enumerate(tool_content):
+        if char == '{':
+            if brace_count == 0:
+                start_pos = i
+            brace_count += 1
+        elif char == '}':
+            brace_count -= 1
+            if brace_count == 0 and start_pos != -1:
+                try:
+                    json_objects.append(json.loads(tool_content[start_pos:i+1]))
+                except json.JSONDecodeError:
+                    logger.info(f"JSON parsing error: {tool_content[start_pos:i+1][:100]}")
+                start_pos = -1
+    return json_objects
+
+# Knowledge Base
+@register_parser("QueryKnowledgeBases")
+def parse_knowledge_base(tool_content):
+    content = ""
+    references = []
+    try:
+        if tool_content.strip().startswith('{'):   # multiple JSON objects
+            json_data = split_json_objects(tool_content)
+        else:
+            json_data = json.loads(tool_content)
+    except json.JSONDecodeError as e:
+        logger.info(f"JSON parsing error: {e}")
+        return tool_content, [], []   # use the original content
+
+    if isinstance(json_data, list):
+        for item in json_data:
+            if isinstance(item, dict) and "content" in item:
+                content_text = item["content"].get("text", "")
+                content += content_text + "\n\n"
+
+                if "location" in item and "s3Location" in item["location"]:
+                    uri = item["location"]["s3Location"]["uri"]
+                    filename = uri.split("/")[-1]
+                    ext = uri.split(".")[-1]
+                    if ext in image_extensions:
+                        url = sharing_url + "/" + capture_prefix + "/" + filename
+                    else:
+                        url = sharing_url + "/" + s3_prefix + "/" + filename
+
+                    references.append({
+                        "url": url,
+                        "title": filename,
+                        "content": get_summary(content_text)
+                    })
+    return content, [], references
+
+# AWS Document
+@register_parser("search_documentation")
+def parse_aws_document(tool_content):
+    references = []
+    try:
+        json_data = json.loads(tool_content)
+    except json.JSONDecodeError:
+        logger.info(f"JSON parsing error: {tool_content[:100]}")
+        return "", [], []
+
+    for item in json_data:
+        if isinstance(item, str):
+            try:
+                item = json.loads(item)
+            except json.JSONDecodeError:
+                logger.info(f"Failed to parse item as JSON: {item}")
+                continue
+
+        if isinstance(item, dict) and 'url' in item and 'title' in item:
+            references.append({
+                "url": item['url'],
+                "title": item['title'],
+                "content": get_summary(item.get('context', ""))
+            })
+    return "", [], references
+
+# ArXiv
+@register_parser("search_papers")
+def parse_arxiv(tool_content):
+    content = ""
+    references = []
+    try:
+        json_data = json.loads(tool_content)
+    except json.JSONDecodeError:
+        logger.info(f"JSON parsing error: {tool_content[:100]}")
+        return "", [], []
+
+    for paper in json_data.get("papers", []) if isinstance(json_data, dict) else []:
+        abstract = get_summary(paper['abstract'])
+        content += f"{abstract}\n\n"
+        references.append({
+            "url": paper['url'],
+            "title": paper['title'],
+            "content": abstract
+        })
+    return content, [], references
+
+def parse_json(tool_content):
+    """Generic parser for the results of RAG, image paths, AWS documents and papers."""
+    try:
+        json_data = load_json(tool_content)
+    except (json.JSONDecodeError, TypeError):
+        return "", [], []
+
+    urls = []
+    references = []
+    if isinstance(json_data, dict):
+        if "path" in json_data:
+            path = json_data["path"]
+            urls.extend(path if isinstance(path, list) else [path])
+        if "papers" in json_data:
+            _, _, references = parse_arxiv(json.dumps(json_data))
+        return "", urls, references
+
+    if isinstance(json_data, list):
+        for item in json_data:
+            if isinstance(item, str):   # AWS Document
+                try:
+                    item = json.loads(item)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(item, dict) and "rank_order" in item:
+                    references.append({
+                        "url": item['url'],
+                        "title": item['title'],
+                        "content": get_summary(item['context'])
+                    })
+            elif isinstance(item, dict) and "reference" in item and "contents" in item:   # RAG
+                references.append({
+                    "url": item["reference"]["url"],
+                    "title": item["reference"]["title"],
+                    "content": get_summary(item["contents"])
+                })
+    return "", urls, references
+
+def parse(tool_name, tool_content):
+    """Return (content, urls, references) of the tool result. content is empty if the result is used as it is."""
+    if isinstance(tool_content, list) and tool_content and all(isinstance(item, dict) and item.get("type") == "text" for item in tool_content):
+        tool_content = "\n".join(item["text"] for item in tool_content)   # content blocks of MCP tools
+
+    try:
+        if is_tavily(tool_content):
+            return parse_tavily(tool_content)
+        if tool_name in parsers:
+            return parsers[tool_name](tool_content)
+        return parse_json(tool_content)
+    except Exception:
+        err_msg = traceback.format_exc()
+        logger.info(f"error message: {err_msg}")
+        return "", [], []
+
+class ReferenceCollector:
+    """References and image urls of the tool results in a request."""
+
+    def __init__(self):
+        self.results = dict()    # tool_call_id -> (content, urls, references)
+        self.references = []
+        self.image_urls = []
+        self.reference_urls = set()
+
+    def collect(self, message):
+        """Parse the ToolMessage once and return its (content, urls, references)."""
+        if message.tool_call_id in self.results:
+            return self.results[message.tool_call_id]
+
+        content, urls, references = parse(message.name, message.content)
+        self.results[message.tool_call_id] = (content, urls, references)
+
+        for reference in references:
+            key = reference.get("url") or reference.get("title")
+            if key in self.reference_urls:
+                continue
+            self.reference_urls.add(key)
+            self.references.append(reference)
+        for url in urls:
+            if url not in self.image_urls:
+                self.image_urls.append(url)
+
+        logger.info(f"{message.name}: {len(references)} references, {len(urls)} urls")
+        return content, urls, references
+
+    def collect_all(self, messages):
+        """Collect the ToolMessages which are not parsed yet."""
+        for message in messages:
+            if isinstance(message, ToolMessage):
+                self.collect(message)
+        return self.references
@@ -0,0 +1,310 @@
+import logging
+import sys
+import threading
+import time
+import utils
+
+from collections import deque
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("region-scheduler")
+
+config = utils.load_config()
+
+latency_window = 100          # number of latency samples per region
+throttle_window = 60          # seconds
+breaker_threshold = config["region_breaker_threshold"] if "region_breaker_threshold" in config else 3   # consecutive throttles
+breaker_cooldown = config["region_breaker_cooldown"] if "region_breaker_cooldown" in config else 30     # seconds
+max_breaker_cooldown = 300    # seconds
+
+throttling_error_codes = [
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException"
+]
+
+####################### Region Scheduler #######################
+# Multi-region routing for Bedrock calls
+# Every bedrock-runtime client reports its calls through botocore
+# event hooks, so the scheduler sees the in-flight requests, the
+# latency and the throttling of each region including the retries
+# which botocore does internally.
+################################################################
+class RegionStats:
+    def __init__(self, region):
+        self.region = region
+        self.in_flight = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.results = deque()    # (time, throttled)
+        self.consecutive_throttles = 0
+        self.opened_at = 0        # circuit breaker
+        self.cooldown = 0
+        self.probing = False      # half-open
+        self.requests = 0
+        self.throttles = 0
+        self.first_tokens = deque(maxlen=latency_window)   # time to the first token of the streamed answers
+
+    def percentile(self, p, samples=None):
+        samples = self.latencies if samples is None else samples
+        if not samples:
+            return 0
+        values = sorted(samples)
+        index = min(len(values)-1, int(len(values) * p / 100))
+        return values[index]
+
+    def throttle_rate(self, now):
+        while self.results and now - self.results[0][0] > throttle_window:
+            self.results.popleft()
+        if not self.results:
+            return 0
+        return sum(1 for _, throttled in self.results if throttled) / len(self.results)
+
+    def is_open(self, now):
+        return self.opened_at > 0 and now - self.opened_at < self.cooldown
+
+    def is_half_open(self, now):
+        return self.opened_at > 0 and now - self.opened_at >= self.cooldown
+
+    def record_throttle(self, now):
+        self.throttles += 1
+        self.results.append((now, True))
+        self.consecutive_throttles += 1
+
+        if self.probing or self.consecutive_throttles >= breaker_threshold:
+            # reopen with a longer cooldown when the probe request was throttled again
+            self.cooldown = min(self.cooldown * 2, max_breaker_cooldown) if self.probing else breaker_cooldown
+            self.opened_at = now
+            self.probing = False
+            logger.info(f"circuit breaker opened: {self.region} (cooldown: {self.cooldown}s)")
+
+    def record_success(self, now, latency):
+        self.latencies.append(latency)
+        self.results.append((now, False))
+        self.consecutive_throttles = 0
+
+        if self.opened_at > 0:
+            logger.info(f"circuit breaker closed: {self.region}")
+        self.opened_at = 0
+        self.cooldown = 0
+        self.probing = False
+
+    def score(self, now, pending=0):
+        # expected wait: latency of the region multiplied by its queue, penalized by throttling
+        latency = (self.percentile(50) + self.percentile(95)) / 2
+        return (latency + 0.1) * (1 + self.in_flight + pending) * (1 + 4 * self.throttle_rate(now))
+
+_lock = threading.Lock()
+stats = dict()    # region -> RegionStats
+_turn = 0         # round-robin among the regions with the same score
+
+def get_stats(region):
+    if region not in stats:
+        stats[region] = RegionStats(region)
+    return stats[region]
+
+def is_throttled(parsed):
+    if not isinstance(parsed, dict):
+        return False
+    code = parsed.get("Error", {}).get("Code", "")
+    return code in throttling_error_codes
+
+def before_call(region, context, **kwargs):
+    context["region_scheduler_start"] = time.time()
+    with _lock:
+        region_stats = get_stats(region)
+        region_stats.in_flight += 1
+        region_stats.requests += 1
+        if region_stats.is_half_open(time.time()):
+            region_stats.probing = True
+
+def after_call(region, context, http_response=None, parsed=None, **kwargs):
+    start = context.pop("region_scheduler_start", None)
+    if start is None:
+        return
+
+    now = time.time()
+    with _lock:
+        region_stats = get_stats(region)
+        region_stats.in_flight = max(0, region_stats.in_flight - 1)
+
+        # throttled attempts are already counted by needs_retry
+        if http_response is not None and http_response.status_code < 300:
+            region_stats.record_success(now, now - start)
+
+def after_call_error(region, context, exception=None, **kwargs):
+    if context.pop("region_scheduler_start", None) is None:
+        return
+
+    with _lock:
+        region_stats = get_stats(region)
+        region_stats.in_flight = max(0, region_stats.in_flight - 1)
+
+def needs_retry(region, response=None, **kwargs):
+    # called for every attempt including the ones which botocore retries internally
+    if response is None:
+        return None
+
+    _, parsed = response
+    if is_throttled(parsed):
+        with _lock:
+            get_stats(region).record_throttle(time.time())
+    return None
+
+def register_client(client, region):
+    """Attach the scheduler hooks to a bedrock-runtime client of the region."""
+    events = client.meta.events
+    events.register("before-call.bedrock-runtime", lambda **kwargs: before_call(region, **kwargs))
+    events.register("after-call.bedrock-runtime", lambda **kwargs: after_call(region, **kwargs))
+    events.register("after-call-error.bedrock-runtime", lambda **kwargs: after_call_error(region, **kwargs))
+    events.register("needs-retry.bedrock-runtime", lambda **kwargs: needs_retry(region, **kwargs))
+
+def select(models):
+    """Return the index of the profile in models which is expected to answer first."""
+    return select_many(models, 1)[0]
+
+def select_many(models, count):
+    """
+    Return indexes of the profiles for count requests which are sent at once.
+    The requests selected in this call are counted as in-flight while the rest are selected.
+    """
+    global _turn
+
+    now = time.time()
+    with _lock:
+        pending = [0] * len(models)
+        indexes = []
+        for _ in range(count):
+            _turn += 1
+            candidates = []
+            for i, profile in enumerate(models):
+                region_stats = get_stats(profile["bedrock_region"])
+                if region_stats.is_open(now):
+                    continue
+                if region_stats.is_half_open(now) and (region_stats.probing or region_stats.in_flight + pending[i] > 0):
+                    continue   # only one probe request while half-open
+                candidates.append((region_stats.score(now, pending[i]), (i + _turn) % len(models), i))
+
+            if candidates:
+                index = min(candidates)[2]
+            else:
+                # every region is open, use the one which will be closed first
+                index = min(range(len(models)), key=lambda i: get_stats(models[i]["bedrock_region"]).opened_at + get_stats(models[i]["bedrock_region"]).cooldown)
+                logger.info(f"all regions are throttled, use {models[index]['bedrock_region']}")
+
+            pending[index] += 1
+            indexes.append(index)
+
+        return indexes
+
+def select_fallbacks(models, primary):
+    """Return the indexes of the profiles in the other regions which are not throttled, the best first."""
+    now = time.time()
+    regions = {models[primary]["bedrock_region"]}
+    with _lock:
+        candidates = []
+        for i, profile in enumerate(models):
+            if profile["bedrock_region"] in regions:
+                continue
+            regions.add(profile["bedrock_region"])
+            region_stats = get_stats(profile["bedrock_region"])
+            if region_stats.is_open(now) or region_stats.is_half_open(now):
+                continue
+            candidates.append((region_stats.score(now), i))
+        return [i for _, i in sorted(candidates)]
+
+def select_secondary(models, primary):
+    """Return the index of the profile in another region for a hedged request, or None if there is no such region."""
+    fallbacks = select_fallbacks(models, primary)
+    return fallbacks[0] if fallbacks else None
+
+def is_throttling_error(error):
+    """Whether the error of a chat model call is the throttling of its region, after botocore used up its retries."""
+    while error is not None:
+        response = getattr(error, "response", None)
+        if is_throttled(response):
+            return True
+        if any(code in str(error) for code in throttling_error_codes):
+            return True   # langchain_aws re-raises the ClientError as a ValueError with its message
+        error = error.__cause__ or error.__context__
+    return False
+
+####################### Hedged Requests #######################
+# The time to the first token is recorded per region. A hedged
+# request waits for the first token of the primary region up to
+# the percentile of its recent first tokens, and then sends the
+# same request to a second region. The hedge rate and the latency
+# which the hedges saved are kept here.
+################################################################
+hedge_percentile = config["hedge_percentile"] if "hedge_percentile" in config else 95
+hedge_default_delay = config["hedge_delay"] if "hedge_delay" in config else 3      # seconds, until enough samples
+hedge_min_delay = config["hedge_min_delay"] if "hedge_min_delay" in config else 0.5 # seconds
+hedge_min_samples = 10
+
+hedge_stats = {
+    "requests": 0,      # hedging requests
+    "hedged": 0,        # the second region was called
+    "wins": 0,          # the second region answered first
+    "saved": 0.0        # seconds, sum of the latency which the wins saved
+}
+
+def record_first_token(region, latency):
+    with _lock:
+        get_stats(region).first_tokens.append(latency)
+
+def estimate_first_token(region, elapsed):
+    """First token of the region which has not answered in elapsed seconds: the median of its first tokens later than elapsed."""
+    with _lock:
+        region_stats = get_stats(region)
+        later = [latency for latency in region_stats.first_tokens if latency > elapsed]
+        return region_stats.percentile(50, later) if later else elapsed
+
+def get_hedge_delay(region):
+    """Seconds to wait for the first token of the region before the hedged request is sent."""
+    with _lock:
+        region_stats = get_stats(region)
+        if len(region_stats.first_tokens) < hedge_min_samples:
+            return hedge_default_delay
+        return max(hedge_min_delay, region_stats.percentile(hedge_percentile, region_stats.first_tokens))
+
+def record_hedge(hedged, won, saved=0):
+    with _lock:
+        hedge_stats["requests"] += 1
+        if hedged:
+            hedge_stats["hedged"] += 1
+        if won:
+            hedge_stats["wins"] += 1
+            hedge_stats["saved"] += max(0, saved)
+
+def get_hedge_status():
+    with _lock:
+        requests = hedge_stats["requests"]
+        return {
+            "requests": requests,
+            "hedge_rate": round(hedge_stats["hedged"] / requests, 3) if requests else 0,
+            "win_rate": round(hedge_stats["wins"] / hedge_stats["hedged"], 3) if hedge_stats["hedged"] else 0,
+            "saved": round(hedge_stats["saved"], 3),
+            "saved_per_request": round(hedge_stats["saved"] / requests, 3) if requests else 0
+        }
+
+def get_status():
+    now = time.time()
+    with _lock:
+        return [{
+            "region": region,
+            "in_flight": region_stats.in_flight,
+            "p50": round(region_stats.percentile(50), 3),
+            "p95": round(region_stats.percentile(95), 3),
+            "first_token_p50": round(region_stats.percentile(50, region_stats.first_tokens), 3),
+            "first_token_p95": round(region_stats.percentile(95, region_stats.first_tokens), 3),
+            "throttle_rate": round(region_stats.throttle_rate(now), 3),
+            "breaker": "open" if region_stats.is_open(now) else "half-open" if region_stats.is_half_open(now) else "closed",
+            "requests": region_stats.requests,
+            "throttles": region_stats.throttles
+        } for region, region_stats in stats.items()]
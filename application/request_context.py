@@ -0,0 +1,87 @@
+import contextvars
+import logging
+import sys
+import threading
+import uuid
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("request-context")
+
+####################### Request Context #######################
+# The values of a user session (model, modes, memory and the
+# status of the running request) are kept in a RequestContext
+# instead of module globals, so that one process can serve many
+# sessions at the same time. The context of a Streamlit session
+# is activated at the start of each script run. asyncio tasks
+# inherit it, and threads get it with copy_context().
+# A module declares its session values with SessionState, whose
+# attributes are read and written in the active context.
+###############################################################
+class RequestContext:
+    def __init__(self, session_id=None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.namespaces = dict()   # module name -> dict of the session values
+        self.lock = threading.RLock()
+
+_current = contextvars.ContextVar("request_context", default=None)
+
+# used when no context is activated, e.g. the MCP servers and scripts with one user
+default_context = RequestContext("default")
+
+def get_context():
+    context = _current.get()
+    return context if context is not None else default_context
+
+def activate(context):
+    _current.set(context)
+    return context
+
+def activate_session(session_state):
+    """Activate the context of the Streamlit session. The context is created at the first run of the session."""
+    if "request_context" not in session_state:
+        session_state["request_context"] = RequestContext()
+        logger.info(f"new session: {session_state['request_context'].session_id}")
+    return activate(session_state["request_context"])
+
+def copy_context():
+    """Context for a new thread, e.g. executor.submit(request_context.copy_context().run, func, *args)."""
+    return contextvars.copy_context()
+
+class SessionState:
+    """
+    Session values of a module. factory() returns the dict of the initial values,
+    which is called once per context when a value of the module is used first.
+    """
+
+    def __init__(self, name, factory):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_factory", factory)
+
+    def get_values(self):
+        context = get_context()
+        values = context.namespaces.get(self._name)
+        if values is None:
+            with context.lock:
+                values = context.namespaces.get(self._name)
+                if values is None:
+                    values = self._factory()
+                    context.namespaces[self._name] = values
+        return values
+
+    def __contains__(self, key):
+        return key in self.get_values()
+
+    def __getattr__(self, key):
+        values = self.get_values()
+        if key in values:
+            return values[key]
+        raise AttributeError(f"'{self._name}' has no session value '{key}'")
+
+    def __setattr__(self, key, value):
+        self.get_values()[key] = value
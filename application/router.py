@@ -2,11 +2,11 @@ import utils
 import chat
 import traceback
 import tool_use
+import graph_registry
 
 from typing_extensions import Annotated, TypedDict
 from langgraph.graph.message import add_messages
 from typing import Literal
-from langgraph.prebuilt import ToolNode
 from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
 from langchain_core.prompts import MessagesPlaceholder, ChatPromptTemplate
 from langgraph.graph import START, END, StateGraph
@@ -29,140 +29,143 @@ logger = logging.getLogger("router")
 ####################### LangGraph #######################
 # Chat Agent Executor
 #########################################################
-def create_collaborator(tools, name, st):
-    logger.info(f"###### create_collaborator ######")
+class CollaboratorState(TypedDict):
+    # messages: Annotated[Sequence[BaseMessage], operator.add]
+    messages: Annotated[list, add_messages]
+    name: str
 
-    chatModel = chat.get_chat(chat.reasoning_mode)
-    model = chatModel.bind_tools(tools)
+def should_continue(state: CollaboratorState, config) -> Literal["continue", "end"]:
+    logger.info(f"###### should_continue ######")
 
-    class State(TypedDict):
-        # messages: Annotated[Sequence[BaseMessage], operator.add]
-        messages: Annotated[list, add_messages]
-        name: str
+    st = config.get("configurable", {}).get("st", None)
 
-    tool_node = ToolNode(tools)
+    logger.info(f"state: {state}")
+    messages = state["messages"]    
 
-    def should_continue(state: State) -> Literal["continue", "end"]:
-        logger.info(f"###### should_continue ######")
+    last_message = messages[-1]
 
-        logger.info(f"state: {state}")
-        messages = state["messages"]    
+    if last_message.content:
+        logger.info(f"last_message: {last_message.content}")
+        st.info(f"{last_message.content}")           
 
-        last_message = messages[-1]
+    if last_message.tool_calls:
+        for message in last_message.tool_calls:
+            args = message['args']
+            if chat.debug_mode=='Enable': 
+                if "code" in args:                    
+                    state_msg = f"tool name: {message['name']}"
+                    utils.status(st, state_msg)                    
+                    utils.stcode(st, args['code'])
 
-        if last_message.content:
-            logger.info(f"last_message: {last_message.content}")
-            st.info(f"{last_message.content}")           
+                elif chat.model_type=='claude':
+                    state_msg = f"tool name: {message['name']}, args: {message['args']}"
+                    utils.status(st, state_msg)
 
-        if last_message.tool_calls:
-            for message in last_message.tool_calls:
-                args = message['args']
-                if chat.debug_mode=='Enable': 
-                    if "code" in args:                    
-                        state_msg = f"tool name: {message['name']}"
-                        utils.status(st, state_msg)                    
-                        utils.stcode(st, args['code'])
-                    
-                    elif chat.model_type=='claude':
-                        state_msg = f"tool name: {message['name']}, args: {message['args']}"
-                        utils.status(st, state_msg)
+        logger.info(f"--- CONTINUE: {last_message.tool_calls[-1]['name']} ---")
+        return "continue"
 
-            logger.info(f"--- CONTINUE: {last_message.tool_calls[-1]['name']} ---")
-            return "continue"
-        
-        #if not last_message.tool_calls:
-        else:
-            # logger.info(f"Final: {last_message.content}")
-            logger.info(f"--- END ---")
-            return "end"
-           
-    def call_model(state: State, config):
-        logger.info(f"###### call_model ######")
-        logger.info(f"state: {state['messages']}")
-
-        last_message = state['messages'][-1]
-        if isinstance(last_message, ToolMessage):
-            logger.info(f"{last_message.name}: {last_message.content}")
-            if chat.debug_mode=="Enable":
-                st.info(f"{last_message.name}: {last_message.content}")
-                
-        if chat.isKorean(state["messages"][0].content)==True:
-            system = (
-                "당신의 이름은 서연이고, 질문에 친근한 방식으로 대답하도록 설계된 대화형 AI입니다."
-                "상황에 맞는 구체적인 세부 정보를 충분히 제공합니다."
-                "모르는 질문을 받으면 솔직히 모른다고 말합니다."
-                "한국어로 답변하세요."
-            )
-        else: 
-            system = (            
-                "You are a conversational AI designed to answer in a friendly way to a question."
-                "If you don't know the answer, just say that you don't know, don't try to make up an answer."
+    #if not last_message.tool_calls:
+    else:
+        # logger.info(f"Final: {last_message.content}")
+        logger.info(f"--- END ---")
+        return "end"
+
+def call_model(state: CollaboratorState, config):
+    logger.info(f"###### call_model ######")
+    logger.info(f"state: {state['messages']}")
+
+    st = config.get("configurable", {}).get("st", None)
+    tools = config.get("configurable", {}).get("tools", [])
+
+    chatModel = chat.get_chat(chat.reasoning_mode)
+    model = graph_registry.bind_tools(chatModel, tools)
+
+    last_message = state['messages'][-1]
+    if isinstance(last_message, ToolMessage):
+        logger.info(f"{last_message.name}: {last_message.content}")
+        if chat.debug_mode=="Enable":
+            st.info(f"{last_message.name}: {last_message.content}")
+
+    if chat.isKorean(state["messages"][0].content)==True:
+        system = (
+            "당신의 이름은 서연이고, 질문에 친근한 방식으로 대답하도록 설계된 대화형 AI입니다."
+            "상황에 맞는 구체적인 세부 정보를 충분히 제공합니다."
+            "모르는 질문을 받으면 솔직히 모른다고 말합니다."
+            "한국어로 답변하세요."
+        )
+    else: 
+        system = (            
+            "You are a conversational AI designed to answer in a friendly way to a question."
+            "If you don't know the answer, just say that you don't know, don't try to make up an answer."
+        )
+
+    for attempt in range(3):   
+        logger.info(f"attempt: {attempt}")
+        try:
+            prompt = ChatPromptTemplate.from_messages(
+                [
+                    ("system", system),
+                    MessagesPlaceholder(variable_name="messages"),
+                ]
             )
+            chain = prompt | model
 
-        for attempt in range(3):   
-            logger.info(f"attempt: {attempt}")
-            try:
-                prompt = ChatPromptTemplate.from_messages(
-                    [
-                        ("system", system),
-                        MessagesPlaceholder(variable_name="messages"),
-                    ]
-                )
-                chain = prompt | model
-                    
-                response = chain.invoke(state["messages"])
-                logger.info(f"call_model response: {response}")
-
-                # extended thinking
-                if chat.debug_mode=="Enable":
-                    chat.show_extended_thinking(st, response)
-
-                if isinstance(response.content, list):            
-                    for re in response.content:
-                        if "type" in re:
-                            if re['type'] == 'text':
-                                logger.info(f"--> {re['type']}: {re['text']}")
-
-                                status = re['text']
-                                logger.info(f"status: {status}")
-                                
-                                status = status.replace('`','')
-                                status = status.replace('\"','')
-                                status = status.replace("\'",'')
-                                
-                                logger.info(f"status: {status}")
-                                if status.find('<thinking>') != -1:
-                                    logger.info(f"Remove <thinking> tag.")
-                                    status = status[status.find('<thinking>')+11:status.find('</thinking>')]
-                                    logger.info(f"status without tag: {status}")
-
-                                if chat.debug_mode=="Enable":
-                                    utils.status(st, status)
-                                
-                            elif re['type'] == 'tool_use':                
-                                logger.info(f"--> {re['type']}: {re['name']}, {re['input']}")
-
-                                if chat.debug_mode=="Enable":
-                                    utils.status(st, f"{re['type']}: {re['name']}, {re['input']}")
-                            else:
-                                logger.info(re)
-                        else: # answer
-                            logger.info(response.content)
-                break
-            except Exception:
-                response = AIMessage(content="답변을 찾지 못하였습니다.")
-
-                err_msg = traceback.format_exc()
-                logger.info(f"error message: {err_msg}")
-                # raise Exception ("Not able to request to LLM")
-
-        return {"messages": [response]}
+            response = chain.invoke(state["messages"])
+            logger.info(f"call_model response: {response}")
+
+            # extended thinking
+            if chat.debug_mode=="Enable":
+                chat.show_extended_thinking(st, response)
+
+            if isinstance(response.content, list):            
+                for re in response.content:
+                    if "type" in re:
+                        if re['type'] == 'text':
+                            logger.info(f"--> {re['type']}: {re['text']}")
+
+                            status = re['text']
+                            logger.info(f"status: {status}")
+
+                            status = status.replace('`','')
+                            status = status.replace('\"','')
+                            status = status.replace("\'",'')
+
+                            logger.info(f"status: {status}")
+                            if status.find('<thinking>') != -1:
+                                logger.info(f"Remove <thinking> tag.")
+                                status = status[status.find('<thinking>')+11:status.find('</thinking>')]
+                                logger.info(f"status without tag: {status}")
+
+                            if chat.debug_mode=="Enable":
+                                utils.status(st, status)
+
+                        elif re['type'] == 'tool_use':                
+                            logger.info(f"--> {re['type']}: {re['name']}, {re['input']}")
+
+                            if chat.debug_mode=="Enable":
+                                utils.status(st, f"{re['type']}: {re['name']}, {re['input']}")
+                        else:
+                            logger.info(re)
+                    else: # answer
+                        logger.info(response.content)
+            break
+        except Exception:
+            response = AIMessage(content="답변을 찾지 못하였습니다.")
+
+            err_msg = traceback.format_exc()
+            logger.info(f"error message: {err_msg}")
+            # raise Exception ("Not able to request to LLM")
+
+    return {"messages": [response]}
+
+def create_collaborator(name):
+    logger.info(f"###### create_collaborator ######")
 
     def buildChatAgent():
-        workflow = StateGraph(State)
+        workflow = StateGraph(CollaboratorState)
 
         workflow.add_node("agent", call_model)
-        workflow.add_node("action", tool_node)
+        workflow.add_node("action", graph_registry.tool_node)
         workflow.add_edge(START, "agent")
         workflow.add_conditional_edges(
             "agent",
@@ -176,147 +179,122 @@ def create_collaborator(tools, name, st):
 
         return workflow.compile(name=name)
     
-    return buildChatAgent()
+    return graph_registry.get_graph("router-collaborator", buildChatAgent, name)
     
 reference_docs = []
 contentList = []
 image_url = []
 isInitiated=False
 
-def run_router_supervisor(query, st):
-    logger.info(f"###### run_router_supervisor ######")
-    logger.info(f"query: {query}")
-
-    class State(MessagesState):
-        next: str
-        answer: str
+members = ["search_agent", "code_agent", "weather_agent"]
 
-    members = ["search_agent", "code_agent", "weather_agent"]
+collaborator_tools = {
+    "search_agent": [tool_use.search_by_tavily, tool_use.search_by_knowledge_base],
+    "code_agent": [tool_use.repl_coder, tool_use.repl_drawer],
+    "weather_agent": [tool_use.get_weather_info]
+}
 
-    class Router(TypedDict):
-        """Worker to route to next. If no workers needed, route to FINISH."""
-        next: Literal["search_agent", "code_agent", "weather_agent", "FINISH"]
+class State(MessagesState):
+    next: str
+    answer: str
 
-    llm = chat.get_chat(extended_thinking="Disable")
-
-    system_prompt = (
-        "You are a supervisor tasked with managing a conversation between the"
-        f" following workers: {members}."
-        "Given the following user request, respond with the worker to act next." 
-        "Each worker will perform a task and respond with their results and status. "
-        "When finished, respond with FINISH."
-    )
+class Router(TypedDict):
+    """Worker to route to next. If no workers needed, route to FINISH."""
+    next: Literal["search_agent", "code_agent", "weather_agent", "FINISH"]
 
-    def supervisor_node(state: State):
-        logger.info(f"###### supervisor_node ######")
-        logger.info(f"state: {state}")
+system_prompt = (
+    "You are a supervisor tasked with managing a conversation between the"
+    f" following workers: {members}."
+    "Given the following user request, respond with the worker to act next." 
+    "Each worker will perform a task and respond with their results and status. "
+    "When finished, respond with FINISH."
+)
 
-        goto = END
-        try: 
-            prompt = ChatPromptTemplate.from_messages(
-                [
-                    ("system", system_prompt),
-                    MessagesPlaceholder(variable_name="messages"),
-                ]
-            )
-            structured_llm = llm.with_structured_output(Router, include_raw=True)
-            
-            chain = prompt | structured_llm
-                        
-            messages = state['messages']
-            logger.info(f"messages: {messages}")
-
-            response = chain.invoke({"messages": messages})
-            logger.info(f"response: {response}")
-            parsed = response.get("parsed")
-            logger.info(f"parsed: {parsed}")
-
-            goto = parsed["next"]
-            if goto == "FINISH":            
-                goto = END
-        
-            logger.info(f"goto: {goto}")
-            st.info(f"next: {goto}")
-        except Exception:
-            err_msg = traceback.format_exc()
-            logger.info(f"error message of supervisor_node: {err_msg}")
-            # raise Exception ("Not able to request to LLM")
-                
-        return Command(goto=goto, update={"next": goto})
+def supervisor_node(state: State, config):
+    logger.info(f"###### supervisor_node ######")
+    logger.info(f"state: {state}")
 
-    # creater search agent
-    search_agent = create_collaborator(
-        [tool_use.search_by_tavily, tool_use.search_by_knowledge_base], 
-        "search_agent", st
-    )
-    # creater stock agent
-    stock_agent = create_collaborator(
-        [tool_use.stock_data_lookup], 
-        "stock_agent", st
-    )
-    # creater weather agent
-    weather_agent = create_collaborator(
-        [tool_use.get_weather_info], 
-        "weather_agent", st
-    )
-    # creater code agent
-    code_agent = create_collaborator(
-        [tool_use.repl_coder, tool_use.repl_drawer], 
-        "code_agent", st
-    )
+    st = config.get("configurable", {}).get("st", None)
 
-    def search_node(state: State) -> Command[Literal["supervisor"]]:
-        result = search_agent.invoke(state)
-        logger.info(f"result of search_node: {result}")
+    goto = END
+    try: 
+        llm = chat.get_chat(extended_thinking="Disable")
 
-        return Command(
-            update={
-                "messages": [
-                    AIMessage(content=result["messages"][-1].content, name="search_agent")
-                ]
-            },
-            goto = "supervisor",
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", system_prompt),
+                MessagesPlaceholder(variable_name="messages"),
+            ]
         )
+        structured_llm = llm.with_structured_output(Router, include_raw=True)
+        
+        chain = prompt | structured_llm
+                    
+        messages = state['messages']
+        logger.info(f"messages: {messages}")
 
-    def code_node(state: State) -> Command[Literal["supervisor"]]:
-        result = code_agent.invoke(state)
-        logger.info(f"result of code_node: {result}")
+        response = chain.invoke({"messages": messages})
+        logger.info(f"response: {response}")
+        parsed = response.get("parsed")
+        logger.info(f"parsed: {parsed}")
 
-        return Command(
-            update={
-                "messages": [
-                    AIMessage(content=result["messages"][-1].content, name="code_agent")
-                ]
-            },
-            goto = "supervisor",
-        )
+        goto = parsed["next"]
+        if goto == "FINISH":            
+            goto = END
     
-    def weather_node(state: State) -> Command[Literal["supervisor"]]:
-        logger.info(f"state of weather_node: {state}")
+        logger.info(f"goto: {goto}")
+        st.info(f"next: {goto}")
+    except Exception:
+        err_msg = traceback.format_exc()
+        logger.info(f"error message of supervisor_node: {err_msg}")
+        # raise Exception ("Not able to request to LLM")
+            
+    return Command(goto=goto, update={"next": goto})
+
+def run_collaborator(name, state, config):
+    collaborator = create_collaborator(name)
+    result = collaborator.invoke(state, {
+        "configurable": {
+            "st": config.get("configurable", {}).get("st", None),
+            "tools": collaborator_tools[name]
+        }
+    })
+    logger.info(f"result of {name}: {result}")
+
+    return Command(
+        update={
+            "messages": [
+                AIMessage(content=result["messages"][-1].content, name=name)
+            ]
+        },
+        goto = "supervisor",
+    )
 
-        result = weather_agent.invoke(state)
-        logger.info(f"result of weather_agent: {result}")
+def search_node(state: State, config) -> Command[Literal["supervisor"]]:
+    return run_collaborator("search_agent", state, config)
 
-        return Command(
-            update={
-                "messages": [
-                    AIMessage(content=result["messages"][-1].content, name="weather_agent")
-                ]
-            },
-            goto = "supervisor",
-        )
+def code_node(state: State, config) -> Command[Literal["supervisor"]]:
+    return run_collaborator("code_agent", state, config)
+
+def weather_node(state: State, config) -> Command[Literal["supervisor"]]:
+    logger.info(f"state of weather_node: {state}")
+    return run_collaborator("weather_agent", state, config)
 
-    def build_graph():
-        workflow = StateGraph(State)
-        workflow.add_edge(START, "supervisor")
-        workflow.add_node("supervisor", supervisor_node)
-        workflow.add_node("search_agent", search_node)
-        workflow.add_node("code_agent", code_node)
-        workflow.add_node("weather_agent", weather_node)
+def build_graph():
+    workflow = StateGraph(State)
+    workflow.add_edge(START, "supervisor")
+    workflow.add_node("supervisor", supervisor_node)
+    workflow.add_node("search_agent", search_node)
+    workflow.add_node("code_agent", code_node)
+    workflow.add_node("weather_agent", weather_node)
 
-        return workflow.compile()
+    return workflow.compile()
+
+def run_router_supervisor(query, st):
+    logger.info(f"###### run_router_supervisor ######")
+    logger.info(f"query: {query}")
 
-    app = build_graph()
+    app = graph_registry.get_graph("router-supervisor", build_graph)
     # for s in app.stream(
     #     {"messages": [("user",query)]}, subgraphs=True,
     # ):
@@ -326,7 +304,8 @@ def run_router_supervisor(query, st):
     msg= ""
     inputs = [HumanMessage(content=query)]
     config = {
-        "recursion_limit": 50
+        "recursion_limit": 50,
+        "configurable": {"st": st}
     }    
     result = app.invoke({"messages": inputs}, config)
     logger.info(f"messages: {result['messages']}")
@@ -343,4 +322,4 @@ def run_router_supervisor(query, st):
     # msg = chat.extract_thinking_tag(msg, st)
     image_url = ""
 
-    return msg, image_url, reference
\ No newline at end of file
+    return msg, image_url, reference
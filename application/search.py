@@ -4,6 +4,7 @@ import json
 import utils
 import chat
 import tool_use
+import graph_registry
 
 from langchain.docstore.document import Document
 from tavily import TavilyClient  
@@ -14,7 +15,6 @@ from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
 from langchain_core.prompts import MessagesPlaceholder, ChatPromptTemplate
 from typing_extensions import Annotated, TypedDict
 from langgraph.graph.message import add_messages
-from langgraph.prebuilt import ToolNode
 from typing import Literal
 
 import logging
@@ -187,106 +187,117 @@ def tavily_search(query, k):
 
     return docs
 
-def init_enhanced_search(st):
+####################### LangGraph #######################
+# Enhanced Search
+# The graph is compiled once. st and tools of the request
+# are given by config["configurable"].
+#########################################################
+class State(TypedDict):
+    messages: Annotated[list, add_messages]
+
+def should_continue(state: State) -> Literal["continue", "end"]:
+    messages = state["messages"]    
+    # print('(should_continue) messages: ', messages)
+        
+    last_message = messages[-1]
+    if not last_message.tool_calls:
+        return "end"
+    else:                
+        return "continue"
+
+def call_model(state: State, config):
+    logger.info(f"##### call_model #####")
+
+    st = config.get("configurable", {}).get("st", None)
+    tools = config.get("configurable", {}).get("tools", [])
+
+    messages = state["messages"]
+    # print('messages: ', messages)
+
+    last_message = messages[-1]
+    logger.info(f"last_message: {last_message}")
+
+    if isinstance(last_message, ToolMessage) and last_message.content=="":              
+        logger.info(f"last_message is empty")
+        logger.info(f"question: {state['messages'][0].content}")
+        answer = chat.get_basic_answer(state['messages'][0].content)          
+        return {"messages": [AIMessage(content=answer)]}
+        
+    if chat.isKorean(messages[0].content)==True:
+        system = (
+            "당신은 질문에 답변하기 위한 정보를 수집하는 연구원입니다."
+            "상황에 맞는 구체적인 세부 정보를 충분히 제공합니다."
+            "모르는 질문을 받으면 솔직히 모른다고 말합니다."
+            "최종 답변에는 조사한 내용을 반드시 포함하여야 하고, <result> tag를 붙여주세요."
+        )
+    else: 
+        system = (            
+            "You are a researcher charged with providing information that can be used when making answer."
+            "If you don't know the answer, just say that you don't know, don't try to make up an answer."
+            "You will be acting as a thoughtful advisor."
+            "Put it in <result> tags."
+        )
+            
     llm = chat.get_chat(extended_thinking="Disable") 
+    model = graph_registry.bind_tools(llm, tools)
 
-    model = llm.bind_tools(tool_use.tools)
-
-    class State(TypedDict):
-        messages: Annotated[list, add_messages]
-
-    tool_node = ToolNode(tool_use.tools)
-
-    def should_continue(state: State) -> Literal["continue", "end"]:
-        messages = state["messages"]    
-        # print('(should_continue) messages: ', messages)
-            
-        last_message = messages[-1]
-        if not last_message.tool_calls:
-            return "end"
-        else:                
-            return "continue"
-
-    def call_model(state: State):
-        logger.info(f"##### call_model #####")
-
-        messages = state["messages"]
-        # print('messages: ', messages)
-
-        last_message = messages[-1]
-        logger.info(f"last_message: {last_message}")
-
-        if isinstance(last_message, ToolMessage) and last_message.content=="":              
-            logger.info(f"last_message is empty")
-            logger.info(f"question: {state['messages'][0].content}")
-            answer = chat.get_basic_answer(state['messages'][0].content)          
-            return {"messages": [AIMessage(content=answer)]}
-            
-        if chat.isKorean(messages[0].content)==True:
-            system = (
-                "당신은 질문에 답변하기 위한 정보를 수집하는 연구원입니다."
-                "상황에 맞는 구체적인 세부 정보를 충분히 제공합니다."
-                "모르는 질문을 받으면 솔직히 모른다고 말합니다."
-                "최종 답변에는 조사한 내용을 반드시 포함하여야 하고, <result> tag를 붙여주세요."
-            )
-        else: 
-            system = (            
-                "You are a researcher charged with providing information that can be used when making answer."
-                "If you don't know the answer, just say that you don't know, don't try to make up an answer."
-                "You will be acting as a thoughtful advisor."
-                "Put it in <result> tags."
-            )
-                
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", system),
-                MessagesPlaceholder(variable_name="messages"),
-            ]
-        )
-        chain = prompt | model
-                
-        response = chain.invoke(messages)
-        logger.info(f"call_model response: {response}")
-              
-        # state messag
-        if response.tool_calls:
-            logger.info(f"tool_calls response: {response.tool_calls}")
-
-            toolinfo = response.tool_calls[-1]            
-            if toolinfo['type'] == 'tool_call':
-                logger.info(f"tool name: {toolinfo['name']}")    
-
-            if chat.debug_mode=="Enable":
-                st.info(f"{response.tool_calls[-1]['name']}: {response.tool_calls[-1]['args']}")
-                   
-        return {"messages": [response]}
-
-    def buildChatAgent():
-        workflow = StateGraph(State)
-
-        workflow.add_node("agent", call_model)
-        workflow.add_node("action", tool_node)
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", system),
+            MessagesPlaceholder(variable_name="messages"),
+        ]
+    )
+    chain = prompt | model
             
-        workflow.set_entry_point("agent")
-        workflow.add_conditional_edges(
-            "agent",
-            should_continue,
-            {
-                "continue": "action",
-                "end": END,
-            },
-        )
-        workflow.add_edge("action", "agent")
-        return workflow.compile()
-    
-    return buildChatAgent()
+    response = chain.invoke(messages)
+    logger.info(f"call_model response: {response}")
+          
+    # state messag
+    if response.tool_calls:
+        logger.info(f"tool_calls response: {response.tool_calls}")
+
+        toolinfo = response.tool_calls[-1]            
+        if toolinfo['type'] == 'tool_call':
+            logger.info(f"tool name: {toolinfo['name']}")    
+
+        if chat.debug_mode=="Enable" and st is not None:
+            st.info(f"{response.tool_calls[-1]['name']}: {response.tool_calls[-1]['args']}")
+               
+    return {"messages": [response]}
+
+def buildChatAgent():
+    workflow = StateGraph(State)
+
+    workflow.add_node("agent", call_model)
+    workflow.add_node("action", graph_registry.tool_node)
+        
+    workflow.set_entry_point("agent")
+    workflow.add_conditional_edges(
+        "agent",
+        should_continue,
+        {
+            "continue": "action",
+            "end": END,
+        },
+    )
+    workflow.add_edge("action", "agent")
+    return workflow.compile()
+
+def init_enhanced_search():
+    return graph_registry.get_graph("enhanced-search", buildChatAgent)
 
 def enhanced_search(query, st):
     logger.info(f"###### enhanced_search ######")
     inputs = [HumanMessage(content=query)]
 
-    app_enhanced_search = init_enhanced_search(st)        
-    result = app_enhanced_search.invoke({"messages": inputs})   
+    app_enhanced_search = init_enhanced_search()
+    config = {
+        "configurable": {
+            "st": st,
+            "tools": tool_use.tools
+        }
+    }
+    result = app_enhanced_search.invoke({"messages": inputs}, config)   
     logger.info(f"result: {result}")
             
     message = result["messages"][-1]
@@ -296,4 +307,3 @@ def enhanced_search(query, st):
         return message.content
     else:
         return message.content[message.content.find('<result>')+8:message.content.find('</result>')]
-
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import logging
+import sys
+import time
+import traceback
+import utils
+import tool_index
+
+from langchain_core.messages import AIMessage, ToolMessage
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("tool-executor")
+
+config = utils.load_config()
+
+####################### Tool Executor #######################
+# Action node which runs all tool calls of the last AIMessage
+# at the same time. Each call has a timeout by the tool name or
+# by its MCP server, and the calls which are not finished by the
+# deadline of the step are cancelled. Timeouts and errors are
+# returned to the model as tool messages with status "error" so
+# that it can answer with the partial results.
+#############################################################
+default_timeout = config["tool_timeout"] if "tool_timeout" in config else 120          # seconds
+step_timeout = config["tool_step_timeout"] if "tool_step_timeout" in config else 300   # seconds
+tool_timeouts = config["tool_timeouts"] if "tool_timeouts" in config else {}           # tool name -> seconds
+server_timeouts = config["mcp_server_timeouts"] if "mcp_server_timeouts" in config else {}   # server name -> seconds
+
+def get_server_name(tool):
+    return (getattr(tool, "metadata", None) or {}).get("mcp_server")
+
+def get_timeout(tool):
+    if tool.name in tool_timeouts:
+        return tool_timeouts[tool.name]
+    server_name = get_server_name(tool)
+    if server_name in server_timeouts:
+        return server_timeouts[server_name]
+    return default_timeout
+
+def get_remaining_time(config):
+    """Seconds left until config["configurable"]["deadline"] of the request, or None without a deadline."""
+    deadline = config.get("configurable", {}).get("deadline", None)
+    return deadline - time.time() if deadline else None
+
+def add_timing(config, step, elapsed):
+    timings = config.get("configurable", {}).get("timings", None)
+    if timings is not None:
+        timings.append({"step": step, "elapsed": round(elapsed, 2)})
+
+def get_error_message(tool_call, content):
+    return ToolMessage(
+        name=tool_call["name"],
+        tool_call_id=tool_call["id"],
+        content=content,
+        status="error"
+    )
+
+def add_session_arguments(tool, tool_call, config):
+    """Put the modes of the session in the arguments of the MCP tool (see mcp_pool.session_arguments)."""
+    names = (getattr(tool, "metadata", None) or {}).get("session_arguments", [])
+    values = config.get("configurable", {}).get("session_arguments", {}) if config else {}
+    arguments = {name: values[name] for name in names if name in values}
+    if not arguments:
+        return tool_call
+    return {**tool_call, "args": {**tool_call.get("args", {}), **arguments}}
+
+async def run_tool(tool, tool_call, config, timeout=None):
+    timeout = timeout or get_timeout(tool)
+    tool_call = add_session_arguments(tool, tool_call, config)
+    start = time.time()
+    try:
+        # a tool call as the input returns a ToolMessage with the artifact of MCP tools
+        message = await asyncio.wait_for(
+            tool.ainvoke({**tool_call, "type": "tool_call"}, config),
+            timeout=timeout
+        )
+        logger.info(f"{tool_call['name']}: {time.time()-start:.2f}s")
+        add_timing(config, tool_call["name"], time.time()-start)
+        tool_index.record_usage(tool_call["name"])
+
+        if not isinstance(message, ToolMessage):
+            content = message if isinstance(message, str) else json.dumps(message, ensure_ascii=False, default=str)
+            message = ToolMessage(name=tool_call["name"], tool_call_id=tool_call["id"], content=content)
+        return message
+
+    except asyncio.TimeoutError:
+        logger.info(f"{tool_call['name']}: timeout ({timeout}s)")
+        add_timing(config, tool_call["name"], time.time()-start)
+        return get_error_message(tool_call, f"Error: {tool_call['name']} did not respond in {timeout} seconds. Answer with the other results or try another tool.")
+    except Exception as e:
+        add_timing(config, tool_call["name"], time.time()-start)
+        err_msg = traceback.format_exc()
+        logger.info(f"error message: {err_msg}")
+        return get_error_message(tool_call, f"Error: {repr(e)}\n Please fix your mistakes.")
+
+async def execute_tool_calls(state, config):
+    """Run every tool call of the last AIMessage concurrently with the tools in config["configurable"]["tools"]."""
+    tools = {tool.name: tool for tool in config.get("configurable", {}).get("tools", [])}
+
+    last_message = state["messages"][-1]
+    tool_calls = last_message.tool_calls if isinstance(last_message, AIMessage) else []
+
+    # the tools must finish before the time which is reserved for the answer
+    timeout = step_timeout
+    remaining = get_remaining_time(config)
+    if remaining is not None:
+        answer_reserve = config.get("configurable", {}).get("answer_reserve", 0)
+        timeout = max(min(step_timeout, remaining - answer_reserve), 1)
+
+    results = dict()   # tool_call_id -> ToolMessage
+    tasks = dict()     # task -> tool call
+    for tool_call in tool_calls:
+        tool = tools.get(tool_call["name"])
+        if tool is None:
+            results[tool_call["id"]] = get_error_message(tool_call, f"Error: {tool_call['name']} is not a valid tool, try one of [{', '.join(tools.keys())}].")
+            continue
+        tasks[asyncio.create_task(run_tool(tool, tool_call, config, min(get_timeout(tool), timeout)))] = tool_call
+
+    if tasks:
+        done, pending = await asyncio.wait(tasks.keys(), timeout=timeout)
+        for task in done:
+            results[tasks[task]["id"]] = task.result()
+
+        for task in pending:   # deadline of the step
+            task.cancel()
+            tool_call = tasks[task]
+            logger.info(f"{tool_call['name']}: cancelled by the step deadline ({timeout:.0f}s)")
+            results[tool_call["id"]] = get_error_message(tool_call, f"Error: {tool_call['name']} was cancelled because the tool calls took more than {timeout:.0f} seconds.")
+
+    # the order of the tool calls
+    return {"messages": [results[tool_call["id"]] for tool_call in tool_calls]}
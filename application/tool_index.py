@@ -0,0 +1,170 @@
+import logging
+import math
+import re
+import sys
+import threading
+import utils
+import graph_registry
+
+from collections import Counter
+from langchain_core.tools import StructuredTool
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("tool-index")
+
+config = utils.load_config()
+
+####################### Tool Retrieval #######################
+# When many MCP tools are selected, only the tools relevant to
+# the question are bound to the model. The tools are ranked by
+# BM25 over their names, descriptions and arguments, and the
+# expand_toolset tool lets the model bind more tools by name or
+# keywords when the first selection is not enough. When the search
+# finds nothing, the most used tools are bound instead.
+##############################################################
+top_k = config["tool_retrieval_top_k"] if "tool_retrieval_top_k" in config else 8
+# tool retrieval is used when the number of tools is larger than this value
+threshold = config["tool_retrieval_threshold"] if "tool_retrieval_threshold" in config else 16
+
+k1 = 1.5
+b = 0.75
+name_weight = 3   # tokens of the tool name are repeated
+
+stopwords = set([
+    "a", "an", "the", "is", "are", "was", "of", "in", "on", "at", "to", "for", "by", "with", "and", "or", 
+    "what", "how", "which", "this", "that", "it", "me", "my", "i", "you", "please", "can", "do", "be"
+])
+
+def tokenize(text):
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text or "")   # camelCase
+    words = re.findall(r"[a-zA-Z0-9]+|[가-힣]+", text.lower())
+
+    tokens = []
+    for word in words:
+        if word in stopwords:
+            continue
+        tokens.append(word)
+        if re.match(r"[가-힣]", word) and len(word) > 2:   # korean: bigrams for the postpositions
+            tokens.extend([word[i:i+2] for i in range(len(word)-1)])
+    return tokens
+
+def get_document(tool):
+    args = " ".join(getattr(tool, "args", {}).keys())
+    return tokenize(tool.name.replace("_", " ")) * name_weight + tokenize(tool.description) + tokenize(args)
+
+class ToolIndex:
+    def __init__(self, tools):
+        self.names = [tool.name for tool in tools]
+        self.documents = [Counter(get_document(tool)) for tool in tools]
+        self.lengths = [sum(document.values()) for document in self.documents]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+
+        df = Counter()
+        for document in self.documents:
+            df.update(document.keys())
+        n = len(self.documents)
+        self.idf = {token: math.log(1 + (n - count + 0.5) / (count + 0.5)) for token, count in df.items()}
+
+    def search(self, query, k):
+        """Return the names of the top k tools for the query with a positive score."""
+        tokens = tokenize(query)
+
+        scores = []
+        for name, document, length in zip(self.names, self.documents, self.lengths):
+            score = 0
+            for token in tokens:
+                tf = document.get(token, 0)
+                if tf:
+                    score += self.idf[token] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / self.avg_length))
+            if score > 0:
+                scores.append((score, name))
+
+        scores.sort(reverse=True)
+        return [name for _, name in scores[:k]]
+
+_lock = threading.Lock()
+indexes = dict()   # tools signature -> ToolIndex
+usage = Counter()  # tool name -> number of calls, the prior of the default tools
+
+def record_usage(tool_name):
+    with _lock:
+        usage[tool_name] += 1
+
+def get_default_tools(names, k):
+    """
+    The most used tools, in the order of the servers for the same usage. They are used when the search finds nothing,
+    e.g. for a Korean question and the English descriptions of the tools.
+    """
+    with _lock:
+        ranked = sorted(range(len(names)), key=lambda i: (-usage[names[i]], i))
+    return [names[i] for i in ranked[:k]]
+
+def get_index(tools):
+    key = graph_registry.get_tool_signature(tools)
+    with _lock:
+        if key not in indexes:
+            indexes[key] = ToolIndex(tools)
+        return indexes[key]
+
+class ToolSelection:
+    """Tools which are bound to the model in a request. The selection grows by expand_toolset."""
+
+    def __init__(self, tools, query, always=None):
+        self.tools = {tool.name: tool for tool in tools}
+        self.index = get_index(tools)
+        self.selected = self.index.search(query, top_k)
+        if not self.selected:
+            self.selected = get_default_tools(self.index.names, top_k)
+            logger.info("no tool is found by the search, use the default tools")
+        self.always = list(always or [])
+        self.expand_tool = self.create_expand_tool()
+        logger.info(f"selected tools: {self.selected} ({len(self.selected)}/{len(self.tools)})")
+
+    def get_bound_tools(self):
+        return [self.tools[name] for name in self.selected] + self.always + [self.expand_tool]
+
+    def expand(self, tool_names=None, query=""):
+        added = []
+        for name in tool_names or []:
+            if name in self.tools and name not in self.selected:
+                added.append(name)
+        if query:
+            for name in self.index.search(query, top_k):
+                if name not in self.selected and name not in added:
+                    added.append(name)
+
+        self.selected.extend(added)
+        logger.info(f"expand toolset: {added}")
+        if not added:
+            return "No more tools are found. Use the tools which are already available."
+        return f"The following tools are available now: {', '.join(added)}"
+
+    def create_expand_tool(self):
+        catalog = ", ".join(self.tools.keys())
+
+        def expand_toolset(tool_names: list[str] = [], query: str = "") -> str:
+            return self.expand(tool_names, query)
+
+        return StructuredTool.from_function(
+            func=expand_toolset,
+            name="expand_toolset",
+            description=(
+                "Add tools when the available tools are not enough for the request. "
+                "Give the names of the tools and/or keywords in English which describe the required tools.\n"
+                "tool_names: names of the tools to add\n"
+                "query: keywords of the required tools\n"
+                f"All tools: {catalog}"
+            )
+        )
+
+def select_tools(tools, query, always=None):
+    """Return a ToolSelection for the query, or None when the tools are few enough to bind all of them."""
+    if len(tools) <= threshold:
+        return None
+    return ToolSelection(tools, query, always)
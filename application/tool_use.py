@@ -8,13 +8,14 @@ import knowledge_base as kb
 import chat
 import utils
 import search
+import graph_registry
+import request_context
 import base64
 import uuid
 import yfinance as yf
 
 from typing_extensions import Annotated, TypedDict
 from langgraph.graph.message import add_messages
-from langgraph.prebuilt import ToolNode
 from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
 from typing import Literal
 from langchain_core.tools import tool
@@ -58,8 +59,18 @@ s3_image_prefix = 'images'
 
 doc_prefix = s3_prefix+'/'
 
-reference_docs = []
-contentList = []
+# documents and images of the request in the user session, e.g. tool_use.reference_docs
+session = request_context.SessionState("tool_use", lambda: {
+    "reference_docs": [],
+    "contentList": [],
+    "image_url": []
+})
+
+def __getattr__(name):
+    if name in session:
+        return getattr(session, name)
+    raise AttributeError(f"module 'tool_use' has no attribute '{name}'")
+
 # api key to get weather information in agent
 secretsmanager = boto3.client(
     service_name='secretsmanager',
@@ -113,8 +124,6 @@ def get_basic_answer(query):
 ####################### LangGraph #######################
 # Agentic Workflow: Tool Use
 #########################################################
-image_url = []
-
 @tool 
 def get_book_list(keyword: str) -> str:
     """
@@ -228,7 +237,6 @@ def search_by_knowledge_base(keyword: str) -> str:
     """    
     logger.info(f"###### search_by_knowledge_base ######") 
     
-    global reference_docs
  
     logger.info(f"keyword: {keyword}")
     keyword = keyword.replace('\'','')
@@ -251,7 +259,7 @@ def search_by_knowledge_base(keyword: str) -> str:
     logger.info(f"relevant_context: {relevant_context}")
     
     if len(filtered_docs):
-        reference_docs += filtered_docs
+        session.reference_docs += filtered_docs
         return relevant_context
     else:        
         # relevant_context = "No relevant documents found."
@@ -266,7 +274,6 @@ def search_by_tavily(keyword: str) -> str:
     keyword: search keyword
     return: the information of keyword
     """    
-    global reference_docs    
     answer = ""
     
     keyword = keyword.replace('\'','')
@@ -283,7 +290,7 @@ def search_by_tavily(keyword: str) -> str:
         answer += f"{content}, URL: {url}\n" 
 
     if len(filtered_docs):
-        reference_docs += filtered_docs
+        session.reference_docs += filtered_docs
     
     if answer == "":
         # answer = "No relevant documents found." 
@@ -397,11 +404,10 @@ print(image_base64)
         file_name = url[url.rfind('/')+1:]
         logger.info(f"file_name: {file_name}")
 
-        global image_url
-        image_url.append(path+'/'+s3_image_prefix+'/'+parse.quote(file_name))
-        logger.info(f"image_url: {image_url}")
+        session.image_url.append(path+'/'+s3_image_prefix+'/'+parse.quote(file_name))
+        logger.info(f"image_url: {session.image_url}")
 
-        result = f"생성된 그래프의 URL: {image_url}"
+        result = f"생성된 그래프의 URL: {session.image_url}"
 
         # im = Image.open(BytesIO(base64.b64decode(base64Img)))  # for debuuing
         # im.save(image_name, 'PNG')
@@ -523,10 +529,9 @@ print(image_base64)
             file_name = url[url.rfind('/')+1:]
             logger.info(f"file_name: {file_name}")
 
-            global image_url
-            image_url.append(path+'/'+s3_image_prefix+'/'+parse.quote(file_name))
-            logger.info(f"image_url: {image_url}")
-            result = f"생성된 그래프의 URL: {image_url}"
+            session.image_url.append(path+'/'+s3_image_prefix+'/'+parse.quote(file_name))
+            logger.info(f"image_url: {session.image_url}")
+            result = f"생성된 그래프의 URL: {session.image_url}"
 
             # im = Image.open(BytesIO(base64.b64decode(base64Img)))  # for debuuing
             # im.save(image_name, 'PNG')
@@ -544,192 +549,201 @@ print(image_base64)
 ####################### LangGraph #######################
 # Chat Agent Executor
 #########################################################
-def run_agent_executor(query, historyMode, st):
-    logger.info(f"###### run_agent_executor ######")
-    logger.info(f"historyMode: {historyMode}")
-    
-    class State(TypedDict):
-        # messages: Annotated[Sequence[BaseMessage], operator.add]
-        messages: Annotated[list, add_messages]
+class State(TypedDict):
+    # messages: Annotated[Sequence[BaseMessage], operator.add]
+    messages: Annotated[list, add_messages]
 
-    if chat.internet_mode == "Eanble":
-        # tools = [get_current_time, get_book_list, get_weather_info, search_by_tavily, search_by_knowledge_base, stock_data_lookup, code_drawer, code_interpreter]        
-        tools = [get_current_time, get_book_list, get_weather_info, search_by_tavily, search_by_knowledge_base, stock_data_lookup, repl_drawer, repl_coder] 
-    else:
-        tools = [get_current_time, get_book_list, get_weather_info, search_by_knowledge_base, stock_data_lookup, repl_drawer, repl_coder] 
+def should_continue(state: State, config) -> Literal["continue", "end"]:
+    logger.info(f"###### should_continue ######")
 
-    chatModel = chat.get_chat(chat.reasoning_mode)     
-    model = chatModel.bind_tools(tools)
-    tool_node = ToolNode(tools)
+    st = config.get("configurable", {}).get("st", None)
 
-    def should_continue(state: State) -> Literal["continue", "end"]:
-        logger.info(f"###### should_continue ######")
+    logger.info(f"state: {state}")
+    messages = state["messages"]    
 
-        logger.info(f"state: {state}")
-        messages = state["messages"]    
+    last_message = messages[-1]
+    logger.info(f"last_message: {last_message}")
 
-        last_message = messages[-1]
-        logger.info(f"last_message: {last_message}")
+    if isinstance(last_message, AIMessage) and last_message.tool_calls:
+        logger.info(f"{last_message.content}")
+        if chat.debug_mode=='Enable' and last_message.content:
+            st.info(f"last_message: {last_message.content}")
 
-        if isinstance(last_message, AIMessage) and last_message.tool_calls:
-            logger.info(f"{last_message.content}")
-            if chat.debug_mode=='Enable' and last_message.content:
-                st.info(f"last_message: {last_message.content}")
+        for message in last_message.tool_calls:
+            args = message['args']
+            if chat.debug_mode=='Enable': 
+                if "code" in args:                    
+                    state_msg = f"tool name: {message['name']}"
+                    utils.status(st, state_msg)                    
+                    utils.stcode(st, args['code'])
 
-            for message in last_message.tool_calls:
-                args = message['args']
-                if chat.debug_mode=='Enable': 
-                    if "code" in args:                    
-                        state_msg = f"tool name: {message['name']}"
-                        utils.status(st, state_msg)                    
-                        utils.stcode(st, args['code'])
-                    
-                    elif chat.model_type=='claude':
-                        state_msg = f"tool name: {message['name']}, args: {message['args']}"
-                        utils.status(st, state_msg)
+                elif chat.model_type=='claude':
+                    state_msg = f"tool name: {message['name']}, args: {message['args']}"
+                    utils.status(st, state_msg)
 
-            logger.info(f"--- CONTINUE: {last_message.tool_calls[-1]['name']} ---")
-            return "continue"
-        
-        #if not last_message.tool_calls:
-        else:
-            # logger.info(f"Final: {last_message.content}")
-            logger.info(f"--- END ---")
-            return "end"
-           
-    def call_model(state: State, config):
-        logger.info(f"###### call_model ######")
-        logger.info(f"state: {state['messages']}")
-                
-        if chat.isKorean(state["messages"][0].content)==True:
-            system = (
-                "당신의 이름은 서연이고, 질문에 친근한 방식으로 대답하도록 설계된 대화형 AI입니다."
-                "상황에 맞는 구체적인 세부 정보를 충분히 제공합니다."
-                "모르는 질문을 받으면 솔직히 모른다고 말합니다."
-                "한국어로 답변하세요."
-            )
-        else: 
-            system = (            
-                "You are a conversational AI designed to answer in a friendly way to a question."
-                "If you don't know the answer, just say that you don't know, don't try to make up an answer."
-            )
+        logger.info(f"--- CONTINUE: {last_message.tool_calls[-1]['name']} ---")
+        return "continue"
 
-        for attempt in range(3):   
-            logger.info(f"attempt: {attempt}")
-            try:
-                prompt = ChatPromptTemplate.from_messages(
-                    [
-                        ("system", system),
-                        MessagesPlaceholder(variable_name="messages"),
-                    ]
-                )
-                chain = prompt | model
-                    
-                response = chain.invoke(state["messages"])
-                logger.info(f"call_model response: {response}")
-
-                # extended thinking
-                if chat.debug_mode=="Enable":
-                    chat.show_extended_thinking(st, response)
-
-                if isinstance(response.content, list):            
-                    for re in response.content:
-                        if "type" in re:
-                            if re['type'] == 'text':
-                                logger.info(f"--> {re['type']}: {re['text']}")
-
-                                status = re['text']
-                                logger.info(f"status: {status}")
-                                
-                                status = status.replace('`','')
-                                status = status.replace('\"','')
-                                status = status.replace("\'",'')
-                                
-                                logger.info(f"status: {status}")
-                                if status.find('<thinking>') != -1:
-                                    logger.info(f"Remove <thinking> tag.")
-                                    status = status[status.find('<thinking>')+11:status.find('</thinking>')]
-                                    logger.info(f"status without tag: {status}")
-
-                                if chat.debug_mode=="Enable":
-                                    utils.status(st, status)
-                                
-                            elif re['type'] == 'tool_use':                
-                                logger.info(f"--> {re['type']}: {re['name']}, {re['input']}")
-
-                                if chat.debug_mode=="Enable":
-                                    utils.status(st, f"{re['type']}: {re['name']}, {re['input']}")
-                            else:
-                                logger.info(re)
-                        else: # answer
-                            logger.info(response.content)
-                break
-            except Exception:
-                response = AIMessage(content="답변을 찾지 못하였습니다.")
-
-                err_msg = traceback.format_exc()
-                logger.info(f"error message: {err_msg}")
-                # raise Exception ("Not able to request to LLM")
-
-        return {"messages": [response]}
-
-    def buildChatAgent():
-        workflow = StateGraph(State)
+    #if not last_message.tool_calls:
+    else:
+        # logger.info(f"Final: {last_message.content}")
+        logger.info(f"--- END ---")
+        return "end"
 
-        workflow.add_node("agent", call_model)
-        workflow.add_node("action", tool_node)
-        workflow.add_edge(START, "agent")
-        workflow.add_conditional_edges(
-            "agent",
-            should_continue,
-            {
-                "continue": "action",
-                "end": END,
-            },
-        )
-        workflow.add_edge("action", "agent")
+def call_model(state: State, config):
+    logger.info(f"###### call_model ######")
+    logger.info(f"state: {state['messages']}")
 
-        return workflow.compile()
-    
-    def buildChatAgentWithHistory():
-        workflow = StateGraph(State)
+    st = config.get("configurable", {}).get("st", None)
+    tools = config.get("configurable", {}).get("tools", [])
 
-        workflow.add_node("agent", call_model)
-        workflow.add_node("action", tool_node)
-        workflow.add_edge(START, "agent")
-        workflow.add_conditional_edges(
-            "agent",
-            should_continue,
-            {
-                "continue": "action",
-                "end": END,
-            },
-        )
-        workflow.add_edge("action", "agent")
+    chatModel = chat.get_chat(chat.reasoning_mode)     
+    model = graph_registry.bind_tools(chatModel, tools)
 
-        return workflow.compile(
-            checkpointer=chat.checkpointer,
-            store=chat.memorystore
+    if chat.isKorean(state["messages"][0].content)==True:
+        system = (
+            "당신의 이름은 서연이고, 질문에 친근한 방식으로 대답하도록 설계된 대화형 AI입니다."
+            "상황에 맞는 구체적인 세부 정보를 충분히 제공합니다."
+            "모르는 질문을 받으면 솔직히 모른다고 말합니다."
+            "한국어로 답변하세요."
         )
+    else: 
+        system = (            
+            "You are a conversational AI designed to answer in a friendly way to a question."
+            "If you don't know the answer, just say that you don't know, don't try to make up an answer."
+        )
+
+    for attempt in range(3):   
+        logger.info(f"attempt: {attempt}")
+        try:
+            prompt = ChatPromptTemplate.from_messages(
+                [
+                    ("system", system),
+                    MessagesPlaceholder(variable_name="messages"),
+                ]
+            )
+            chain = prompt | model
+
+            response = chain.invoke(state["messages"])
+            logger.info(f"call_model response: {response}")
+
+            # extended thinking
+            if chat.debug_mode=="Enable":
+                chat.show_extended_thinking(st, response)
+
+            if isinstance(response.content, list):            
+                for re in response.content:
+                    if "type" in re:
+                        if re['type'] == 'text':
+                            logger.info(f"--> {re['type']}: {re['text']}")
+
+                            status = re['text']
+                            logger.info(f"status: {status}")
+
+                            status = status.replace('`','')
+                            status = status.replace('\"','')
+                            status = status.replace("\'",'')
+
+                            logger.info(f"status: {status}")
+                            if status.find('<thinking>') != -1:
+                                logger.info(f"Remove <thinking> tag.")
+                                status = status[status.find('<thinking>')+11:status.find('</thinking>')]
+                                logger.info(f"status without tag: {status}")
+
+                            if chat.debug_mode=="Enable":
+                                utils.status(st, status)
+
+                        elif re['type'] == 'tool_use':                
+                            logger.info(f"--> {re['type']}: {re['name']}, {re['input']}")
+
+                            if chat.debug_mode=="Enable":
+                                utils.status(st, f"{re['type']}: {re['name']}, {re['input']}")
+                        else:
+                            logger.info(re)
+                    else: # answer
+                        logger.info(response.content)
+            break
+        except Exception:
+            response = AIMessage(content="답변을 찾지 못하였습니다.")
+
+            err_msg = traceback.format_exc()
+            logger.info(f"error message: {err_msg}")
+            # raise Exception ("Not able to request to LLM")
+
+    return {"messages": [response]}
+
+def buildChatAgent():
+    workflow = StateGraph(State)
+
+    workflow.add_node("agent", call_model)
+    workflow.add_node("action", graph_registry.tool_node)
+    workflow.add_edge(START, "agent")
+    workflow.add_conditional_edges(
+        "agent",
+        should_continue,
+        {
+            "continue": "action",
+            "end": END,
+        },
+    )
+    workflow.add_edge("action", "agent")
+
+    return workflow.compile()
+
+def buildChatAgentWithHistory():
+    workflow = StateGraph(State)
+
+    workflow.add_node("agent", call_model)
+    workflow.add_node("action", graph_registry.tool_node)
+    workflow.add_edge(START, "agent")
+    workflow.add_conditional_edges(
+        "agent",
+        should_continue,
+        {
+            "continue": "action",
+            "end": END,
+        },
+    )
+    workflow.add_edge("action", "agent")
+
+    return workflow.compile(
+        checkpointer=chat.checkpointer,
+        store=chat.memorystore
+    )
+
+def get_chat_agent(historyMode):
+    if historyMode == "Enable":
+        return graph_registry.get_graph("tool-use-with-history", buildChatAgentWithHistory)   # the sessions are separated by the thread_id
+    else:
+        return graph_registry.get_graph("tool-use", buildChatAgent)
+
+def run_agent_executor(query, historyMode, st):
+    logger.info(f"###### run_agent_executor ######")
+    logger.info(f"historyMode: {historyMode}")
+    
+    if chat.internet_mode == "Eanble":
+        # tools = [get_current_time, get_book_list, get_weather_info, search_by_tavily, search_by_knowledge_base, stock_data_lookup, code_drawer, code_interpreter]        
+        tools = [get_current_time, get_book_list, get_weather_info, search_by_tavily, search_by_knowledge_base, stock_data_lookup, repl_drawer, repl_coder] 
+    else:
+        tools = [get_current_time, get_book_list, get_weather_info, search_by_knowledge_base, stock_data_lookup, repl_drawer, repl_coder] 
 
     # initiate
-    global reference_docs, contentList, image_url
-    reference_docs = []
-    contentList = []
-    image_url = []
+    session.reference_docs = []
+    session.contentList = []
+    session.image_url = []
 
     inputs = [HumanMessage(content=query)]
 
+    app = get_chat_agent(historyMode)
     if historyMode == "Enable":
-        app = buildChatAgentWithHistory()
         config = {
             "recursion_limit": 50,
-            "configurable": {"thread_id": chat.userId}
+            "configurable": {"thread_id": chat.userId, "st": st, "tools": tools}
         }
     else:
-        app = buildChatAgent()
         config = {
-            "recursion_limit": 50
+            "recursion_limit": 50,
+            "configurable": {"st": st, "tools": tools}
         }
     
     # msg = message.content
@@ -747,16 +761,16 @@ def run_agent_executor(query, historyMode, st):
             logger.info(f"{i} --> {m.content}")
         logger.info(f"userId: {chat.userId}")
 
-    for i, doc in enumerate(reference_docs):
+    for i, doc in enumerate(session.reference_docs):
         logger.info(f"--> {i}: {doc}")
         
     reference = ""
-    if reference_docs:
-        reference = chat.get_references(reference_docs)
+    if session.reference_docs:
+        reference = chat.get_references(session.reference_docs)
 
     msg = chat.extract_thinking_tag(msg, st)
     
-    return msg+reference, image_url, reference_docs
+    return msg+reference, session.image_url, session.reference_docs
 
 ####################### LangGraph #######################
 # Agentic Workflow: Tool Use (partial tool을 활용)
@@ -2,6 +2,8 @@ import logging
 import sys
 import json
 import traceback
+import gzip
+import base64
 
 #logging
 def CreateLogger(logger_name):
@@ -74,3 +76,10 @@ def load_mcp_env():
 def save_mcp_env(mcp_env):
     with open("application/mcp.env", "w", encoding="utf-8") as f:
         json.dump(mcp_env, f)
+
+def decode_response(payload):
+    """JSON string of the documents in the Lambda response, which is gzip and base64 encoded if it was compressed."""
+    response = payload['response']
+    if payload.get('encoding') == 'gzip+base64':
+        response = gzip.decompress(base64.b64decode(response)).decode('utf-8')
+    return response
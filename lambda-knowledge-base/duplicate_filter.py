@@ -0,0 +1,85 @@
+import hashlib
+import logging
+import random
+import re
+import sys
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("duplicate-filter")
+
+####################### Duplicate Filter #######################
+# Exact duplicates are found by the hash of the normalized text.
+# Near duplicates are found by MinHash signatures of the word
+# shingles. The overlap is the estimated containment of the
+# smaller text in the larger one, so that a child chunk of the
+# hierarchical chunking is a duplicate of its parent chunk and
+# the chunks which share an overlap of a few sentences are not.
+################################################################
+num_perm = 64
+mersenne_prime = (1 << 61) - 1
+max_hash = (1 << 32) - 1
+
+_random = random.Random(42)   # the same permutations in every container
+permutations = [(_random.randint(1, mersenne_prime - 1), _random.randint(0, mersenne_prime - 1)) for _ in range(num_perm)]
+
+def normalize(text):
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+def get_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=4).digest(), "big")
+
+def get_shingles(text, size):
+    """Hashes of the word n-grams. Character n-grams are used for the text which has a few words."""
+    words = text.split(" ")
+    if len(words) >= size * 2:
+        return {get_hash(" ".join(words[i:i+size])) for i in range(len(words) - size + 1)}
+    size = size * 3
+    return {get_hash(text[i:i+size]) for i in range(max(1, len(text) - size + 1))}
+
+def get_signature(shingles):
+    return [min(((a * s + b) % mersenne_prime) & max_hash for s in shingles) for a, b in permutations]
+
+def get_containment(first, second):
+    """Estimated |A∩B| / min(|A|, |B|) from the MinHash Jaccard similarity and the number of shingles."""
+    (signature_a, size_a), (signature_b, size_b) = first, second
+    jaccard = sum(1 for x, y in zip(signature_a, signature_b) if x == y) / num_perm
+    intersection = jaccard * (size_a + size_b) / (1 + jaccard)
+    return min(1.0, intersection / min(size_a, size_b))
+
+def find_duplicates(texts, threshold=0.8, shingle_size=5):
+    """
+    Return the index of the earlier text which each text duplicates, or None for the texts to keep.
+    threshold: containment of the smaller text above which the texts are near duplicates (1 or more: exact duplicates only)
+    """
+    duplicate_of = [None] * len(texts)
+    hashes = dict()     # hash of the normalized text -> index
+    kept = []           # (index, (signature, number of shingles))
+    for i, text in enumerate(texts):
+        text = normalize(text)
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if key in hashes:
+            duplicate_of[i] = hashes[key]
+            continue
+        hashes[key] = i
+
+        if threshold >= 1:
+            continue
+        shingles = get_shingles(text, shingle_size)
+        minhash = (get_signature(shingles), len(shingles))
+        for j, other in kept:
+            if get_containment(minhash, other) >= threshold:
+                duplicate_of[i] = j
+                break
+        else:
+            kept.append((i, minhash))
+
+    duplicates = sum(1 for d in duplicate_of if d is not None)
+    if duplicates:
+        logger.info(f"duplicates: {duplicates}/{len(texts)}")
+    return duplicate_of
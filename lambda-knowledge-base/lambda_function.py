@@ -1,9 +1,20 @@
+import time
+init_start = time.time()
+
 import json
+import gzip
+import base64
 import traceback
+import asyncio
 import boto3
 import os
 import re
 import info
+import threading
+import rate_limiter
+import duplicate_filter
+
+from concurrent.futures import ThreadPoolExecutor
 
 from botocore.config import Config
 
@@ -13,13 +24,12 @@ from langchain_aws import ChatBedrock
 from langchain_aws import AmazonKnowledgeBasesRetriever
 from urllib import parse
 from pydantic.v1 import BaseModel, Field
-from multiprocessing import Process, Pipe
+from grade_cache import GradeCache
 
 bedrock_region = os.environ.get('bedrock_region')
 projectName = os.environ.get('projectName')
 path = os.environ.get('sharing_url')
 
-knowledge_base_id = ""
 numberOfDocs = 3
 knowledge_base_name = projectName
 s3_prefix = 'docs'
@@ -38,6 +48,51 @@ def isKorean(text):
         print('Not Korean: ', word_kor)
         return False
     
+# clients and chat models are kept in the module scope to reuse them in warm invocations
+max_pool_connections = int(os.environ.get('max_pool_connections', 50))
+
+# shared budget of the graders per region and model (0: unlimited)
+rate_limiter.configure(
+    rpm=os.environ.get('bedrock_rpm', 0),
+    tpm=os.environ.get('bedrock_tpm', 0),
+    path=os.environ.get('rate_limit_shared_path')
+)
+
+bedrock_clients = dict()  # region -> bedrock-runtime client
+chat_models = dict()      # (region, model_id, parameters) -> ChatBedrock
+chat_model_lock = threading.RLock()
+
+def get_bedrock_client(bedrock_region):
+    with chat_model_lock:
+        if bedrock_region not in bedrock_clients:
+            print(f'create bedrock-runtime client: {bedrock_region}')
+            bedrock_client = boto3.client(
+                service_name='bedrock-runtime',
+                region_name=bedrock_region,
+                config=Config(
+                    retries = {
+                        'max_attempts': 30
+                    },
+                    max_pool_connections=max_pool_connections
+                )
+            )
+            rate_limiter.register_client(bedrock_client, bedrock_region)
+            bedrock_clients[bedrock_region] = bedrock_client
+        return bedrock_clients[bedrock_region]
+
+def get_chat_model(bedrock_region, modelId, parameters):
+    key = (bedrock_region, modelId, json.dumps(parameters, sort_keys=True))
+
+    with chat_model_lock:
+        if key not in chat_models:
+            chat_models[key] = ChatBedrock(   # new chat model
+                model_id=modelId,
+                client=get_bedrock_client(bedrock_region), 
+                model_kwargs=parameters,
+                region_name=bedrock_region
+            )
+        return chat_models[key]
+
 selected_chat = 0
 multi_region = 'Disable'
 def get_chat(models, extended_thinking):
@@ -62,16 +117,6 @@ def get_chat(models, extended_thinking):
     elif model_type == 'claude':
         STOP_SEQUENCE = "\n\nHuman:" 
                           
-    # bedrock   
-    boto3_bedrock = boto3.client(
-        service_name='bedrock-runtime',
-        region_name=bedrock_region,
-        config=Config(
-            retries = {
-                'max_attempts': 30
-            }
-        )
-    )
     if extended_thinking=='Enable':
         maxReasoningOutputTokens=64000
         print(f"extended_thinking: {extended_thinking}")
@@ -95,12 +140,7 @@ def get_chat(models, extended_thinking):
             "stop_sequences": [STOP_SEQUENCE]
         }
 
-    chat = ChatBedrock(   # new chat model
-        model_id=modelId,
-        client=boto3_bedrock, 
-        model_kwargs=parameters,
-        region_name=bedrock_region
-    )    
+    chat = get_chat_model(bedrock_region, modelId, parameters)
     
     if multi_region=='Enable':
         selected_chat = selected_chat + 1
@@ -124,16 +164,6 @@ def get_parallel_processing_chat(models, selected):
     elif model_type == 'claude':
         STOP_SEQUENCE = "\n\nHuman:" 
                           
-    # bedrock   
-    boto3_bedrock = boto3.client(
-        service_name='bedrock-runtime',
-        region_name=bedrock_region,
-        config=Config(
-            retries = {
-                'max_attempts': 30
-            }
-        )
-    )
     parameters = {
         "max_tokens":maxOutputTokens,     
         "temperature":0.1,
@@ -143,11 +173,7 @@ def get_parallel_processing_chat(models, selected):
     }
     # print('parameters: ', parameters)
 
-    chat = ChatBedrock(   # new chat model
-        model_id=modelId,
-        client=boto3_bedrock, 
-        model_kwargs=parameters,
-    )        
+    chat = get_chat_model(bedrock_region, modelId, parameters)
     return chat
                 
 class GradeDocuments(BaseModel):
@@ -155,54 +181,133 @@ class GradeDocuments(BaseModel):
 
     binary_score: str = Field(description="Documents are relevant to the question, 'yes' or 'no'")
 
-def grade_document_based_on_relevance(conn, question, doc, models, selected):     
-    chat = get_parallel_processing_chat(models, selected)
-    retrieval_grader = get_retrieval_grader(chat)
-    score = retrieval_grader.invoke({"question": question, "document": doc.page_content})
+# number of documents which are graded at the same time
+grading_concurrency = int(os.environ.get('grading_concurrency', 8))
+# stop grading when this number of relevant documents are found (0: grade all documents)
+min_relevant_docs = int(os.environ.get('min_relevant_docs', 0))
+# number of documents which are graded by a single request (0 or 1: one request per document)
+grading_batch_size = int(os.environ.get('grading_batch_size', 10))
+
+# grades of (question, document, model) which are reused by warm invocations
+grade_cache = GradeCache(
+    maxsize=int(os.environ.get('grade_cache_size', 10000)),
+    ttl=int(os.environ.get('grade_cache_ttl', 86400)),
+    path=os.environ.get('grade_cache_path')
+)
+
+async def grade_document_based_on_relevance(retrieval_grader, question, doc, semaphore):
+    async with semaphore:
+        score = await retrieval_grader.ainvoke({"question": question, "document": doc.page_content})
     # print(f"score: {score}")
     
-    grade = score.binary_score    
-    if grade == 'yes':
+    if score.binary_score.lower() == 'yes':
         print(f"---GRADE: DOCUMENT RELEVANT---")
-        conn.send(doc)
+        return True
     else:  # no
         print(f"--GRADE: DOCUMENT NOT RELEVANT---")
-        conn.send(None)
-    
-    conn.close()
+        return False
 
-def grade_documents_using_parallel_processing(models, question, documents):
+async def grade_batch_based_on_relevance(batch_grader, retrieval_grader, question, documents, indexes, semaphore):
+    """
+    Grade documents[indexes] in a single request. Documents without a verdict are graded one by one.
+    Return the verdicts as {index: True if relevant}.
+    """
+    verdicts = dict()
+    if batch_grader is not None:
+        try:
+            async with semaphore:
+                result = await batch_grader.ainvoke({"question": question, "documents": format_documents_for_grading(documents, indexes)})
+            for grade in result.grades:
+                if grade.index in indexes:
+                    verdicts[grade.index] = grade.binary_score.lower() == "yes"
+        except Exception:
+            err_msg = traceback.format_exc()
+            print('error message: ', err_msg)
+
+        missing = [i for i in indexes if i not in verdicts]
+        if missing:
+            print(f"no verdict in the batch, grade documents {missing} one by one")
+    else:
+        missing = indexes
+
+    results = await asyncio.gather(
+        *[grade_document_based_on_relevance(retrieval_grader, question, documents[i], semaphore) for i in missing],
+        return_exceptions=True
+    )
+    for i, result in zip(missing, results):
+        if isinstance(result, Exception):
+            print('error message: ', result)
+            continue
+        verdicts[i] = result
+
+    relevant = [i for i in indexes if verdicts.get(i)]
+    print(f"---GRADE: {len(relevant)}/{len(indexes)} DOCUMENTS RELEVANT---")
+    return verdicts
+
+async def grade_documents_concurrently(models, question, documents, min_relevant=0, semaphore=None):
     global selected_chat
 
-    number_of_models = len(models)    
-    filtered_docs = []    
-    processes = []
-    parent_connections = []
-    
-    for i, doc in enumerate(documents):
-        #print(f"grading doc[{i}]: {doc.page_content}")        
-        parent_conn, child_conn = Pipe()
-        parent_connections.append(parent_conn)
-            
-        process = Process(target=grade_document_based_on_relevance, args=(child_conn, question, doc, models, selected_chat))
-        processes.append(process)
-        
-        selected_chat = selected_chat + 1
-        if selected_chat == number_of_models:
-            selected_chat = 0
-    for process in processes:
-        process.start()
-            
-    for parent_conn in parent_connections:
-        relevant_doc = parent_conn.recv()
+    model_id = models[0]["model_id"]
 
-        if relevant_doc is not None:
-            filtered_docs.append(relevant_doc)
+    relevant = set()
+    uncached = []
+    for i, doc in enumerate(documents):
+        grade = grade_cache.get(question, doc.page_content, model_id)
+        if grade is None:
+            uncached.append(i)
+        elif grade:
+            relevant.add(i)
+    if len(uncached) < len(documents):
+        print(f"grade cache: {len(documents)-len(uncached)} hits, {len(uncached)} misses")
+    if min_relevant and len(relevant) >= min_relevant:
+        uncached = []
+
+    batch_size = grading_batch_size if grading_batch_size > 1 else 1
+    batches = [uncached[i:i+batch_size] for i in range(0, len(uncached), batch_size)]
 
-    for process in processes:
-        process.join()
-    
-    return filtered_docs
+    number_of_models = len(models)
+    if multi_region == 'Enable':
+        llms = []
+        for i in range(len(batches)):
+            llms.append(get_parallel_processing_chat(models, selected_chat))
+
+            selected_chat = selected_chat + 1
+            if selected_chat == number_of_models:
+                selected_chat = 0
+    else:
+        llms = [get_chat(models, extended_thinking="Disable")] * len(batches) if batches else []
+
+    semaphore = semaphore or asyncio.Semaphore(grading_concurrency)
+    tasks = []
+    for llm, indexes in zip(llms, batches):
+        batch_grader = get_batch_retrieval_grader(llm) if len(indexes) > 1 else None
+        tasks.append(asyncio.create_task(
+            grade_batch_based_on_relevance(batch_grader, get_retrieval_grader(llm), question, documents, indexes, semaphore)
+        ))
+
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    for i, grade in task.result().items():
+                        grade_cache.put(question, documents[i].page_content, model_id, grade)
+                        if grade:
+                            relevant.add(i)
+                except Exception:
+                    err_msg = traceback.format_exc()
+                    print('error message: ', err_msg)
+
+            if min_relevant and len(relevant) >= min_relevant:
+                print(f"found {len(relevant)} relevant documents, skip {len(pending)} batches")
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    # keep the order of the retrieved documents
+    return [doc for i, doc in enumerate(documents) if i in relevant]
 
 def get_retrieval_grader(chat):
     system = (
@@ -221,52 +326,84 @@ def get_retrieval_grader(chat):
     retrieval_grader = grade_prompt | structured_llm_grader
     return retrieval_grader
 
+class DocumentGrade(BaseModel):
+    """Binary score for relevance check on one of the retrieved documents."""
+
+    index: int = Field(description="index of the document")
+    binary_score: str = Field(description="Document is relevant to the question, 'yes' or 'no'")
+
+class GradeBatch(BaseModel):
+    """Binary scores for relevance check on a list of retrieved documents."""
+
+    grades: list[DocumentGrade] = Field(description="grade of every document in the list")
+
+def format_documents_for_grading(documents, indexes):
+    return "\n\n".join([f"<document index={i}>\n{documents[i].page_content}\n</document>" for i in indexes])
+
+def get_batch_retrieval_grader(chat):
+    system = (
+        "You are a grader assessing relevance of retrieved documents to a user question."
+        "Each document is given in <document index=N> tags. Grade every document independently."
+        "If a document contains keyword(s) or semantic meaning related to the question, grade it as relevant."
+        "Give a binary score 'yes' or 'no' with the index of each document to indicate whether the document is relevant to the question."
+    )
+
+    grade_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", system),
+            ("human", "Retrieved documents: \n\n {documents} \n\n User question: {question}"),
+        ]
+    )    
+    structured_llm_grader = chat.with_structured_output(GradeBatch)
+    batch_grader = grade_prompt | structured_llm_grader
+    return batch_grader
+
 def grade_documents(model_name, question, documents):
     print(f"###### grade_documents ######")
     print(f"start grading...")
 
     models = info.get_model_info(model_name)
     
-    filtered_docs = []
-    if multi_region == 'Enable':  # parallel processing        
-        filtered_docs = grade_documents_using_parallel_processing(models, question, documents)
-
-    else:
-        # Score each doc    
-        llm = get_chat(models, extended_thinking="Disable")
-        retrieval_grader = get_retrieval_grader(llm)
-        for i, doc in enumerate(documents):
-            # print('doc: ', doc)
-            
-            score = retrieval_grader.invoke({"question": question, "document": doc.page_content})
-            # print("score: ", score)
-            
-            grade = score.binary_score
-            # print("grade: ", grade)
-            
-            if grade.lower() == "yes": # Document relevant
-                print(f"---GRADE: DOCUMENT RELEVANT---")
-                filtered_docs.append(doc)
-            
-            else: # Document not relevant
-                print(f"---GRADE: DOCUMENT NOT RELEVANT---")
-                continue
+    filtered_docs = asyncio.run(grade_documents_concurrently(models, question, documents, min_relevant_docs))
+    print(f"filtered_docs: {len(filtered_docs)}/{len(documents)}")
     
     return filtered_docs
 
-contentList = []
+def grade_documents_by_keyword(model_name, keywords, documents, indexes):
+    """
+    Grade the documents which each keyword retrieved against the keyword.
+    indexes: indexes in documents per keyword. Return the indexes of the relevant documents per keyword.
+    """
+    print(f"###### grade_documents_by_keyword ######")
+
+    models = info.get_model_info(model_name)
+
+    async def grade_all():
+        semaphore = asyncio.Semaphore(grading_concurrency)   # shared by the keywords
+        return await asyncio.gather(*[
+            grade_documents_concurrently(models, keyword, [documents[i] for i in doc_indexes], min_relevant_docs, semaphore)
+            for keyword, doc_indexes in zip(keywords, indexes)
+        ])
+
+    positions = {id(doc): i for i, doc in enumerate(documents)}
+    relevant_indexes = [[positions[id(doc)] for doc in docs] for docs in asyncio.run(grade_all())]
+    print(f"relevant documents per keyword: {[len(doc_indexes) for doc_indexes in relevant_indexes]}")
+
+    return relevant_indexes
+
+# containment of the smaller chunk above which two chunks are near duplicates (1: exact duplicates only)
+near_duplicate_threshold = float(os.environ.get('near_duplicate_threshold', 0.8))
+shingle_size = int(os.environ.get('shingle_size', 5))   # words
+
+def get_duplicates(docs):
+    """Return the index of the earlier document which each document duplicates, or None."""
+    return duplicate_filter.find_duplicates([doc.page_content for doc in docs], near_duplicate_threshold, shingle_size)
+
 def check_duplication(docs):
-    global contentList
     length_original = len(docs)
-    
-    updated_docs = []
-    print('length of relevant_docs:', len(docs))
-    for doc in docs:            
-        if doc.page_content in contentList:
-            print('duplicated!')
-            continue
-        contentList.append(doc.page_content)
-        updated_docs.append(doc)            
+    print('length of relevant_docs:', length_original)
+
+    updated_docs = [doc for doc, duplicate in zip(docs, get_duplicates(docs)) if duplicate is None]
     length_updated_docs = len(updated_docs)   
     
     if length_original == length_updated_docs:
@@ -284,11 +421,108 @@ def print_doc(i, doc):
             
     print(f"{i}: {text}, metadata:{doc.metadata}")
 
-def search_by_knowledge_base(keyword: str, top_k: int) -> str:
+# knowledge base ids, retrievers and the clients of bedrock-agent are reused by warm invocations
+knowledge_base_id_ttl = int(os.environ.get('knowledge_base_id_ttl', 3600))   # seconds
+
+knowledge_base_ids = dict()   # knowledge base name -> (knowledge_base_id, resolved_at)
+retrievers = dict()           # (knowledge_base_id, top_k) -> AmazonKnowledgeBasesRetriever
+agent_clients = dict()        # service name -> bedrock-agent or bedrock-agent-runtime client
+knowledge_base_lock = threading.RLock()
+
+def get_agent_client(service_name):
+    with knowledge_base_lock:
+        if service_name not in agent_clients:
+            print(f'create {service_name} client: {bedrock_region}')
+            agent_clients[service_name] = boto3.client(
+                service_name=service_name,
+                region_name=bedrock_region,
+                config=Config(
+                    max_pool_connections=max_pool_connections
+                )
+            )
+        return agent_clients[service_name]
+
+def list_knowledge_bases():
+    """Return the summaries of all knowledge bases in the account, following nextToken."""
+    client = get_agent_client('bedrock-agent')
+
+    summaries = []
+    kwargs = {"maxResults": 100}
+    while True:
+        response = client.list_knowledge_bases(**kwargs)
+        summaries.extend(response.get("knowledgeBaseSummaries", []))
+        if not response.get("nextToken"):
+            break
+        kwargs["nextToken"] = response["nextToken"]
+    return summaries
+
+def get_knowledge_base_id(knowledge_base_name):
+    """Return the id of the knowledge base by its name. The id is kept for knowledge_base_id_ttl seconds."""
+    with knowledge_base_lock:
+        if knowledge_base_name in knowledge_base_ids:
+            knowledge_base_id, resolved_at = knowledge_base_ids[knowledge_base_name]
+            if time.time() - resolved_at < knowledge_base_id_ttl:
+                return knowledge_base_id
+
+        start = time.time()
+        try:
+            summaries = list_knowledge_bases()
+        except Exception as e:
+            err_msg = traceback.format_exc()
+            print('error message: ', err_msg)
+            print('Exception type:', type(e).__name__)
+            print('Exception args:', e.args)
+            return ""
+        print(f'Found {len(summaries)} knowledge bases ({time.time()-start:.3f}s)')
+
+        knowledge_base_id = ""
+        for summary in summaries:
+            if summary["name"] == knowledge_base_name:
+                knowledge_base_id = summary["knowledgeBaseId"]
+                print('knowledge_base_id: ', knowledge_base_id)
+                break
+
+        if not knowledge_base_id:
+            print(f'ERROR: Knowledge base with name "{knowledge_base_name}" not found!')
+            print('Available knowledge bases:')
+            for summary in summaries:
+                print(f'  - {summary["name"]}')
+            knowledge_base_ids.pop(knowledge_base_name, None)
+            return ""
+
+        knowledge_base_ids[knowledge_base_name] = (knowledge_base_id, time.time())
+        return knowledge_base_id
+
+def invalidate_knowledge_base(knowledge_base_id):
+    """Forget the knowledge base whose id is not valid anymore, so that it is resolved again by the next request."""
+    with knowledge_base_lock:
+        for name in [name for name, (kb_id, _) in knowledge_base_ids.items() if kb_id == knowledge_base_id]:
+            print(f'invalidate knowledge base: {name} ({knowledge_base_id})')
+            del knowledge_base_ids[name]
+        for key in [key for key in retrievers if key[0] == knowledge_base_id]:
+            del retrievers[key]
+
+def is_knowledge_base_missing(e):
+    # the knowledge base was deleted or recreated with a new id
+    return type(e).__name__ == 'ResourceNotFoundException' or 'ResourceNotFoundException' in str(e)
+
+def get_retriever(knowledge_base_id, top_k):
+    key = (knowledge_base_id, top_k)
+    with knowledge_base_lock:
+        if key not in retrievers:
+            retrievers[key] = AmazonKnowledgeBasesRetriever(
+                knowledge_base_id=knowledge_base_id, 
+                retrieval_config={"vectorSearchConfiguration": {
+                    "numberOfResults": top_k,
+                    "overrideSearchType": "HYBRID"   # SEMANTIC
+                }},
+                region_name=bedrock_region,
+                client=get_agent_client('bedrock-agent-runtime')
+            )
+        return retrievers[key]
+
+def search_by_knowledge_base(knowledge_base_id: str, keyword: str, top_k: int) -> str:
     print("###### search_by_knowledge_base ######")    
-    
-    global contentList, knowledge_base_id
-    contentList = []
  
     print('keyword: ', keyword)
     keyword = keyword.replace('\'','')
@@ -301,17 +535,11 @@ def search_by_knowledge_base(keyword: str, top_k: int) -> str:
     if knowledge_base_id:    
         try:
             print(f'Attempting to retrieve from knowledge base: {knowledge_base_id}')
-            retriever = AmazonKnowledgeBasesRetriever(
-                knowledge_base_id=knowledge_base_id, 
-                retrieval_config={"vectorSearchConfiguration": {
-                    "numberOfResults": top_k,
-                    "overrideSearchType": "HYBRID"   # SEMANTIC
-                }},
-                region_name=bedrock_region
-            )
+            retriever = get_retriever(knowledge_base_id, top_k)
             
+            start = time.time()
             docs = retriever.invoke(keyword)
-            print('length of docs: ', len(docs))        
+            print(f'length of docs: {len(docs)} ({time.time()-start:.3f}s)')
             # print('docs: ', docs)
 
             print('--> docs from knowledge base')
@@ -355,11 +583,14 @@ def search_by_knowledge_base(keyword: str, top_k: int) -> str:
                 )    
 
         except Exception as e:
-            knowledge_base_id = ""
             err_msg = traceback.format_exc()
             print('error message: ', err_msg)
             print('Exception type:', type(e).__name__)
             print('Exception args:', e.args)
+
+            # only a missing knowledge base is resolved again, other errors keep the cached id
+            if is_knowledge_base_missing(e):
+                invalidate_knowledge_base(knowledge_base_id)
             
             # Check if it's a permission error
             if '403' in str(e) or 'Forbidden' in str(e):
@@ -373,18 +604,165 @@ def search_by_knowledge_base(keyword: str, top_k: int) -> str:
     
     return relevant_docs
 
+# number of keywords which are retrieved at the same time in a batch
+retrieval_concurrency = int(os.environ.get('retrieval_concurrency', 5))
+
+def search_batch(knowledge_base_id, keywords, top_k):
+    """
+    Retrieve the keywords concurrently. Return the union of the documents without duplicated and near duplicated contents
+    and the indexes of the documents in the union for each keyword.
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, min(len(keywords), retrieval_concurrency))) as executor:
+        results = list(executor.map(lambda keyword: search_by_knowledge_base(knowledge_base_id, keyword, top_k), keywords))
+    print(f"retrieved {len(keywords)} keywords ({time.time()-start:.3f}s)")
+
+    # a duplicated document is replaced by the first one in the union
+    docs = [doc for docs in results for doc in docs]
+    duplicates = get_duplicates(docs)
+
+    union = []
+    positions = dict()   # index in docs -> index in union
+    for i, duplicate in enumerate(duplicates):
+        if duplicate is None:
+            positions[i] = len(union)
+            union.append(docs[i])
+        else:
+            positions[i] = positions[duplicate]
+
+    indexes = []
+    offset = 0
+    for keyword_docs in results:
+        doc_indexes = []
+        for i in range(offset, offset + len(keyword_docs)):
+            if positions[i] not in doc_indexes:
+                doc_indexes.append(positions[i])
+        indexes.append(doc_indexes)
+        offset += len(keyword_docs)
+    print(f"union: {len(union)}/{len(docs)} documents")
+
+    return union, indexes
+
+def get_json_docs(docs):
+    json_docs = []
+    for doc in docs:
+        print('doc: ', doc)
+
+        json_docs.append({
+            "contents": doc.page_content,              
+            "reference": {
+                "url": doc.metadata["url"],                   
+                "title": doc.metadata["name"],
+                "from": doc.metadata["from"]
+            }
+        })
+    return json_docs
+
+def get_documents(json_docs):
+    """Documents from the json docs of a previous search_rag response."""
+    return [
+        Document(
+            page_content=json_doc["contents"],
+            metadata={
+                'name': json_doc["reference"]["title"],
+                'url': json_doc["reference"]["url"],
+                'from': json_doc["reference"]["from"]
+            }
+        ) for json_doc in json_docs
+    ]
+
+# the size of a response is limited by the budgets, with a marker at the end of a truncated content.
+# The sizes are measured as the Lambda runtime sends them: the response is a JSON string in the
+# JSON of the runtime, which escapes non-ASCII characters (ensure_ascii=True), e.g. 6 bytes for a Korean letter.
+max_doc_bytes = int(os.environ.get('max_doc_bytes', 20000))              # contents of a document
+max_response_bytes = int(os.environ.get('max_response_bytes', 1000000))  # all documents, the limit of the invoke payload is 6MB
+min_doc_bytes = 200          # a document is dropped instead of being truncated below this size
+truncation_marker = " ...(truncated)"
+
+def get_wire_size(value):
+    """Bytes of the value in the invoke response."""
+    return len(json.dumps(json.dumps(value, ensure_ascii=False))) - 2
+
+def truncate_text(text, max_bytes):
+    if get_wire_size(text) <= max_bytes:
+        return text
+
+    # the longest head which fits in the budget with the marker
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if get_wire_size(text[:mid] + truncation_marker) <= max_bytes:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + truncation_marker
+
+def apply_byte_budget(json_docs, doc_bytes, response_bytes):
+    """Truncate the contents of the documents to the budgets. The documents after the total budget are dropped."""
+    budgeted_docs = []
+    remaining = response_bytes - get_wire_size([])
+    for json_doc in json_docs:
+        contents = truncate_text(json_doc["contents"], doc_bytes)
+        overhead = get_wire_size({**json_doc, "contents": ""}) + 2   # with the separator
+        if overhead + get_wire_size(contents) > remaining:
+            if remaining - overhead < min_doc_bytes:
+                break
+            contents = truncate_text(contents, remaining - overhead)
+
+        budgeted_docs.append({**json_doc, "contents": contents})
+        remaining -= overhead + get_wire_size(contents)
+
+    truncated = sum(1 for original, budgeted in zip(json_docs, budgeted_docs) if original["contents"] != budgeted["contents"])
+    if truncated or len(budgeted_docs) < len(json_docs):
+        print(f"byte budget: {truncated} truncated, {len(json_docs)-len(budgeted_docs)} dropped")
+    return budgeted_docs
+
+def encode_response(json_docs, compression):
+    """The json docs as a JSON string, or gzip and base64 encoded if the client requested the compression."""
+    body = json.dumps(json_docs, ensure_ascii=False)
+    if compression == 'gzip':
+        encoded = base64.b64encode(gzip.compress(body.encode('utf-8'))).decode('ascii')
+        print(f"compression: {len(body.encode('utf-8'))} -> {len(encoded)} bytes")
+        return encoded, 'gzip+base64'
+    return body, None
+
+def get_output(json_docs, compression, doc_bytes, response_bytes, results=None, indexes=None):
+    json_docs = apply_byte_budget(json_docs, doc_bytes, response_bytes)
+    response, encoding = encode_response(json_docs, compression)
+
+    output = {
+        'response': response
+    }
+    if encoding:
+        output['encoding'] = encoding
+    if results is not None:
+        # the indexes of the dropped documents are removed
+        results = [{**result, "indexes": [i for i in result["indexes"] if i < len(json_docs)]} for result in results]
+        output['results'] = json.dumps(results, ensure_ascii=False)
+    if indexes is not None:
+        output['indexes'] = json.dumps(indexes[:len(json_docs)])
+    return output
+
+invocations = 0
+
 def lambda_handler(event, context):
+    global invocations
+    invocations += 1
+    handler_start = time.time()
     print('event: ', event)
     
     function = event['function']
     print('function: ', function)
 
-    knowledge_base_name = event["knowledge_base_name"]
+    knowledge_base_name = event.get("knowledge_base_name")
     print('knowledge_base_name: ', knowledge_base_name)
 
     keyword = event.get('keyword')
     print('keyword: ', keyword)
 
+    keywords = event.get('keywords')   # batch of keywords which are searched by one invocation
+    print('keywords: ', keywords)
+
     top_k = event.get('top_k')
     print('top_k: ', top_k)
     
@@ -398,47 +776,24 @@ def lambda_handler(event, context):
     multi_region = event.get('multi_region')
     print('multi_region: ', multi_region)
 
-    global contentList
-    contentList = []
+    compression = event.get('compression')   # 'gzip' for a gzip and base64 encoded response
+    print('compression: ', compression)
 
-    global knowledge_base_id
-    # retrieve knowledge_base_id
-    if not knowledge_base_id:
-        try: 
-            client = boto3.client(
-                service_name='bedrock-agent',
-                region_name=bedrock_region
-            )   
-            response = client.list_knowledge_bases(
-                maxResults=20
-            )
-            print('(list_knowledge_bases) response: ', response)
-            
-            if "knowledgeBaseSummaries" in response:
-                summaries = response["knowledgeBaseSummaries"]
-                print(f'Found {len(summaries)} knowledge bases')
-                for summary in summaries:
-                    print(f'Knowledge Base: {summary["name"]} (ID: {summary["knowledgeBaseId"]})')
-                    if summary["name"] == knowledge_base_name:                        
-                        knowledge_base_id = summary["knowledgeBaseId"]
-                        print('knowledge_base_id: ', knowledge_base_id)
-                        break
-                
-                if not knowledge_base_id:
-                    print(f'ERROR: Knowledge base with name "{knowledge_base_name}" not found!')
-                    print('Available knowledge bases:')
-                    for summary in summaries:
-                        print(f'  - {summary["name"]}')
-            else:
-                print('ERROR: No knowledge bases found in response')
-                print('Response keys:', response.keys() if response else 'No response')
-                
-        except Exception as e:
-            knowledge_base_id = ""
-            err_msg = traceback.format_exc()
-            print('error message: ', err_msg)
-            print('Exception type:', type(e).__name__)
-            print('Exception args:', e.args)
+    doc_bytes = int(event.get('max_doc_bytes') or max_doc_bytes)
+    response_bytes = int(event.get('max_response_bytes') or max_response_bytes)
+
+    if function == 'grade_documents':
+        # the second step of a progressive search: the client has shown the hits of search_rag
+        # without grading, and the relevant ones of the hits are returned here
+        documents = get_documents(event.get('documents', []))
+        graded_docs = grade_documents(model_name, keyword, documents)
+        graded = {id(doc) for doc in graded_docs}
+        indexes = [i for i, doc in enumerate(documents) if id(doc) in graded]
+        print(f"handler: {time.time()-handler_start:.3f}s ({'cold' if invocations == 1 else 'warm'} start, invocation: {invocations})")
+
+        return get_output(get_json_docs(graded_docs), compression, doc_bytes, response_bytes, indexes=indexes)
+
+    knowledge_base_id = get_knowledge_base_id(knowledge_base_name)
     
     if not knowledge_base_id:
         print('ERROR: Could not retrieve knowledge_base_id. Cannot proceed with search.')
@@ -447,32 +802,40 @@ def lambda_handler(event, context):
             'error': 'Knowledge base not found or not accessible'
         }
     
-    docs = []
-    if function == 'search_rag':
+    json_docs = []
+    results = []
+    if function == 'search_rag' and keywords:
+        union, indexes = search_batch(knowledge_base_id, keywords, top_k)  # retrieve
+        if grading == "Enable":
+            # a document is graded against each keyword which retrieved it, and kept if it is relevant to any of them
+            relevant_indexes = grade_documents_by_keyword(model_name, keywords, union, indexes)  # grade documents
+            kept = sorted({i for doc_indexes in relevant_indexes for i in doc_indexes})
+            positions = {i: position for position, i in enumerate(kept)}   # index in union -> index in the graded documents
+            indexes = [[positions[i] for i in doc_indexes] for doc_indexes in relevant_indexes]
+            docs = [union[i] for i in kept]
+        else:
+            docs = union
+
+        json_docs = get_json_docs(docs)
+        results = [{"keyword": k, "indexes": doc_indexes} for k, doc_indexes in zip(keywords, indexes)]
+        print('results: ', results)
+
+    elif function == 'search_rag':
         print('keyword: ', keyword)        
-        relevant_docs = search_by_knowledge_base(keyword, top_k)  # retrieve
+        relevant_docs = search_by_knowledge_base(knowledge_base_id, keyword, top_k)  # retrieve
+        relevant_docs = check_duplication(relevant_docs)  # check duplication before grading
         if grading == "Enable":            
             filtered_docs = grade_documents(model_name, keyword, relevant_docs)  # grade documents            
-            filtered_docs = check_duplication(filtered_docs)  # check duplication
             docs = filtered_docs            
         else:
             docs = relevant_docs
 
-        json_docs = []
-        for doc in docs:
-            print('doc: ', doc)
-
-            json_docs.append({
-                "contents": doc.page_content,              
-                "reference": {
-                    "url": doc.metadata["url"],                   
-                    "title": doc.metadata["name"],
-                    "from": doc.metadata["from"]
-                }
-            })
-
+        json_docs = get_json_docs(docs)
         print('json_docs: ', json_docs)
+
+    print(f"handler: {time.time()-handler_start:.3f}s ({'cold' if invocations == 1 else 'warm'} start, invocation: {invocations})")
         
-    return {
-        'response': json.dumps(json_docs, ensure_ascii=False)
-    }
+    # documents of each keyword as the indexes in the response
+    return get_output(json_docs, compression, doc_bytes, response_bytes, results=results if keywords else None)
+
+print(f"init: {time.time()-init_start:.3f}s")
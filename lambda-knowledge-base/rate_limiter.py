@@ -0,0 +1,296 @@
+import fcntl
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from botocore.eventstream import EventStream
+from collections import deque
+
+logging.basicConfig(
+    level=logging.INFO,  # Default to INFO level
+    format='%(filename)s:%(lineno)d | %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stderr)
+    ]
+)
+logger = logging.getLogger("rate-limiter")
+
+####################### Rate Limiter #######################
+# Token buckets for requests and tokens per minute of each
+# (region, model). Bedrock calls are held in the caller thread
+# by a botocore hook before the request is built, and queued
+# callers are served in arrival order. If shared_path is set,
+# the buckets are kept in files so that the processes of the
+# application (e.g. the MCP servers) share the same budget.
+############################################################
+requests_per_minute = 0    # 0: unlimited
+tokens_per_minute = 0      # 0: unlimited
+shared_path = None         # directory of the cross-process buckets
+max_wait = 120             # seconds
+wait_window = 200          # number of wait samples for the metrics
+
+chars_per_token = 4
+default_max_tokens = 4096
+
+def configure(rpm=None, tpm=None, path=None):
+    global requests_per_minute, tokens_per_minute, shared_path
+
+    if rpm is not None:
+        requests_per_minute = int(rpm)
+    if tpm is not None:
+        tokens_per_minute = int(tpm)
+    if path:
+        os.makedirs(path, exist_ok=True)
+        shared_path = path
+    logger.info(f"rate limit: rpm={requests_per_minute}, tpm={tokens_per_minute}, shared_path={shared_path}")
+
+class Bucket:
+    """Requests and tokens which are refilled continuously up to the budget per minute."""
+
+    def __init__(self, key):
+        self.key = key
+        self.state = None
+
+    def get_path(self):
+        return os.path.join(shared_path, f"{self.key.replace('/', '_').replace(':', '_')}.json")
+
+    def refill(self, state, now):
+        elapsed = max(0, now - state["updated_at"])
+        if requests_per_minute:
+            state["requests"] = min(requests_per_minute, state["requests"] + elapsed * requests_per_minute / 60)
+        if tokens_per_minute:
+            state["tokens"] = min(tokens_per_minute, state["tokens"] + elapsed * tokens_per_minute / 60)
+        state["updated_at"] = now
+        return state
+
+    def get_wait(self, state, tokens):
+        wait = 0
+        if requests_per_minute and state["requests"] < 1:
+            wait = max(wait, (1 - state["requests"]) * 60 / requests_per_minute)
+        if tokens_per_minute:
+            tokens = min(tokens, tokens_per_minute)   # a large request waits for the full bucket only
+            if state["tokens"] < tokens:
+                wait = max(wait, (tokens - state["tokens"]) * 60 / tokens_per_minute)
+        return wait
+
+    def new_state(self, now):
+        return {"requests": requests_per_minute, "tokens": tokens_per_minute, "updated_at": now}
+
+    def update(self, func):
+        """Apply func to the bucket state with a lock for the process or for all processes."""
+        now = time.time()
+        if shared_path is None:
+            if self.state is None:
+                self.state = self.new_state(now)
+            return func(self.refill(self.state, now))
+
+        with open(self.get_path(), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                body = f.read()
+                state = json.loads(body) if body else self.new_state(now)
+                result = func(self.refill(state, now))
+
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def try_acquire(self, tokens):
+        def consume(state):
+            wait = self.get_wait(state, tokens)
+            if wait == 0:
+                state["requests"] -= 1
+                state["tokens"] -= tokens
+            return wait
+        return self.update(consume)
+
+    def adjust(self, tokens):
+        """Refund (tokens < 0) or charge more (tokens > 0) after the actual usage is known."""
+        def apply(state):
+            state["tokens"] = min(tokens_per_minute, state["tokens"] - tokens)
+        self.update(apply)
+
+class Limiter:
+    def __init__(self, key):
+        self.key = key
+        self.bucket = Bucket(key)
+        self.condition = threading.Condition()
+        self.queue = deque()      # tickets of the waiting callers
+        self.waits = deque(maxlen=wait_window)
+        self.requests = 0
+        self.delayed = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def acquire(self, tokens):
+        """Block until the request fits in the budget. Return the waiting time in seconds."""
+        start = time.time()
+        ticket = object()
+
+        with self.condition:
+            self.queue.append(ticket)
+            try:
+                while True:
+                    if self.queue[0] is ticket:   # first come, first served
+                        wait = self.bucket.try_acquire(tokens)
+                        if wait == 0:
+                            break
+                        if time.time() - start + wait > max_wait:
+                            logger.info(f"{self.key}: waited {time.time()-start:.1f}s, send the request without the budget")
+                            break
+                    else:
+                        wait = None   # wait for the turn
+                    self.condition.wait(timeout=wait)
+            finally:
+                self.queue.remove(ticket)
+                self.condition.notify_all()
+
+        elapsed = time.time() - start
+        self.record(elapsed)
+        return elapsed
+
+    def adjust(self, tokens):
+        """Correct the charged tokens with the same lock as acquire, and wake up the waiting callers for a refund."""
+        with self.condition:
+            self.bucket.adjust(tokens)
+            self.condition.notify_all()
+
+    def record(self, elapsed):
+        with self.condition:
+            self.requests += 1
+            self.waits.append(elapsed)
+            if elapsed > 0.01:
+                self.delayed += 1
+            self.total_wait += elapsed
+            self.max_wait = max(self.max_wait, elapsed)
+
+    def get_status(self):
+        with self.condition:
+            waits = sorted(self.waits)
+            return {
+                "key": self.key,
+                "requests": self.requests,
+                "delayed": self.delayed,
+                "queued": len(self.queue),
+                "avg_wait": round(self.total_wait / self.requests, 3) if self.requests else 0,
+                "p95_wait": round(waits[min(len(waits)-1, int(len(waits) * 0.95))], 3) if waits else 0,
+                "max_wait": round(self.max_wait, 3)
+            }
+
+_lock = threading.Lock()
+limiters = dict()    # "region/model_id" -> Limiter
+
+def get_limiter(region, model_id):
+    key = f"{region}/{model_id}"
+    with _lock:
+        if key not in limiters:
+            limiters[key] = Limiter(key)
+        return limiters[key]
+
+def estimate_tokens(body):
+    """Input tokens estimated by the length of the body and the maximum output tokens of the request."""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="ignore")
+    if not isinstance(body, str):
+        return default_max_tokens
+
+    max_tokens = default_max_tokens
+    try:
+        request = json.loads(body)
+        if "max_tokens" in request:    # anthropic
+            max_tokens = request["max_tokens"]
+        elif "inferenceConfig" in request:    # nova
+            max_tokens = request["inferenceConfig"].get("max_new_tokens", default_max_tokens)
+    except Exception:
+        pass
+
+    return len(body) // chars_per_token + max_tokens
+
+def before_parameter_build(region, params, context, **kwargs):
+    if not requests_per_minute and not tokens_per_minute:
+        return
+    if "modelId" not in params:
+        return
+
+    limiter = get_limiter(region, params["modelId"])
+    tokens = estimate_tokens(params.get("body"))
+
+    wait = limiter.acquire(tokens)
+    if wait > 1:
+        logger.info(f"{limiter.key}: waited {wait:.1f}s for the rate limit")
+
+    context["rate_limiter"] = (limiter, tokens)
+
+def get_stream_usage(event):
+    """Input and output tokens in the last event of a stream, or None for the other events."""
+    if "metadata" in event:   # converse_stream
+        usage = event["metadata"].get("usage", {})
+        return usage.get("inputTokens", 0) + usage.get("outputTokens", 0)
+
+    body = event.get("chunk", {}).get("bytes")   # invoke_model_with_response_stream
+    if body and b"invocationMetrics" in body:
+        try:
+            metrics = json.loads(body).get("amazon-bedrock-invocationMetrics", {})
+            return metrics.get("inputTokenCount", 0) + metrics.get("outputTokenCount", 0)
+        except Exception:
+            return None
+    return None
+
+class UsageStream:
+    """Event stream which corrects the charged tokens with the usage at the end of the stream."""
+
+    def __init__(self, stream, limiter, tokens):
+        self.stream = stream
+        self.limiter = limiter
+        self.tokens = tokens
+
+    def __iter__(self):
+        used = None
+        try:
+            for event in self.stream:
+                usage = get_stream_usage(event)
+                if usage is not None:
+                    used = usage
+                yield event
+        finally:
+            if used is not None:
+                self.limiter.adjust(used - self.tokens)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def after_call(context, http_response=None, parsed=None, **kwargs):
+    charged = context.pop("rate_limiter", None)
+    if charged is None or http_response is None or not tokens_per_minute:
+        return
+
+    limiter, tokens = charged
+    headers = http_response.headers
+    if "x-amzn-bedrock-input-token-count" in headers:
+        used = int(headers.get("x-amzn-bedrock-input-token-count", 0)) + int(headers.get("x-amzn-bedrock-output-token-count", 0))
+        limiter.adjust(used - tokens)
+        return
+
+    # streaming responses have the usage in the last event of the stream
+    if isinstance(parsed, dict):
+        for key in ["body", "stream"]:
+            if isinstance(parsed.get(key), EventStream):
+                parsed[key] = UsageStream(parsed[key], limiter, tokens)
+
+def register_client(client, region):
+    """Attach the rate limit to a bedrock-runtime client of the region."""
+    events = client.meta.events
+    events.register("before-parameter-build.bedrock-runtime", lambda **kwargs: before_parameter_build(region, **kwargs))
+    events.register("after-call.bedrock-runtime", after_call)
+
+def get_status():
+    with _lock:
+        return [limiter.get_status() for limiter in limiters.values()]